@@ -1,144 +1,131 @@
+import json
 import os
-from flask import Flask, request, jsonify, send_from_directory
+import queue
+import threading
+import time
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
-
-# Load .env file manually
-env_path = ".env"
-if os.path.exists(env_path):
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ[key.strip()] = value.strip()
+from werkzeug.security import safe_join
 
+from envfile import load_env_file
+
+# 先加载 .env，再导入在导入时读取环境变量的模块
+load_env_file()
+
+import events
+import image_variants
+import metrics
+import tracing
+import usage
 from bus import GlobalStateBus
 from dispatcher import dispatch
-from executor import execute_skill
-from skills import SKILLS, skill_by_name
+from executor import execute_skill, generate_image_prompt
+from illustrations import illustrate_storyboard
+from image_pipeline import ImagePipeline
+from runner import (
+    ContextMissingError,
+    WorkflowRunActiveError,
+    _log_context_trace,
+    _prepare_skill_input,
+    patch_skill_output,
+    rebuild_stale,
+    record_skill_output,
+    recover_interrupted,
+    resume_workflow,
+    run_workflow,
+)
+from skills import REGISTRY, SKILLS, skill_by_name
+from speculation import Speculator
+from uploads import (
+    MAX_REQUEST_BYTES,
+    UPLOAD_FOLDER,
+    MaterialExtractor,
+    UnsupportedUploadError,
+    UploadTooLargeError,
+    is_extractable,
+    save_upload,
+)
 
 
-MAX_CONTEXT_CHARS = 8000
+app = Flask(__name__, static_folder="web", static_url_path="")
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_BYTES
+CORS(app)
 
+OUTPUTS_FOLDER = "outputs"
+STATE_PATH = "state.json"
+DISPATCHER_PROMPT = "DispatcherPrompt.md"
 
-class ContextMissingError(RuntimeError):
-    def __init__(self, missing_types: list[str]):
-        self.missing_types = missing_types
-        missing = ", ".join(sorted(set(missing_types)))
-        super().__init__(f"上下文文件缺失或读取失败：{missing}")
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(OUTPUTS_FOLDER, exist_ok=True)
 
+# 提供服务的进程在处理第一个请求前（或 __main__ 启动时）把所属进程已退出的 running Skill
+# 与工作流运行标记为 interrupted；导入模块本身不修改状态（reloader 父进程、其他 worker 同样会导入）。
+# 未完成的工作流可通过 /api/workflow/resume 续跑，或设置 AUTO_RESUME_WORKFLOW=true 自动续跑
+AUTO_RESUME_WORKFLOW = os.getenv("AUTO_RESUME_WORKFLOW", "").lower() in ("1", "true", "yes")
+_RECOVERY = {"done": False, "run": None}
+_RECOVERY_LOCK = threading.Lock()
 
-def _prepare_skill_input(skill, user_message: str, context_index: dict) -> str:
-    """
-    App 层负责：读取上下文 + 组装输入。
-    
-    Executor 只接收最终的 input_text，不做任何上下文读取。
-    """
-    if not skill.requires_context:
-        # 不需要上下文，直接返回用户消息
-        _log_context_trace(
-            f"[prepare_input] skill={skill.name} requires_context=[] input=raw_user_message"
-        )
-        return user_message
-    
-    # 需要上下文：读取并组装
-    parts = []
-    missing_types = []
-    for ctx_type in skill.requires_context:
-        ctx_info = context_index.get(ctx_type)
-        if not ctx_info:
-            missing_types.append(ctx_type)
-            continue
-
-        ref_path = ctx_info.get("ref", "")
-        if not ref_path or not os.path.exists(ref_path):
-            missing_types.append(ctx_type)
-            continue
+# 修改 skills/*.md 后自动重新加载提示词（SKILL_RELOAD_INTERVAL=0 关闭）
+REGISTRY.watch()
 
-        try:
-            with open(ref_path, "r", encoding="utf-8") as f:
-                content = f.read()
-            if not content.strip():
-                missing_types.append(ctx_type)
-                continue
-            if len(content) > MAX_CONTEXT_CHARS:
-                content = content[:MAX_CONTEXT_CHARS] + "\n\n[内容已截断]\n"
-                _log_context_trace(
-                    f"[prepare_input] skill={skill.name} ctx={ctx_type} truncated_to={MAX_CONTEXT_CHARS}"
-                )
-            parts.append(f"=== {ctx_type} ===\n{content}\n")
-            _log_context_trace(
-                f"[prepare_input] skill={skill.name} ctx={ctx_type} ref={ref_path} bytes={len(content)}"
-            )
-        except Exception:
-            missing_types.append(ctx_type)
-    
-    if missing_types:
-        missing = ", ".join(sorted(set(missing_types)))
-        _log_context_trace(
-            f"[prepare_input] skill={skill.name} missing_context={missing}"
-        )
-        raise ContextMissingError(missing_types)
+# 推测式预生成（SPECULATIVE_PREGEN=true 时开启）
+SPECULATOR = Speculator()
 
-    # 组装：上下文 + 用户要求
-    if parts:
-        final_input = "\n".join(parts) + f"\n=== 用户要求 ===\n{user_message}"
-        _log_context_trace(
-            f"[prepare_input] skill={skill.name} final_input_bytes={len(final_input)}"
-        )
-        return final_input
-    else:
-        return user_message
-
-
-# Skill output type 映射（固定枚举）
-SKILL_OUTPUT_TYPES = {
-    "course_goal_definition": "course_goal",
-    "course_design_plan": "design_plan",
-    "course_plan_review": "design_review",
-    "course_script_writing": "course_script",
-    "course_script_review": "script_review",
-    "storyboard_writing": "storyboard",
-    "storyboard_review": "storyboard_review",
-    "course_production_workflow": "workflow_summary",
-}
-
-# Skill 描述映射
-SKILL_DESCRIPTIONS = {
-    "course_goal_definition": "课程目标与学习成果",
-    "course_design_plan": "课程设计方案",
-    "course_plan_review": "课程设计方案评审报告",
-    "course_script_writing": "课程脚本",
-    "course_script_review": "课程脚本评审报告",
-    "storyboard_writing": "分镜脚本",
-    "storyboard_review": "分镜脚本评审报告",
-    "course_production_workflow": "课程制作完整流程",
-}
+# 上传资料的文本提取在后台进行，结果登记为 reference_material 上下文
+MATERIALS = MaterialExtractor(STATE_PATH, OUTPUTS_FOLDER, UPLOAD_FOLDER)
 
+# 图像渲染在后台线程池中进行，结果经 /api/events（或 /api/images/events）推送
+IMAGE_PIPELINE = ImagePipeline()
+SSE_HEARTBEAT_SECONDS = 15
 
-app = Flask(__name__, static_folder="web", static_url_path="")
-CORS(app)
 
-UPLOAD_FOLDER = "uploads"
-OUTPUTS_FOLDER = "outputs"
-STATE_PATH = "state.json"
-DISPATCHER_PROMPT = "DispatcherPrompt.md"
-CONTEXT_TRACE_LOG = os.path.join(OUTPUTS_FOLDER, "context_trace.log")
+def recover_once() -> dict | None:
+    """每个进程只执行一次启动恢复，返回可续跑的工作流运行"""
+    with _RECOVERY_LOCK:
+        if not _RECOVERY["done"]:
+            _RECOVERY["run"] = recover_interrupted(GlobalStateBus(STATE_PATH))
+            _RECOVERY["done"] = True
+        return _RECOVERY["run"]
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUTS_FOLDER, exist_ok=True)
 
+@app.before_request
+def _recover_interrupted():
+    if not _RECOVERY["done"]:
+        recover_once()
+
+
+@app.before_request
+def _begin_trace():
+    # 每个请求一条链路；允许调用方通过 X-Request-Id 传入关联 ID
+    request.environ["trace_token"] = tracing.begin_trace(request.headers.get("X-Request-Id"))
+    # 请求内（及其提交的后台任务中）的 LLM 调用都计入当前会话
+    request.environ["usage_token"] = usage.begin(STATE_PATH)
+    request.environ["request_started"] = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc()
+
+
+@app.after_request
+def _attach_trace_id(response):
+    trace_id = tracing.current_trace_id()
+    if trace_id:
+        response.headers["X-Trace-Id"] = trace_id
+    endpoint = request.endpoint or "unknown"
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    started = request.environ.get("request_started")
+    if started is not None:
+        metrics.HTTP_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+    return response
 
-def _log_context_trace(message: str):
-    """
-    记录上下文链路追踪日志（用于排查“断层/未注入/吐提示词”问题）。
-    """
-    try:
-        with open(CONTEXT_TRACE_LOG, "a", encoding="utf-8") as f:
-            f.write(message.rstrip() + "\n")
-    except Exception:
-        pass
+
+@app.teardown_request
+def _end_trace(exc):
+    usage_token = request.environ.pop("usage_token", None)
+    if usage_token is not None:
+        usage.end(usage_token)
+    token = request.environ.pop("trace_token", None)
+    if token is not None:
+        tracing.end_trace(token)
+        metrics.HTTP_IN_FLIGHT.dec()
 
 
 @app.route("/")
@@ -154,10 +141,16 @@ def chat():
     uploaded_files = []
     for file in files:
         if file and file.filename:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            file.save(filepath)
-            uploaded_files.append(filepath)
+            # 分块落盘并计算哈希，超过大小上限时中止
+            try:
+                upload = save_upload(file)
+            except UploadTooLargeError as exc:
+                return jsonify({"error": str(exc)}), 413
+            except UnsupportedUploadError as exc:
+                return jsonify({"error": str(exc)}), 415
+            uploaded_files.append(upload)
+            if is_extractable(upload.path):
+                MATERIALS.submit(upload)
 
     if not message and not uploaded_files:
         return jsonify({"error": "No message or files provided"}), 400
@@ -185,6 +178,7 @@ def chat():
     reply = ""
     output_files = []
     options = []
+    image_jobs = []
 
     if action == "call_skill":
         skill_name = result.get("skill_name")
@@ -194,13 +188,14 @@ def chat():
             return jsonify({"error": f"Unknown skill: {skill_name}"}), 500
 
         bus.set_stage("skill_selected")
+        bus.record_transition(state.get("selected_skill"), skill.name)
         bus.set_selected_skill(skill.name)
         bus.mark_skill_running(skill.name)
 
         try:
             # App 层读取上下文并组装输入
             context_index = state.get("context_index", {})
-            input_text = _prepare_skill_input(skill, message, context_index)
+            skill_input = _prepare_skill_input(skill, message, context_index)
         except ContextMissingError as exc:
             # 上下文文件缺失/读取失败，返回 ask_user，保留 pending_user_input
             bus.mark_skill_error(skill.name)
@@ -208,26 +203,57 @@ def chat():
                 "reply": str(exc),
                 "output_files": [],
                 "options": [],
-                "bus_state": bus.get_state(),
+                "state_version": bus.state_etag(),
             }), 200
 
         try:
-            # Executor 只接收最终输入
-            output_path = execute_skill(skill, input_text)
-            bus.mark_skill_done(
-                skill.name,
-                output_path,
-                SKILL_OUTPUT_TYPES.get(skill.name, "unknown"),
-                SKILL_DESCRIPTIONS.get(skill.name, skill.description)
-            )
+            if skill.skill_type == "workflow":
+                # 工作流逐步执行并记录检查点，进程中断后可从未完成的步骤续跑
+                steps = run_workflow(bus, skill, message, OUTPUTS_FOLDER)
+                output_files.extend(step["ref"] for step in steps)
+            elif skill.output_type == "image":
+                # 提示词在请求内生成并立即返回；渲染交给后台管线，完成后再登记产出
+                output_path = skill.output_filename
+                image_prompt = generate_image_prompt(skill, skill_input, output_path)
+                job = IMAGE_PIPELINE.submit(
+                    image_prompt,
+                    output_path,
+                    group=skill.name,
+                    on_done=_register_image(skill, context_index),
+                )
+                output_files.append(os.path.splitext(output_path)[0] + "_prompt.txt")
+                image_jobs.append(job.to_dict())
+            else:
+                # 已有产出且请求只涉及部分章节时，只重新生成这些章节
+                output_path = patch_skill_output(bus, skill, message, context_index)
+                if output_path is None:
+                    # 命中推测式预生成时直接使用后台结果
+                    output_path = SPECULATOR.take(skill, message, context_index)
+                    if output_path is None:
+                        # Executor 只接收最终输入
+                        output_path = execute_skill(skill, skill_input)
+                    # 登记产出；内容变化时下游上下文标记为 stale
+                    record_skill_output(bus, skill, output_path, context_index)
+                output_files.append(output_path)
+                # 后台预生成最可能的下一个 Skill
+                SPECULATOR.schedule(bus.get_state(), skill.name)
             
             # Skill 已消耗用户输入，清空 pending_user_input（语义锁）
             bus.clear_pending_input()
             
             reply = ""
-            output_files.append(output_path)
+        except usage.BudgetExceededError as exc:
+            # 超出会话预算（BUDGET_ACTION=reject）：保留 pending_user_input，调整预算后可重试
+            bus.mark_skill_error(skill.name, skill.produces)
+            return jsonify({
+                "reply": str(exc),
+                "output_files": [],
+                "options": [],
+                "usage": exc.session,
+                "state_version": bus.state_etag(),
+            }), 200
         except Exception as exc:
-            output_type = SKILL_OUTPUT_TYPES.get(skill.name)
+            output_type = skill.produces
             bus.mark_skill_error(skill.name, output_type)
             return jsonify({"error": f"Skill execution failed: {exc}"}), 500
 
@@ -253,14 +279,238 @@ def chat():
         "reply": reply,
         "output_files": output_files,
         "options": options,
-        "bus_state": bus.get_state(),
+        "image_jobs": image_jobs,
+        "uploads": [upload.to_dict() for upload in uploaded_files],
+        "state_version": bus.state_etag(),
+    })
+
+
+@app.errorhandler(413)
+def request_too_large(exc):
+    return jsonify({"error": f"请求超过大小上限（{MAX_REQUEST_BYTES // (1024 * 1024)} MB）"}), 413
+
+
+def _register_image(skill, context_index: dict):
+    """渲染结束后的回调（后台线程）：成功则登记产出，失败则标记错误"""
+    def on_done(job):
+        bus = GlobalStateBus(STATE_PATH)
+        if job.status == "done":
+            record_skill_output(bus, skill, job.output_path, context_index)
+            entry = bus.find_context_by_ref(job.output_path) or {}
+            job.content_hash = entry.get("content_hash")
+        else:
+            bus.mark_skill_error(skill.name, skill.produces)
+    return on_done
+
+
+@app.route("/api/images/<job_id>")
+def image_job(job_id):
+    job = IMAGE_PIPELINE.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown image job: {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/api/events")
+def state_events():
+    """
+    SSE：推送总线状态增量（state：Skill 状态、context_index、stage、工作流步骤）
+    与图像渲染进度（image）。断线重连时按 Last-Event-ID 补发错过的事件。
+    """
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID", ""))
+    except ValueError:
+        last_event_id = None
+
+    def stream():
+        q, backlog = events.BROKER.subscribe(last_event_id)
+        try:
+            # 告知客户端当前版本，便于判断是否需要重新拉取 /api/state
+            yield f"event: hello\ndata: {json.dumps({'state_version': GlobalStateBus(STATE_PATH).state_etag()})}\n\n"
+            for event in backlog:
+                yield events.format_sse(event)
+            while True:
+                try:
+                    event = q.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield events.format_sse(event)
+        finally:
+            events.BROKER.unsubscribe(q)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/images/events")
+def image_events():
+    """SSE：推送图像渲染任务的状态变化（queued → rendering → done / failed）"""
+    def stream():
+        q = IMAGE_PIPELINE.subscribe()
+        try:
+            while True:
+                try:
+                    data = q.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: image\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        finally:
+            IMAGE_PIPELINE.unsubscribe(q)
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/storyboard/illustrations", methods=["POST"])
+def storyboard_illustrations():
+    """为分镜中的每个镜头批量生成插图（后台并发渲染，进度经 /api/images/events 推送）"""
+    bus = GlobalStateBus(STATE_PATH)
+    try:
+        result = illustrate_storyboard(bus, IMAGE_PIPELINE)
+    except (ContextMissingError, ValueError) as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify({
+        "items": result["items"],
+        "image_jobs": result["jobs"],
+        "state_version": bus.state_etag(),
+    })
+
+
+@app.route("/api/state")
+def get_state():
+    """
+    完整的总线状态，支持条件请求：If-None-Match 与当前版本一致时返回 304。
+
+    /api/chat 等接口只返回 state_version，前端在版本变化时再来这里取完整状态。
+    """
+    bus = GlobalStateBus(STATE_PATH)
+    etag = bus.state_etag()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(bus.get_state())
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/api/usage")
+def get_usage():
+    """LLM 用量与估算费用：会话合计、按 Skill、按工作流运行，以及预算配置"""
+    bus = GlobalStateBus(STATE_PATH)
+    session_usage = bus.get_usage()
+    return jsonify({
+        **session_usage,
+        "budget": usage.budget_config(),
+        "over_budget": usage.over_budget(session_usage["session"]),
+        "state_version": bus.state_etag(),
     })
 
 
+@app.route("/api/rebuild", methods=["POST"])
+def rebuild():
+    """只重跑 stale 的下游上下文（按依赖拓扑顺序，输入未变则跳过）"""
+    bus = GlobalStateBus(STATE_PATH)
+    results = rebuild_stale(bus)
+    return jsonify({
+        "results": results,
+        "state_version": bus.state_etag(),
+    })
+
+
+@app.route("/api/workflow/resume", methods=["POST"])
+def resume():
+    """从检查点续跑被中断的工作流，已 ready 的步骤直接复用"""
+    bus = GlobalStateBus(STATE_PATH)
+    run = bus.get_workflow_run()
+    if not run or run["status"] == "done":
+        return jsonify({"error": "No interrupted workflow to resume"}), 400
+    try:
+        steps = resume_workflow(bus)
+    except WorkflowRunActiveError as exc:
+        return jsonify({"error": str(exc)}), 409
+    except Exception as exc:
+        return jsonify({"error": f"Workflow resume failed: {exc}"}), 500
+    return jsonify({
+        "steps": steps,
+        "output_files": [step["ref"] for step in steps or []],
+        "state_version": bus.state_etag(),
+    })
+
+
+def _resume_in_background(run: dict):
+    with tracing.trace(f"resume-{run['run_id'][:8]}"):
+        try:
+            resume_workflow(GlobalStateBus(STATE_PATH))
+        except Exception as exc:
+            _log_context_trace(f"[recover] workflow resume failed: {exc}")
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus 文本格式的指标导出"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+# 带 ?v=<内容哈希> 版本参数的 URL 内容不可变，可长期缓存
+IMMUTABLE_CACHE_SECONDS = 365 * 24 * 3600
+
+
 @app.route("/outputs/<path:filename>")
 def serve_output(filename):
-    return send_from_directory(OUTPUTS_FOLDER, filename)
+    """
+    返回产出文件（支持 Range 与 ETag 条件请求）。
+
+    图片按 Accept 头协商返回 AVIF / WebP 版本，?size=thumb 返回缩略图；
+    变体尚未生成时先返回原图并在后台生成。
+    """
+    served = filename
+    best = True
+    path = safe_join(OUTPUTS_FOLDER, filename)
+    if path and os.path.isfile(path) and image_variants.is_image(path):
+        variant, best = image_variants.negotiate(
+            path, request.headers.get("Accept", ""), thumb=request.args.get("size") == "thumb"
+        )
+        served = os.path.relpath(variant, OUTPUTS_FOLDER)
+
+    # 已登记的产出用内容哈希作为 ETag（变体附加文件名区分），其余文件使用默认 ETag
+    etag = True
+    entry = GlobalStateBus(STATE_PATH).find_context_by_ref(os.path.join(OUTPUTS_FOLDER, filename))
+    if entry and entry.get("content_hash"):
+        etag = entry["content_hash"]
+        if served != filename:
+            etag += "-" + os.path.basename(served)
+
+    response = send_from_directory(OUTPUTS_FOLDER, served, conditional=True, etag=etag)
+    if image_variants.is_image(filename):
+        response.vary.add("Accept")
+    # 只有版本参数等于当前内容哈希时 URL 才对应不可变的内容；旧版本或任意值仍需重新验证
+    version = request.args.get("v")
+    if version and best and entry and version == entry.get("content_hash"):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_CACHE_SECONDS
+        response.cache_control.immutable = True
+    else:
+        # 同一路径的产出可能被重新生成，每次用 ETag 重新验证
+        response.cache_control.no_cache = True
+    return response
 
 
 if __name__ == "__main__":
+    # debug 模式下 reloader 的父进程也会执行到这里，只在实际提供服务的子进程中恢复与续跑
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        interrupted_run = recover_once()
+        if AUTO_RESUME_WORKFLOW and interrupted_run:
+            threading.Thread(
+                target=_resume_in_background, args=(interrupted_run,), name="workflow-resume", daemon=True
+            ).start()
     app.run(host="0.0.0.0", port=3000, debug=True)
@@ -0,0 +1,392 @@
+"""
+多课程批量生成：读取课程清单（JSONL / CSV），为每门课程在独立的会话目录中
+运行 course_production_workflow。
+
+- 每门课程：<batch_dir>/<course_id>/state.json + outputs/，互不干扰
+- 有界线程池并发执行，所有线程共享同一个 LLM 限流器
+- 重跑同一个 batch_dir 时，已完成的课程跳过，失败或被中断的课程从检查点继续
+- 结束后输出每门课程的耗时、状态与 LLM 用量（token 数、估算费用），并写入 <batch_dir>/report.json
+
+离线模式（run_batch_offline）不占用工作线程：每一轮把所有课程当前可执行的步骤合成一个
+批量作业提交给模型服务的批量接口，轮询到完成后登记产出、推进到下一步，按批量单价计费。
+"""
+
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import tracing
+import usage
+from bus import GlobalStateBus
+from executor import execute_skill, render_prompt, write_text_output
+from llm import LLMClient
+from runner import (
+    _prepare_skill_input,
+    begin_workflow_step,
+    complete_workflow_step,
+    fail_workflow_step,
+    finish_workflow,
+    next_workflow_step,
+    recover_interrupted,
+    run_workflow,
+    skill_output_path,
+    start_or_resume_run,
+)
+from skills import skill_by_name
+
+
+WORKFLOW_NAME = "course_production_workflow"
+REPORT_FILENAME = "report.json"
+PENDING_JOBS_FILENAME = "batch_jobs.json"  # 离线模式下已提交、尚未处理结果的批量作业
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "30"))
+BATCH_MAX_ATTEMPTS = int(os.getenv("BATCH_MAX_ATTEMPTS", "3"))  # 单个步骤在批量作业中失败后的最多提交次数
+
+
+def load_manifest(path: str) -> list[dict]:
+    """
+    读取课程清单。每条至少包含 topic，可选 audience / duration / id / notes。
+
+    .csv 按表头读取，其余按 JSONL（每行一个 JSON 对象）读取。
+    """
+    courses = []
+    with open(path, "r", encoding="utf-8-sig") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for index, row in enumerate(rows, start=1):
+        row = {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+        if not row.get("topic"):
+            raise ValueError(f"Manifest row {index} has no topic.")
+        row["id"] = str(row.get("id") or f"course_{index:03d}")
+        courses.append(row)
+    ids = [c["id"] for c in courses]
+    if len(ids) != len(set(ids)):
+        raise ValueError("Manifest contains duplicate course ids.")
+    return courses
+
+
+def course_brief(course: dict) -> str:
+    """把清单条目转成工作流的用户输入"""
+    lines = [f"课程主题：{course['topic']}"]
+    if course.get("audience"):
+        lines.append(f"目标人群：{course['audience']}")
+    if course.get("duration"):
+        lines.append(f"课程时长：{course['duration']}")
+    if course.get("notes"):
+        lines.append(f"补充说明：{course['notes']}")
+    return "\n".join(lines)
+
+
+def _open_course(course: dict, batch_dir: str) -> tuple[GlobalStateBus, str]:
+    """课程的会话总线与输出目录"""
+    course_dir = os.path.join(batch_dir, course["id"])
+    outputs_dir = os.path.join(course_dir, "outputs")
+    os.makedirs(outputs_dir, exist_ok=True)
+    return GlobalStateBus(os.path.join(course_dir, "state.json")), outputs_dir
+
+
+def _finish_result(result: dict, bus: GlobalStateBus, workflow) -> dict:
+    skills = bus.get_state()["skills"]
+    result["steps"] = {step: skills.get(step, {}).get("status") for step in workflow.workflow_steps}
+    # 课程会话的累计用量（含此前被中断的运行）
+    result["usage"] = bus.get_usage()["session"]
+    return result
+
+
+def run_course(course: dict, batch_dir: str) -> dict:
+    """在独立会话目录中运行一门课程的完整工作流"""
+    bus, outputs_dir = _open_course(course, batch_dir)
+    workflow = skill_by_name(WORKFLOW_NAME)
+
+    result = {"id": course["id"], "topic": course["topic"], "session_id": bus.get_state()["session_id"]}
+    if bus.get_state()["skills"].get(WORKFLOW_NAME, {}).get("status") == "done":
+        result.update({"status": "skipped", "seconds": 0.0, "steps": {}, "usage": bus.get_usage()["session"]})
+        return result
+
+    recover_interrupted(bus)
+    started = time.perf_counter()
+    with tracing.trace(f"batch-{course['id']}"):
+        try:
+            steps = run_workflow(bus, workflow, course_brief(course), outputs_dir, resume=True)
+            result["status"] = "done"
+        except Exception as exc:
+            steps = []
+            result["status"] = "failed"
+            result["error"] = str(exc)
+    result["seconds"] = round(time.perf_counter() - started, 2)
+    result["executed"] = sum(1 for s in steps if s["status"] == "executed")
+    return _finish_result(result, bus, workflow)
+
+
+def run_batch(manifest_path: str, batch_dir: str, workers: int = 4) -> dict:
+    courses = load_manifest(manifest_path)
+    os.makedirs(batch_dir, exist_ok=True)
+    started = time.perf_counter()
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(run_course, course, batch_dir): course for course in courses}
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"[{result['status']}] {result['id']} {result['topic']} ({result['seconds']}s)")
+
+    return _write_report(manifest_path, batch_dir, courses, results, started, workers=workers)
+
+
+def _write_report(manifest_path: str, batch_dir: str, courses: list[dict], results: list[dict], started: float, **extra) -> dict:
+    order = {course["id"]: i for i, course in enumerate(courses)}
+    results.sort(key=lambda r: order[r["id"]])
+    total_usage = usage.empty_usage()
+    for result in results:
+        usage.add_usage(total_usage, result.get("usage", {}))
+    report = {
+        "manifest": os.path.abspath(manifest_path),
+        "finished_at": datetime.now().isoformat(),
+        "seconds": round(time.perf_counter() - started, 2),
+        **extra,
+        "counts": {
+            status: sum(1 for r in results if r["status"] == status)
+            for status in ("done", "failed", "skipped")
+        },
+        "usage": total_usage,
+        "courses": results,
+    }
+    with open(os.path.join(batch_dir, REPORT_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+# ==================== 离线批量模式 ====================
+
+def _plan_step(session: dict, workflow) -> dict | None:
+    """
+    课程当前需要执行的步骤及其请求；工作流全部完成时返回 None。
+
+    图像步骤不走批量接口，在此直接同步执行后继续找下一步。
+    """
+    bus = session["bus"]
+    while True:
+        skill = next_workflow_step(bus, workflow)
+        if skill is None:
+            return None
+        run = bus.get_workflow_run()
+        context_index = bus.get_state().get("context_index", {})
+        skill_input = _prepare_skill_input(skill, run["user_message"], context_index)
+        output_path = skill_output_path(skill, run.get("outputs_dir"))
+        if skill.output_type != "image":
+            prompt, input_text = render_prompt(skill, skill_input)
+            return {
+                "bus": bus,
+                "skill": skill,
+                "prompt": prompt,
+                "input_text": input_text,
+                "output_path": output_path,
+                "context_index": context_index,
+                "run_id": run["run_id"],
+            }
+        begin_workflow_step(bus, skill)
+        with usage.scope(state_path=bus.path, run_id=run["run_id"]):
+            execute_skill(skill, skill_input, output_path)
+        complete_workflow_step(bus, skill, output_path, context_index)
+        session["executed"] += 1
+
+
+def _fail_course(session: dict, workflow, skill, exc: Exception):
+    if skill is not None:
+        fail_workflow_step(session["bus"], workflow, skill)
+    session["result"].update({"status": "failed", "error": str(exc)})
+
+
+def _plan_round(sessions: dict[str, dict], workflow) -> dict[str, dict]:
+    """为每门进行中的课程准备下一步请求；已完成或失败的课程在此结束"""
+    planned = {}
+    for course_id, session in sessions.items():
+        if session["result"].get("status"):
+            continue
+        bus = session["bus"]
+        try:
+            with usage.scope(state_path=bus.path):
+                # 会话超出预算且 BUDGET_ACTION=reject 时不再提交
+                usage.apply_budget("strong")
+            step = _plan_step(session, workflow)
+        except Exception as exc:
+            _fail_course(session, workflow, next_workflow_step(bus, workflow), exc)
+            continue
+        if step is None:
+            finish_workflow(bus, workflow)
+            session["result"]["status"] = "done"
+            session["result"]["seconds"] = round(time.perf_counter() - session["started"], 2)
+            continue
+        planned[course_id] = step
+    return planned
+
+
+def _load_pending_jobs(batch_dir: str) -> list[dict]:
+    path = os.path.join(batch_dir, PENDING_JOBS_FILENAME)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [{**job, "resumed": True} for job in json.load(f)]
+
+
+def _job_matches(job: dict, planned: dict[str, dict]) -> bool:
+    return all(
+        item["course"] in planned and planned[item["course"]]["skill"].name == item["step"]
+        for item in job["items"]
+    )
+
+
+def _save_pending_jobs(batch_dir: str, jobs: list[dict]):
+    path = os.path.join(batch_dir, PENDING_JOBS_FILENAME)
+    if not jobs:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump([{k: v for k, v in job.items() if k != "resumed"} for job in jobs], f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _submit_round(llm: LLMClient, planned: dict[str, dict]) -> list[dict]:
+    """按模型档位分组，每组提交一个批量作业"""
+    by_tier: dict[str, list[str]] = {}
+    for course_id, step in planned.items():
+        by_tier.setdefault(step["skill"].model_tier, []).append(course_id)
+    jobs = []
+    for tier, course_ids in by_tier.items():
+        prompts = [planned[course_id]["prompt"] for course_id in course_ids]
+        name = llm.submit_batch(prompts, tier=tier)
+        jobs.append({"name": name, "tier": tier, "items": [
+            {"course": course_id, "step": planned[course_id]["skill"].name} for course_id in course_ids
+        ]})
+        print(f"Submitted batch job {name}: {len(prompts)} request(s)")
+    for step in planned.values():
+        begin_workflow_step(step["bus"], step["skill"])
+    return jobs
+
+
+def _wait_for_job(llm: LLMClient, job: dict, poll_interval: float) -> list:
+    while True:
+        results = llm.poll_batch(job["name"])
+        if results is not None:
+            return results
+        time.sleep(poll_interval)
+
+
+def _apply_results(sessions: dict[str, dict], planned: dict[str, dict], job: dict, results: list, workflow):
+    """
+    登记一个作业的结果：写产出、记用量、记检查点。
+
+    失败的请求不写产出、不记检查点，步骤保持未完成，下一轮重新提交；
+    同一步骤累计失败 BATCH_MAX_ATTEMPTS 次后该课程标记为失败。
+    """
+    model = LLMClient().model_for(job["tier"])
+    for item, result in zip(job["items"], results):
+        session, step = sessions[item["course"]], planned[item["course"]]
+        bus, skill = session["bus"], step["skill"]
+        with usage.scope(state_path=bus.path, skill=skill.name, run_id=step["run_id"]):
+            usage.record("batch", model, result.tokens, 0.0)
+        try:
+            write_text_output(skill, result.text, step["input_text"], step["output_path"])
+        except Exception as exc:
+            error = result.error or str(exc)
+            attempts = session["attempts"][skill.name] = session["attempts"].get(skill.name, 0) + 1
+            if attempts >= BATCH_MAX_ATTEMPTS:
+                _fail_course(session, workflow, skill, RuntimeError(f"{skill.name}: {error}"))
+            else:
+                bus.set_skill_status(skill.name, "error")
+                print(f"[retry] {item['course']} {skill.name} ({attempts}/{BATCH_MAX_ATTEMPTS}): {error}")
+            continue
+        complete_workflow_step(bus, skill, step["output_path"], step["context_index"])
+        session["executed"] += 1
+
+
+def run_batch_offline(manifest_path: str, batch_dir: str, poll_interval: float = BATCH_POLL_SECONDS) -> dict:
+    """
+    离线批量模式：各课程的工作流按轮推进，每轮的请求合成一个批量作业（按模型档位分组）。
+
+    已提交的作业记录在 <batch_dir>/batch_jobs.json；进程中断后重跑同一 batch_dir，
+    先继续轮询这些作业（作业已失效时重新提交），已完成的步骤不会重复执行。
+    """
+    courses = load_manifest(manifest_path)
+    os.makedirs(batch_dir, exist_ok=True)
+    started = time.perf_counter()
+    workflow = skill_by_name(WORKFLOW_NAME)
+
+    sessions: dict[str, dict] = {}
+    for course in courses:
+        bus, outputs_dir = _open_course(course, batch_dir)
+        result = {"id": course["id"], "topic": course["topic"], "session_id": bus.get_state()["session_id"]}
+        if bus.get_state()["skills"].get(WORKFLOW_NAME, {}).get("status") == "done":
+            result.update({"status": "skipped", "seconds": 0.0})
+        else:
+            recover_interrupted(bus)
+            start_or_resume_run(bus, workflow, course_brief(course), outputs_dir, resume=True)
+            bus.mark_skill_running(WORKFLOW_NAME)
+        sessions[course["id"]] = {"bus": bus, "result": result, "started": started, "executed": 0, "attempts": {}}
+
+    llm = LLMClient()
+    resumed = _load_pending_jobs(batch_dir)
+    submitted = 0
+    with tracing.trace(f"batch-offline-{os.path.basename(os.path.abspath(batch_dir))}"):
+        while True:
+            planned = _plan_round(sessions, workflow)
+            if not planned:
+                break
+            # 续跑时先处理中断前提交的作业（其中的步骤须与当前规划一致），本轮不再提交新作业
+            jobs = [job for job in resumed if _job_matches(job, planned)]
+            resumed = []
+            for job in jobs:
+                print(f"Resuming batch job {job['name']}: {len(job['items'])} request(s)")
+            if not jobs:
+                jobs = _submit_round(llm, planned)
+                submitted += len(jobs)
+            _save_pending_jobs(batch_dir, jobs)
+
+            for job in jobs:
+                try:
+                    results = _wait_for_job(llm, job, poll_interval)
+                except Exception as exc:
+                    if job.get("resumed"):
+                        # 中断前的作业已失效（如本地替身的作业随进程丢失），下一轮重新提交
+                        print(f"Batch job {job['name']} is no longer available: {exc}")
+                        continue
+                    for item in job["items"]:
+                        _fail_course(sessions[item["course"]], workflow, planned[item["course"]]["skill"], exc)
+                    continue
+                _apply_results(sessions, planned, job, results, workflow)
+            _save_pending_jobs(batch_dir, [])
+
+    results = []
+    for session in sessions.values():
+        result = session["result"]
+        result.setdefault("seconds", round(time.perf_counter() - started, 2))
+        result["executed"] = session["executed"]
+        results.append(_finish_result(result, session["bus"], workflow))
+        print(f"[{result['status']}] {result['id']} {result['topic']} ({result['seconds']}s)")
+    return _write_report(manifest_path, batch_dir, courses, results, started, mode="batch_api", batch_jobs=submitted)
+
+
+def print_report(report: dict):
+    print()
+    print(f"{'id':<16}{'status':<10}{'seconds':>10}{'tokens':>12}{'cost($)':>10}  topic")
+    for course in report["courses"]:
+        totals = course.get("usage", {})
+        line = (
+            f"{course['id']:<16}{course['status']:<10}{course['seconds']:>10}"
+            f"{usage.total_tokens(totals):>12}{totals.get('cost_usd', 0):>10.4f}  {course['topic']}"
+        )
+        if course.get("error"):
+            line += f"  ! {course['error']}"
+        print(line)
+    counts = report["counts"]
+    print(
+        f"\n{counts['done']} done, {counts['failed']} failed, {counts['skipped']} skipped "
+        f"in {report['seconds']}s, {usage.total_tokens(report['usage'])} tokens, ${report['usage']['cost_usd']:.4f}"
+    )
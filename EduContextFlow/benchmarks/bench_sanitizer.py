@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+输出清理器基准测试：_clean_llm_output（线性实现）vs 旧版多遍扫描实现。
+
+语料取自 outputs/ 与 检查文件夹/ 中的真实生成结果，并按倍数放大、
+拼接复述的用户输入，模拟长脚本 + 长输入的场景。
+
+用法（在 EduContextFlow 目录下）：
+    python benchmarks/bench_sanitizer.py [--repeat 20] [--scales 1,8,32]
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from executor import OutputSanitizer, _clean_llm_output
+
+
+def _legacy_clean_llm_output(raw_output: str, original_input: str) -> str:
+    """旧版实现（原样保留，仅用于对照）。"""
+    output = raw_output.strip()
+
+    bad_starts = [
+        "好的，这是根据",
+        "好的，我来",
+        "好的，以下是",
+        "根据您的要求",
+        "这是为您",
+        "以下是根据",
+        "## Prompt 模板",
+        "## 输出要求",
+        "===教学内容===",
+        "===用户需求===",
+    ]
+
+    for bad_start in bad_starts:
+        if bad_start in output:
+            idx = output.find(bad_start)
+            if idx < 100:
+                after_marker = output[idx:]
+                lines = after_marker.split('\n')
+                for i, line in enumerate(lines):
+                    stripped = line.strip()
+                    if not stripped or stripped.startswith('#') or stripped.startswith('=') or stripped.startswith('-'):
+                        continue
+                    if any(kw in stripped for kw in ['Prompt', '模板', 'Template', '要求', 'Requirements', '{{', '}}']):
+                        continue
+                    if stripped and (stripped[0].isdigit() or len(stripped) > 10):
+                        output = '\n'.join(lines[i:]).strip()
+                        break
+
+    if original_input in output:
+        last_idx = output.rfind(original_input)
+        if last_idx != -1:
+            after_input = output[last_idx + len(original_input):].strip()
+            if after_input:
+                lines = after_input.split('\n')
+                content_start = 0
+                for i, line in enumerate(lines):
+                    stripped = line.strip()
+                    if stripped in ['===', '============', '==========', '---', '现在请直接输出', '要求：']:
+                        content_start = i + 1
+                    elif stripped.startswith('现在请') or stripped.startswith('要求') or stripped.startswith('==='):
+                        content_start = i + 1
+                    elif stripped and not stripped.startswith('=') and not stripped.startswith('-'):
+                        break
+
+                cleaned = '\n'.join(lines[content_start:]).strip()
+                if cleaned:
+                    return cleaned
+
+    lines = output.split('\n')
+    real_content_lines = []
+    in_meta_section = True
+
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            continue
+        is_meta = (
+            stripped.startswith('#') or
+            stripped.startswith('=') or
+            stripped.startswith('Prompt') or
+            '模板' in stripped or
+            'Template' in stripped or
+            '{{' in stripped or
+            '}}' in stripped or
+            stripped in ['---', '===', '============']
+        )
+        if not is_meta:
+            in_meta_section = False
+        if not in_meta_section:
+            real_content_lines.append(line)
+
+    if real_content_lines:
+        cleaned = '\n'.join(real_content_lines).strip()
+        if cleaned:
+            return cleaned
+
+    return output
+
+
+def _load_corpus() -> list[tuple[str, str]]:
+    paths = sorted(
+        glob.glob(os.path.join(ROOT, "outputs", "*.md"))
+        + glob.glob(os.path.join(ROOT, "outputs", "*.txt"))
+        + glob.glob(os.path.join(ROOT, "检查文件夹", "*.md"))
+    )
+    corpus = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            corpus.append((os.path.relpath(path, ROOT), f.read()))
+    return corpus
+
+
+def _cases(text: str, scale: int) -> list[tuple[str, str, str]]:
+    """同一语料的三种形态：原样、带复述开头、复述了完整输入。"""
+    body = "\n\n".join([text] * scale)
+    user_input = "=== design_plan ===\n" + body[: len(body) // 2]
+    return [
+        ("plain", body, user_input),
+        ("bad_start", "好的，以下是根据您的设计方案生成的内容：\n\n## 输出要求\n\n" + body, user_input),
+        ("echo", f"{user_input}\n\n=== 用户要求 ===\n现在请直接输出\n\n{body}", user_input),
+    ]
+
+
+def _time(func, raw: str, user_input: str, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(raw, user_input)
+    return (time.perf_counter() - start) / repeat
+
+
+def _streamed(raw: str, user_input: str, chunk_size: int = 256) -> str:
+    """流式清理：增量拼接 + flush()；复述了用户输入时（flush() 为 None）以 finish() 为准"""
+    sanitizer = OutputSanitizer(user_input)
+    streamed = "".join(sanitizer.feed(raw[i:i + chunk_size]) for i in range(0, len(raw), chunk_size))
+    tail = sanitizer.flush()
+    return sanitizer.finish() if tail is None else streamed + tail
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark _clean_llm_output")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--scales", default="1,8,32")
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    corpus = _load_corpus()
+    mismatches = 0
+
+    print(f"{'file':<36}{'case':<11}{'chars':>9}{'legacy ms':>11}{'new ms':>9}{'stream ms':>11}{'speedup':>9}")
+    for name, text in corpus:
+        for scale in scales:
+            for case, raw, user_input in _cases(text, scale):
+                expected = _legacy_clean_llm_output(raw, user_input)
+                if _clean_llm_output(raw, user_input) != expected or _streamed(raw, user_input) != expected:
+                    mismatches += 1
+                    print(f"MISMATCH {name} case={case} scale={scale}")
+                legacy = _time(_legacy_clean_llm_output, raw, user_input, args.repeat)
+                new = _time(_clean_llm_output, raw, user_input, args.repeat)
+                stream = _time(_streamed, raw, user_input, args.repeat)
+                print(
+                    f"{name[:35]:<36}{case:<11}{len(raw):>9}"
+                    f"{legacy * 1000:>11.3f}{new * 1000:>9.3f}{stream * 1000:>11.3f}"
+                    f"{legacy / new if new else 0:>8.1f}x"
+                )
+
+    print(f"\nmismatches: {mismatches}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,117 @@
+"""
+离线基准测试使用的假 LLM：替换 LLMClient 的网络调用，返回确定性的内容。
+
+install() 直接替换 LLMClient 类上的方法，dispatcher / executor 中
+新建的 LLMClient 实例都会生效；uninstall() 恢复原实现。
+"""
+
+import json
+import re
+import time
+
+from llm import LLMClient
+
+
+_SECTION = """## 第{n}章 模块{n}
+
+### 讲解
+这一部分讲解第{n}个知识点，结合生活中的例子说明原理，并给出关键结论。{pad}
+
+### 示例
+示例{n}：学生分组完成一个小实验，记录观察结果并讨论。
+
+### 练习
+练习{n}：根据本章内容回答三个问题，并说明理由。
+"""
+
+
+def fake_document(sections: int = 6, pad_chars: int = 200) -> str:
+    pad = "补充说明。" * max(1, pad_chars // 5)
+    body = "\n".join(_SECTION.format(n=i + 1, pad=pad) for i in range(sections))
+    return f"# 课程内容\n\n{body}"
+
+
+class FakeLLM:
+    """
+    可配置的假 LLM。
+
+    latency: 每次调用的模拟延迟（秒），默认 0，只测本地开销。
+    dispatch_skill: dispatch 时返回的 skill 名称。
+    fail_on: prompt 中包含该文本时抛出 RuntimeError（模拟服务端错误）。
+    """
+
+    CHUNK_SIZE = 16
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        sections: int = 6,
+        dispatch_skill: str = "course_goal_definition",
+        fail_on: str | None = None,
+    ):
+        self.latency = latency
+        self.fail_on = fail_on
+        self.document = fake_document(sections)
+        self.dispatch_skill = dispatch_skill
+        self.calls = 0
+        self.prompt_bytes = 0
+        self._originals = {}
+
+    def complete(self, prompt: str, on_chunk=None) -> str:
+        self.calls += 1
+        self.prompt_bytes += len(prompt)
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_on and self.fail_on in prompt:
+            raise RuntimeError("503 UNAVAILABLE (fake)")
+        text = self._respond(prompt)
+        if on_chunk is None:
+            return text
+        # 流式：按固定大小分块回调，回调返回 True 时停止（与 LLMClient.complete 的语义一致）
+        for start in range(0, len(text), self.CHUNK_SIZE):
+            if on_chunk(text[start:start + self.CHUNK_SIZE]):
+                return text[:start + self.CHUNK_SIZE]
+        return text
+
+    def _respond(self, prompt: str) -> str:
+        if "available_skills" in prompt:
+            return json.dumps({
+                "action": "call_skill",
+                "skill_name": self.dispatch_skill,
+                "reason": "fake dispatch",
+            })
+        if "【目标章节】" in prompt:
+            match = re.search(r"【目标章节】\n(#+ [^\n]+)", prompt)
+            heading = match.group(1) if match else "### 练习"
+            return f"{heading}\n修改后的内容。"
+        return self.document
+
+    def generate_image(self, prompt: str, output_path: str) -> None:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        with open(output_path, "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n" + b"\0" * 4096)
+
+    def install(self):
+        fake = self
+        self._originals = {
+            "complete": LLMClient.complete,
+            "generate_image": LLMClient.generate_image,
+        }
+        LLMClient.complete = lambda _self, prompt, *a, cached_prefix=None, on_chunk=None, **kw: fake.complete(
+            (cached_prefix or "") + prompt, on_chunk
+        )
+        LLMClient.generate_image = lambda _self, prompt, output_path, *a, **kw: fake.generate_image(prompt, output_path)
+        return self
+
+    def uninstall(self):
+        for name, func in self._originals.items():
+            setattr(LLMClient, name, func)
+        self._originals = {}
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.uninstall()
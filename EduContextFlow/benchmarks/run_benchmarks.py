@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+dispatch → execute 管线的离线基准测试（使用假 LLM，不发起网络请求）。
+
+覆盖：dispatch()、_prepare_skill_input、execute_skill、_clean_llm_output、
+GlobalStateBus 持久化（随 context_index 规模增长）、完整的七步工作流，
+以及各入口模块的导入耗时（冷启动，在子进程中测量）。
+
+用法（在 EduContextFlow 目录下）：
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --baseline bench.json --threshold 0.25
+
+结果为 JSON；指定 --baseline 时，p50 比基线慢超过 threshold 的用例记为回归，
+进程以非零状态退出，便于在发布前拦截性能回退。
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import tracing
+from bus import GlobalStateBus
+from dispatcher import dispatch
+from executor import _clean_llm_output, execute_skill
+from fake_llm import FakeLLM, fake_document
+from runner import _prepare_skill_input, run_workflow
+from skills import SKILLS, skill_by_name
+
+DISPATCHER_PROMPT = os.path.join(ROOT, "DispatcherPrompt.md")
+CONTEXT_SIZES = (10, 100, 1000)
+IMPORT_MODULES = ("llm", "skills", "dispatcher", "runner", "app")
+
+
+def _measure(func, iterations: int) -> dict:
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    total = sum(samples)
+    return {
+        "iterations": iterations,
+        "mean_ms": round(total / iterations * 1000, 4),
+        "p50_ms": round(statistics.median(samples) * 1000, 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 4),
+        "ops_per_sec": round(iterations / total, 2) if total else None,
+    }
+
+
+def _fill_context_index(bus: GlobalStateBus, size: int):
+    """用 size 个假条目填充 context_index（只有索引，不写文件）"""
+    now = datetime.now().isoformat()
+    for i in range(size):
+        bus._state["context_index"][f"artifact_{i}"] = {
+            "ref": f"outputs/artifact_{i}.md",
+            "producer": "course_script_writing",
+            "status": "ready",
+            "description": f"测试产物 {i}",
+            "created_at": now,
+            "updated_at": now,
+        }
+    bus._persist()
+
+
+def _write(path: str, content: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def bench_clean_output(results: dict, iterations: int):
+    for sections in (6, 60):
+        document = fake_document(sections)
+        raw = "好的，以下是根据您的要求生成的内容：\n\n" + document
+        results[f"clean_output/sections={sections}"] = _measure(
+            lambda: _clean_llm_output(raw, "=== design_plan ===\n课程设计"), iterations
+        )
+
+
+def bench_prepare_input(results: dict, iterations: int):
+    skill = skill_by_name("course_script_writing")
+    for sections in (6, 60):
+        _write("outputs/design_plan.md", fake_document(sections))
+        context_index = {"design_plan": {"ref": "outputs/design_plan.md", "status": "ready"}}
+        results[f"prepare_input/sections={sections}"] = _measure(
+            lambda: _prepare_skill_input(skill, "请编写课程脚本", context_index), iterations
+        )
+
+
+def bench_dispatch(results: dict, iterations: int):
+    for size in (0,) + CONTEXT_SIZES:
+        bus = GlobalStateBus(f"dispatch_{size}.json")
+        _fill_context_index(bus, size)
+        state = bus.get_state()
+        results[f"dispatch/context={size}"] = _measure(
+            lambda: dispatch(
+                user_message="帮我确认课程目标：光合作用，初二学生",
+                bus_state=state,
+                skills=SKILLS,
+                dispatcher_prompt_path=DISPATCHER_PROMPT,
+                outputs_dir="outputs",
+            ),
+            iterations,
+        )
+
+
+def bench_execute_skill(results: dict, iterations: int):
+    skill = skill_by_name("course_script_writing")
+    results["execute_skill/course_script_writing"] = _measure(
+        lambda: execute_skill(skill, "=== design_plan ===\n课程设计\n\n=== 用户要求 ===\n编写脚本"),
+        iterations,
+    )
+
+
+def bench_bus_persist(results: dict, iterations: int):
+    for size in CONTEXT_SIZES:
+        bus = GlobalStateBus(f"persist_{size}.json")
+        _fill_context_index(bus, size)
+        results[f"bus_persist/context={size}"] = _measure(
+            lambda: bus.update_context_status("artifact_0", "ready"), iterations
+        )
+
+
+def bench_workflow(results: dict, iterations: int):
+    workflow = skill_by_name("course_production_workflow")
+
+    def run_once():
+        if os.path.exists("workflow_state.json"):
+            os.remove("workflow_state.json")
+        bus = GlobalStateBus("workflow_state.json")
+        run_workflow(bus, workflow, "光合作用，初二学生，40 分钟", "outputs")
+
+    results["workflow/course_production_workflow"] = _measure(run_once, iterations)
+
+
+def _import_env() -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    return env
+
+
+def _slowest_imports(module: str, top: int = 5) -> list[dict]:
+    """用 -X importtime 找出自身耗时最多的导入"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=_import_env(),
+    )
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        entries.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+    entries.sort(key=lambda e: e["self_ms"], reverse=True)
+    return entries[:top]
+
+
+def bench_import(results: dict, iterations: int):
+    # 每次在新的解释器中导入，测量的是冷启动耗时（含解释器启动）
+    env = _import_env()
+    for module in IMPORT_MODULES:
+        command = [sys.executable, "-c", f"import {module}"]
+        if subprocess.run(command, capture_output=True, env=env).returncode != 0:
+            results[f"import/{module}"] = {"error": "import failed"}
+            continue
+        result = _measure(lambda: subprocess.run(command, capture_output=True, env=env, check=True), iterations)
+        result["slowest_imports"] = _slowest_imports(module)
+        results[f"import/{module}"] = result
+
+
+BENCHMARKS = {
+    "clean_output": bench_clean_output,
+    "prepare_input": bench_prepare_input,
+    "dispatch": bench_dispatch,
+    "execute_skill": bench_execute_skill,
+    "bus_persist": bench_bus_persist,
+    "workflow": bench_workflow,
+    "import": bench_import,
+}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous or not previous.get("p50_ms") or "p50_ms" not in current:
+            continue
+        ratio = current["p50_ms"] / previous["p50_ms"]
+        current["baseline_p50_ms"] = previous["p50_ms"]
+        current["ratio"] = round(ratio, 3)
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: p50 {previous['p50_ms']}ms -> {current['p50_ms']}ms ({ratio:.2f}x)")
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the dispatch→execute pipeline")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--only", help="Comma-separated benchmark groups: " + ",".join(BENCHMARKS))
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated LLM latency per call (seconds)")
+    parser.add_argument("--output", help="Write JSON results to this path")
+    parser.add_argument("--baseline", help="Baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Allowed p50 slowdown ratio")
+    args = parser.parse_args()
+
+    groups = [g.strip() for g in args.only.split(",")] if args.only else list(BENCHMARKS)
+    output_path = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    results: dict = {}
+    workdir = tempfile.mkdtemp(prefix="educf-bench-")
+    cwd = os.getcwd()
+    fake = FakeLLM(latency=args.latency).install()
+    try:
+        os.chdir(workdir)
+        os.makedirs("outputs", exist_ok=True)
+        for group in groups:
+            # workflow 每次迭代都是七次 LLM 调用、import 每次迭代启动一个解释器，迭代次数相应减少
+            iterations = max(1, args.iterations // 10) if group in ("workflow", "import") else args.iterations
+            BENCHMARKS[group](results, iterations)
+    finally:
+        fake.uninstall()
+        tracing.flush()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "llm_latency": args.latency,
+            "llm_calls": fake.calls,
+        },
+        "results": results,
+    }
+
+    regressions = []
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        report["regressions"] = regressions
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output_path:
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+"""
+离线行为检查（使用假 LLM，不发起网络请求）。
+
+覆盖容易用少量断言固定住的纯逻辑与状态流转，补充只测耗时的 run_benchmarks.py。
+
+用法（在 EduContextFlow 目录下）：
+    python benchmarks/run_checks.py
+    python benchmarks/run_checks.py --only workflow_resume
+
+任一检查失败时进程以非零状态退出。
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import json
+
+import dispatcher
+import image_variants
+import llm
+import tracing
+from bus import GlobalStateBus
+from executor import OutputSanitizer, _clean_llm_output, execute_skill, render_prompt, split_prompt
+from fake_llm import FakeLLM, fake_document
+from intent_index import NUMPY_AVAILABLE, IntentIndex
+from llm import ContextCache, JsonObjectStream
+from runner import (
+    _prepare_skill_input,
+    rebuild_stale,
+    record_skill_output,
+    recover_interrupted,
+    resume_workflow,
+    run_workflow,
+)
+from sections import find_target_sections, split_sections
+from skills import PROMPTS, SKILLS, PromptTemplate, SkillInput, skill_by_name
+from speculation import SPECULATIVE_DIR, Speculator, is_confirm_message
+
+
+def check_workflow_resume():
+    """失败的步骤不进入检查点，续跑时从该步骤重新执行，之前的步骤直接复用"""
+    workflow = skill_by_name("course_production_workflow")
+    bus = GlobalStateBus("resume_state.json")
+    with FakeLLM(fail_on="# Skill: course_script_writing"):
+        try:
+            run_workflow(bus, workflow, "光合作用，初二学生，40 分钟", "outputs")
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("workflow should fail at course_script_writing")
+    run = bus.get_workflow_run()
+    assert run["status"] == "failed", run["status"]
+    assert "course_script_writing" not in run["completed_steps"], run["completed_steps"]
+    assert bus.get_state()["skills"]["course_script_writing"]["status"] == "error"
+    assert not os.path.exists(os.path.join("outputs", "course_script.md"))
+
+    assert recover_interrupted(bus)["run_id"] == run["run_id"]
+    with FakeLLM():
+        steps = resume_workflow(bus)
+    statuses = {step["step"]: step["status"] for step in steps}
+    assert statuses["course_plan_review"] == "reused", statuses
+    assert statuses["course_script_writing"] == "executed", statuses
+    assert bus.get_workflow_run()["status"] == "done"
+
+
+def check_recover_live_owner():
+    """启动恢复只处理所属进程已退出的 running 条目，且没有变化时不写盘"""
+    bus = GlobalStateBus("recover_state.json")
+    bus.start_workflow_run("course_production_workflow", "课程", "outputs")
+    bus.set_workflow_step("course_goal_definition")
+    bus.mark_skill_running("course_goal_definition")
+    version = bus.state_etag()
+    assert recover_interrupted(bus) is None
+    assert bus.state_etag() == version
+    assert bus.get_workflow_run()["status"] == "running"
+
+    # 模拟所属进程已退出（旧版本状态文件中没有 owner）
+    bus._state["workflow_run"].pop("owner")
+    bus._state["skills"]["course_goal_definition"].pop("owner")
+    assert recover_interrupted(bus)["status"] == "interrupted"
+    assert bus.get_state()["skills"]["course_goal_definition"]["status"] == "interrupted"
+
+
+def check_rebuild_keeps_ref():
+    """重建 stale 产出时写回条目引用的文件（此处为会话目录），而不是 Skill 的默认路径"""
+    workflow = skill_by_name("course_production_workflow")
+    bus = GlobalStateBus("rebuild_state.json")
+    with FakeLLM():
+        run_workflow(bus, workflow, "光合作用，初二学生，40 分钟", os.path.join("session", "outputs"))
+        design_ref = bus.get_state()["context_index"]["design_plan"]["ref"]
+        with open(design_ref, "a", encoding="utf-8") as f:
+            f.write("\n## 补充\n新增内容。\n")
+        refs = {t: e["ref"] for t, e in bus.get_state()["context_index"].items()}
+        results = rebuild_stale(bus)
+    assert any(r["status"] == "rebuilt" for r in results), results
+    for result in results:
+        if result["status"] == "rebuilt":
+            assert result["ref"] == refs[result["context_type"]], result
+    assert not os.path.exists(os.path.join("outputs", "course_script.md"))
+
+
+def check_patch_targets():
+    """只有显式引用章节（序号或引号中的标题）并带修改动词时才进入局部修改"""
+    document = "# 课程目标\n\n## 教学目标\n理解原理。\n\n" + fake_document(3)
+    sections = split_sections(document)
+
+    def titles(request: str) -> list[str]:
+        return [s.title for s in find_target_sections(sections, request)]
+
+    # 新的需求说明中出现泛用词（目标 / 练习），不是局部修改
+    assert titles("课程目标：光合作用，目标是让学生会做练习") == []
+    assert titles("重新确定课程目标，面向初二学生，增加实验练习") == []
+    # 有章节引用但没有修改动词
+    assert titles("第二章写得不错") == []
+    # 序号 + 修改动词，章节内按关键词收窄到子节
+    assert titles("把第二章的练习改得简单一点") == ["练习"]
+    assert titles("第二章重写一下") == ["第2章 模块2"]
+    # 引号中的标题
+    assert titles("把“教学目标”改得更具体") == ["教学目标"]
+
+
+def check_sanitizer_parity():
+    """流式清理的增量拼接后与 finish()（即 _clean_llm_output）一致，且不输出开头的复述标记"""
+    body = fake_document(3)
+    raws = [
+        body,
+        "好的，以下是课程脚本内容：\n\n" + body,
+        "好的，以下是根据您的要求生成的内容：\n\n## 输出要求\n\n" + body,
+        "## Prompt 模板\n===教学内容===\n\n  " + body.replace("\n\n", "\n   \n") + "  \n\n",
+        "根据您的要求，本课程面向初二学生，共 40 分钟。\n" + body,
+    ]
+    for raw in raws:
+        expected = _clean_llm_output(raw, "光合作用")
+        for chunk_size in (1, 7, 16, 256):
+            sanitizer = OutputSanitizer("光合作用")
+            deltas = [sanitizer.feed(raw[i:i + chunk_size]) for i in range(0, len(raw), chunk_size)]
+            streamed = "".join(deltas)
+            assert streamed, "content should be streamed before finish()"
+            assert "好的，以下是" not in streamed and "Prompt" not in streamed, streamed[:40]
+            assert sanitizer.finish() == expected
+            assert streamed + sanitizer.flush() == expected, (raw[:30], chunk_size)
+    assert not _clean_llm_output(raws[1], "").startswith("好的")
+
+    # 复述了用户输入：只能在结束时判断，flush() 返回 None，由消费方整体替换
+    user_input = "=== design_plan ===\n" + body[:300]
+    sanitizer = OutputSanitizer(user_input)
+    sanitizer.feed(f"{user_input}\n\n现在请直接输出\n\n{body}")
+    assert sanitizer.flush() is None
+    assert sanitizer.finish() == body.strip()
+
+
+def check_speculation():
+    """推测结果只用于纯确认/继续的请求；丢弃的临时文件被删除；浪费预算按时间窗口计数、命中后重置"""
+    goal = skill_by_name("course_goal_definition")
+    design = skill_by_name("course_design_plan")
+    assert is_confirm_message(design, "好的，继续")
+    assert is_confirm_message(design, "生成设计方案")
+    assert not is_confirm_message(design, "改成5分钟")
+    assert not is_confirm_message(design, "面向小学生")
+
+    bus = GlobalStateBus("speculation_state.json")
+    speculator = Speculator("outputs", enabled=True, budget=1, window=3600)
+    speculative_dir = os.path.join("outputs", SPECULATIVE_DIR)
+    with FakeLLM():
+        path = execute_skill(goal, _prepare_skill_input(goal, "光合作用", {}), os.path.join("outputs", "course_goal.md"))
+        record_skill_output(bus, goal, path, {})
+        context_index = bus.get_state()["context_index"]
+
+        # 带具体要求的请求：丢弃推测结果并删除临时文件
+        assert speculator.schedule(bus.get_state(), goal.name) == [design.name]
+        speculator._pending[design.name]["future"].result()
+        assert speculator.take(design, "面向小学生", context_index) is None
+        assert os.listdir(speculative_dir) == []
+
+        # 窗口内浪费次数已达预算：暂停推测；窗口过去后恢复
+        assert speculator.schedule(bus.get_state(), goal.name) == []
+        speculator._recent_waste[0] -= 7200
+        assert speculator.schedule(bus.get_state(), goal.name) == [design.name]
+        assert speculator.take(design, "好的，继续", context_index) == os.path.join("outputs", "design_plan.md")
+        assert speculator.hits == 1 and not speculator._recent_waste
+
+        # 之前进程遗留的过期临时文件在下次调度时清理
+        stale = os.path.join(speculative_dir, "design_plan.deadbeef.md")
+        with open(stale, "w", encoding="utf-8") as f:
+            f.write("stale")
+        os.utime(stale, (0, 0))
+        speculator.schedule(bus.get_state(), goal.name)
+        assert not os.path.exists(stale)
+        # 等待仍在进行的预生成，避免在临时目录清理后（或假 LLM 卸载后）才写文件
+        for entry in list(speculator._pending.values()):
+            entry["future"].result()
+
+
+def check_image_negotiation():
+    """Accept 按 q 值协商：q=0 表示拒绝该格式，q 值高者优先，子串不算匹配"""
+    assert image_variants.parse_accept("image/webp;q=0, image/avif; q=0.5 ,*/*;q=0.8") == {
+        "image/webp": 0.0, "image/avif": 0.5, "*/*": 0.8,
+    }
+    path = os.path.join("outputs", "shot.png")
+    for target in (path, image_variants.variant_path(path, ".avif"), image_variants.variant_path(path, ".webp")):
+        with open(target, "wb") as f:
+            f.write(b"image")
+    pillow = image_variants.PILLOW_AVAILABLE
+    image_variants.PILLOW_AVAILABLE = True
+    try:
+        def served(accept: str) -> str:
+            return os.path.basename(image_variants.negotiate(path, accept)[0])
+
+        assert served("image/avif,image/webp,*/*") == "shot.avif"
+        assert served("image/avif;q=0.5,image/webp") == "shot.webp"
+        assert served("image/avif;q=0,image/webp;q=0,*/*") == "shot.png"
+        assert served("image/webp;q=0") == "shot.png"
+        assert served("image/webpx,image/*") == "shot.png"
+    finally:
+        image_variants.PILLOW_AVAILABLE = pillow
+
+
+def check_json_stream():
+    """JsonObjectStream 在任意分块边界下与 json.loads 结果一致，字段在值结束时立即给出"""
+    obj = {
+        "action": "call_skill",
+        "skill_name": "course_script_writing",
+        "reason": "含转义：\"引号\"、反斜杠 \\、逗号, 和括号 } ]",
+        "options": [{"label": "a,b", "value": [1, {"x": "}"}]}, []],
+        "meta": {"nested": {"deep": [True, None, 1.5e3]}},
+        "count": -12,
+    }
+    raw = "```json\n" + json.dumps(obj, ensure_ascii=False, indent=1) + "\n```"
+    for chunk_size in (1, 2, 3, 7, len(raw)):
+        stream = JsonObjectStream()
+        seen = []
+        for start in range(0, len(raw), chunk_size):
+            seen.extend(stream.feed(raw[start:start + chunk_size]))
+        assert stream.done, chunk_size
+        assert stream.fields == obj, (chunk_size, stream.fields)
+        assert seen == list(obj), seen
+
+    # 字段在其值结束（遇到同层逗号）时即可取得，不必等对象结束
+    stream = JsonObjectStream()
+    assert stream.feed('{"action": "ask_') == {}
+    assert stream.feed('user", "options": [') == {"action": "ask_user"}
+    assert not stream.done and "options" not in stream.fields
+
+    # 对象结束后的字符被忽略
+    stream = JsonObjectStream()
+    stream.feed('{"a": 1} {"b": 2}')
+    assert stream.fields == {"a": 1}
+
+
+def check_prompt_template():
+    """预编译模板：只替换标识符槽位，未提供的槽位与其他花括号按原文保留，填入的值不再被解析"""
+    template = PromptTemplate.compile('{a}示例 {"k": 1} {not a slot} {b}{a}结尾')
+    assert template.slots == ("a", "b", "a")
+    assert len(template.literals) == len(template.slots) + 1
+    assert template.render({"a": "X", "b": "{a}"}) == 'X示例 {"k": 1} {not a slot} {a}X结尾'
+    assert template.render({"a": "X"}) == 'X示例 {"k": 1} {not a slot} {b}X结尾'
+    assert PromptTemplate.compile("没有槽位").render({"a": "X"}) == "没有槽位"
+
+    for skill in SKILLS:
+        raw = PROMPTS.get(skill.prompt_file)
+        assert skill.prompt.render({}) == raw, skill.name
+        if skill.skill_type == "skill":
+            assert "user_input" in skill.prompt.slots, skill.name
+
+
+def check_split_prompt():
+    """split_prompt 的前缀只取决于 Skill 与上游上下文：用户要求变化时前缀不变，上下文变化时前缀随之变化"""
+    skill = skill_by_name("course_design_plan")
+    contexts = {"course_goal": "# 课程目标\n理解光合作用。", "reference_material": "已有讲义。"}
+    prefix, rest, user_input = split_prompt(skill, SkillInput("面向初二学生", contexts))
+    assert prefix and "面向初二学生" not in prefix
+    assert prefix + rest == render_prompt(skill, SkillInput("面向初二学生", contexts))[0]
+    assert "面向初二学生" in user_input
+
+    for message in ("改成 5 分钟", "", "{user_input} 与 {course_goal}"):
+        other_prefix, other_rest, _ = split_prompt(skill, SkillInput(message, contexts))
+        assert other_prefix == prefix, message
+        assert other_prefix + other_rest == render_prompt(skill, SkillInput(message, contexts))[0]
+
+    changed = dict(contexts, course_goal="# 课程目标\n理解呼吸作用。")
+    assert split_prompt(skill, SkillInput("面向初二学生", changed))[0] != prefix
+    # 纯文本输入（无上下文）同样可以切分
+    plain_prefix, plain_rest, _ = split_prompt(skill_by_name("course_goal_definition"), "光合作用")
+    assert plain_prefix + plain_rest == render_prompt(skill_by_name("course_goal_definition"), "光合作用")[0]
+
+
+def check_dispatch_candidates():
+    """预筛保留按总线状态可执行的下一步；消息本身无法判断时列出全部 Skill；schema 不受预筛限制"""
+    all_names = [s.name for s in SKILLS]
+
+    def candidates(message: str, *ready_types: str) -> list[str]:
+        state = {"context_index": {t: {"status": "ready"} for t in ready_types}}
+        return [s.name for s in dispatcher.rank_skills(message, SKILLS, top_k=2, bus_state=state)]
+
+    for message in ("继续", "下一步吧", "好的"):
+        assert candidates(message, "course_goal", "design_plan", "design_review") == all_names, message
+
+    # 消息足够明确时只列出前 top_k 个，再补上状态上的下一步（产出已 ready 的不算）
+    found = candidates("评审方案", "course_goal", "design_plan", "design_review", "course_script", "script_review")
+    assert found[0] == "course_plan_review", found
+    assert "storyboard_writing" in found and len(found) < len(all_names), found
+    assert "course_script_writing" not in found, found
+
+    enum = dispatcher.decision_schema(SKILLS)["properties"]["skill_name"]["enum"]
+    assert enum == all_names
+
+
+def check_context_cache():
+    """Skill 前缀第二次出现才登记缓存，eager 前缀首次即登记；过期登记与其锁在 lookup 时清理"""
+    created = []
+    original = llm._create_cache
+    llm._create_cache = lambda client, model, prefix: created.append(prefix) or f"cachedContents/{len(created)}"
+    try:
+        cache = ContextCache()
+        skill_key = ContextCache.key("key", "model", "skill prefix")
+        assert cache.lookup(None, skill_key, "skill prefix") == (None, "first_use")
+        assert cache.lookup(None, skill_key, "skill prefix") == ("cachedContents/1", "created")
+        assert cache.lookup(None, skill_key, "skill prefix") == ("cachedContents/1", "hit")
+        dispatch_key = ContextCache.key("key", "model", "dispatcher rules")
+        assert cache.lookup(None, dispatch_key, "dispatcher rules", eager=True) == ("cachedContents/2", "created")
+
+        for entry in cache._entries.values():
+            entry["expires_at"] = 0
+        cache.lookup(None, ContextCache.key("key", "model", "other"), "other")
+        assert len(cache._entries) == 1 and len(cache._key_locks) == 1
+        assert created == ["skill prefix", "dispatcher rules"]
+    finally:
+        llm._create_cache = original
+
+
+def check_intent_index_paths():
+    """numpy 稠密矩阵与纯 Python 稀疏点积在内置 Skill 目录上给出相同的得分与排序"""
+    if not NUMPY_AVAILABLE:
+        raise AssertionError("numpy is required (see requirements.txt)")
+    dense = IntentIndex(SKILLS, dense=True)
+    sparse = IntentIndex(SKILLS, dense=False)
+    assert dense._matrix is not None and sparse._matrix is None
+    messages = ["继续", "下一步吧", "", "!!!", "Storyboard please", "光合作用，初二学生，40 分钟"]
+    for skill in SKILLS:
+        messages += [skill.intent_description, *skill.trigger_keywords, *skill.example_utterances]
+    for message in messages:
+        dense_scores, sparse_scores = dense.scores(message), sparse.scores(message)
+        assert all(abs(a - b) < 1e-9 for a, b in zip(dense_scores, sparse_scores)), message
+        assert [s.name for s, _ in dense.rank(message)] == [s.name for s, _ in sparse.rank(message)], message
+
+
+CHECKS = {
+    "workflow_resume": check_workflow_resume,
+    "recover_live_owner": check_recover_live_owner,
+    "rebuild_keeps_ref": check_rebuild_keeps_ref,
+    "patch_targets": check_patch_targets,
+    "sanitizer_parity": check_sanitizer_parity,
+    "speculation": check_speculation,
+    "image_negotiation": check_image_negotiation,
+    "json_stream": check_json_stream,
+    "prompt_template": check_prompt_template,
+    "split_prompt": check_split_prompt,
+    "dispatch_candidates": check_dispatch_candidates,
+    "context_cache": check_context_cache,
+    "intent_index_paths": check_intent_index_paths,
+}
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Offline behaviour checks")
+    parser.add_argument("--only", help="Comma-separated checks: " + ",".join(CHECKS))
+    args = parser.parse_args()
+    names = [n.strip() for n in args.only.split(",")] if args.only else list(CHECKS)
+
+    failed = []
+    cwd = os.getcwd()
+    for name in names:
+        # 每个检查在独立的临时目录中运行
+        workdir = tempfile.mkdtemp(prefix="educf-check-")
+        try:
+            os.chdir(workdir)
+            os.makedirs("outputs", exist_ok=True)
+            CHECKS[name]()
+            print(f"PASS {name}")
+        except Exception:
+            failed.append(name)
+            print(f"FAIL {name}")
+            traceback.print_exc()
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+    tracing.flush()
+
+    print(f"\n{len(names) - len(failed)} passed, {len(failed)} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
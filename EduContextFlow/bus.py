@@ -1,8 +1,17 @@
+import functools
 import json
 import os
+import socket
+import threading
+import time
 import uuid
 from datetime import datetime
 
+import events
+import metrics
+import tracing
+import usage
+
 
 DEFAULT_SKILLS = {
     "course_goal_definition": {"status": "empty"},
@@ -34,71 +43,245 @@ def _default_state():
         "context_index": {},  # 语义上下文索引：key=类型, value={ref, producer, status}
         "last_output_ref": None,
         "pending_user_input": None,  # 当前轮次待消耗的用户输入（语义锁）
+        "workflow_run": None,  # 当前工作流运行的检查点（用于崩溃后续跑）
+        "skill_transitions": {},  # 观察到的 Skill 转移次数：{上一个 Skill: {下一个 Skill: 次数}}
+        "usage": _empty_usage_state(),  # LLM 用量与成本：会话合计 / 按 Skill / 按工作流运行
     }
 
 
+def _empty_usage_state() -> dict:
+    return {"session": usage.empty_usage(), "skills": {}, "workflow_runs": {}}
+
+
+# 当前进程的标识：running 的 Skill 与工作流运行记录其所属进程（owner）与心跳时间，
+# 同一个 state.json 可能被多个进程使用（多个 worker、reloader 子进程、CLI），
+# 启动恢复时只处理所属进程已经退出的条目
+_PROCESS_TOKEN = uuid.uuid4().hex
+_HOSTNAME = socket.gethostname()
+ORPHAN_TIMEOUT_SECONDS = float(os.getenv("ORPHAN_TIMEOUT_SECONDS", "1800"))  # 无法探测进程时按心跳判断
+
+
+def process_owner() -> dict:
+    return {"pid": os.getpid(), "host": _HOSTNAME, "token": _PROCESS_TOKEN}
+
+
+def owner_alive(owner: dict | None, heartbeat_at: float | None) -> bool:
+    """
+    所属进程是否仍在运行。
+
+    同一主机上按 pid 探测；同 pid 但标识不同说明是本进程的前一个实例（如容器重启后 pid 复用）。
+    其他主机上的进程（或 Windows 上，os.kill 会结束目标进程）按心跳是否超过 ORPHAN_TIMEOUT_SECONDS 判断。
+    没有 owner 的条目来自旧版本的状态文件，视为已退出。
+    """
+    if not owner:
+        return False
+    if owner.get("host") != _HOSTNAME or os.name == "nt":
+        return heartbeat_at is not None and time.time() - heartbeat_at < ORPHAN_TIMEOUT_SECONDS
+    if owner.get("pid") == os.getpid():
+        return owner.get("token") == _PROCESS_TOKEN
+    try:
+        os.kill(owner["pid"], 0)
+    except PermissionError:
+        return True
+    except (OSError, KeyError, TypeError):
+        return False
+    return True
+
+
+def _claim(entry: dict):
+    """记录条目由当前进程持有，并刷新心跳"""
+    entry["owner"] = process_owner()
+    entry["heartbeat_at"] = time.time()
+
+
+def _release(entry: dict):
+    entry.pop("owner", None)
+    entry.pop("heartbeat_at", None)
+
+
+# 同一进程内、同一路径的 GlobalStateBus 实例共享内存中的状态与锁，
+# 后台线程（渲染回调、上传解析等）与请求线程的写入不会互相覆盖
+_SHARED: dict[str, dict] = {}  # 绝对路径 -> {"state", "lock", "mtime"}
+_SHARED_LOCK = threading.Lock()
+
+
+def _mtime_ns(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class GlobalStateBus:
     def __init__(self, path: str):
         self.path = path
         self._state = None
+        key = os.path.abspath(path)
+        with _SHARED_LOCK:
+            self._shared = _SHARED.setdefault(key, {"state": None, "lock": threading.RLock(), "mtime": None})
+        self._lock = self._shared["lock"]
         self._load_or_init()
 
+    @_synchronized
     def _load_or_init(self):
-        if os.path.exists(self.path):
+        mtime = _mtime_ns(self.path)
+        if self._shared["state"] is not None and mtime is not None and mtime == self._shared["mtime"]:
+            # 复用本进程内已加载的状态
+            self._state = self._shared["state"]
+        elif mtime is not None:
+            # 首次加载，或文件被其他进程修改过
             with open(self.path, "r", encoding="utf-8") as f:
                 self._state = json.load(f)
+            self._shared["state"] = self._state
+            self._shared["mtime"] = mtime
+            self._publish_changes()
         else:
             self._state = _default_state()
+            self._shared["state"] = self._state
             self._persist()
         self._ensure_skills()
 
+    @_synchronized
     def _ensure_skills(self):
+        changed = False
         if "skills" not in self._state or not isinstance(self._state["skills"], dict):
-            self._state["skills"] = json.loads(json.dumps(DEFAULT_SKILLS))
+            self._state["skills"] = {}
+            changed = True
         for name, value in DEFAULT_SKILLS.items():
             if name not in self._state["skills"]:
-                self._state["skills"][name] = value
-        self._persist()
+                self._state["skills"][name] = dict(value)
+                changed = True
+        # 只在补全了缺失项时写盘，只读场景（如 /api/state）不产生写入
+        if changed:
+            self._persist()
 
+    @_synchronized
     def _persist(self):
-        with open(self.path, "w", encoding="utf-8") as f:
-            json.dump(self._state, f, indent=2, ensure_ascii=True)
+        started = time.perf_counter()
+        # 每次写入递增状态版本号，用于 /api/state 的条件请求
+        self._state["state_version"] = self._state.get("state_version", 0) + 1
+        with tracing.span("bus.persist") as s:
+            data = json.dumps(self._state, indent=2, ensure_ascii=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                f.write(data)
+            self._shared["mtime"] = _mtime_ns(self.path)
+            s["bytes"] = len(data)
+        metrics.BUS_PERSISTS.inc()
+        metrics.BUS_PERSIST_SECONDS.observe(time.perf_counter() - started)
+        self._publish_changes()
+
+    def _publish_changes(self):
+        # 与上次写入时的摘要比较，只推送变化的部分（/api/events）
+        # 首次加载只记录基线；重新加载其他进程写入的文件时同样推送差异
+        summary = events.summarize_state(self._state)
+        previous = self._shared.get("summary")
+        self._shared["summary"] = summary
+        if previous is None:
+            return
+        changes = events.diff_states(previous, summary)
+        if changes:
+            events.BROKER.publish("state", {"state_version": self.state_etag(), "changes": changes})
 
+    @_synchronized
     def get_state(self):
         return json.loads(json.dumps(self._state))
 
+    @_synchronized
+    def state_etag(self) -> str:
+        """当前状态的版本标识（session_id + 版本号），无需复制整个状态"""
+        return f"{self._state.get('session_id')}-{self._state.get('state_version', 0)}"
+
+    @_synchronized
+    def find_context_by_ref(self, ref: str) -> dict | None:
+        """按文件路径查找 context_index 条目（返回副本）"""
+        target = os.path.normpath(ref)
+        for entry in self._state.get("context_index", {}).values():
+            if entry.get("ref") and os.path.normpath(entry["ref"]) == target:
+                return dict(entry)
+        return None
+
+    @_synchronized
     def set_stage(self, stage: str):
         self._state["stage"] = stage
         self._persist()
 
+    @_synchronized
     def set_selected_skill(self, skill_name: str | None):
         self._state["selected_skill"] = skill_name
         self._persist()
 
+    @_synchronized
+    def record_transition(self, from_skill: str | None, to_skill: str):
+        """记录用户在 from_skill 完成后请求了 to_skill（用于推测式预生成排序）"""
+        if not from_skill or from_skill == to_skill:
+            return
+        transitions = self._state.setdefault("skill_transitions", {})
+        counts = transitions.setdefault(from_skill, {})
+        counts[to_skill] = counts.get(to_skill, 0) + 1
+        self._persist()
+
+    @_synchronized
+    def record_usage(self, call_usage: dict, skill: str | None = None, run_id: str | None = None):
+        """累计一次 LLM 调用的用量（见 usage.record）"""
+        totals = self._state.setdefault("usage", _empty_usage_state())
+        usage.add_usage(totals["session"], call_usage)
+        if skill:
+            usage.add_usage(totals["skills"].setdefault(skill, usage.empty_usage()), call_usage)
+        if run_id:
+            usage.add_usage(totals["workflow_runs"].setdefault(run_id, usage.empty_usage()), call_usage)
+        self._persist()
+
+    @_synchronized
+    def get_usage(self) -> dict:
+        return json.loads(json.dumps(self._state.get("usage") or _empty_usage_state()))
+
     def _get_timestamp(self) -> str:
         """获取当前时间的 ISO 格式字符串"""
         return datetime.now().isoformat()
 
+    @_synchronized
     def set_skill_status(self, skill_name: str, status: str):
         """
         设置 Skill 的状态。
         
-        status 可选值: "empty" | "running" | "done" | "error" | "skipped"
+        status 可选值: "empty" | "running" | "done" | "error" | "skipped" | "interrupted"
         """
         if skill_name in self._state["skills"]:
-            self._state["skills"][skill_name]["status"] = status
+            info = self._state["skills"][skill_name]
+            info["status"] = status
+            if status == "running":
+                _claim(info)
+            else:
+                _release(info)
             self._persist()
 
+    @_synchronized
     def mark_skill_done(
         self,
         skill_name: str,
         output_ref: str,
         output_type: str,
         description: str,
+        content_hash: str | None = None,
+        input_hashes: dict[str, str] | None = None,
     ):
-        """标记 Skill 完成，并更新 context_index"""
+        """
+        标记 Skill 完成，并更新 context_index。
+
+        content_hash / input_hashes 为产出文件与所用上游文件的内容哈希，
+        用于依赖失效判断和增量重建（只存哈希，不存内容）。
+        """
         if skill_name in self._state["skills"]:
             self._state["skills"][skill_name]["status"] = "done"
+            _release(self._state["skills"][skill_name])
 
         # 写入语义上下文索引（字典结构）
         now = self._get_timestamp()
@@ -110,11 +293,16 @@ class GlobalStateBus:
             "created_at": now,
             "updated_at": now,
         }
+        if content_hash is not None:
+            context_entry["content_hash"] = content_hash
+        if input_hashes is not None:
+            context_entry["input_hashes"] = input_hashes
         
-        # 如果已存在，保留 created_at，只更新 updated_at
+        # 如果已存在，保留 created_at，只更新 updated_at；版本号递增
         existing = self._state.setdefault("context_index", {}).get(output_type)
         if existing and "created_at" in existing:
             context_entry["created_at"] = existing["created_at"]
+        context_entry["version"] = (existing or {}).get("version", 0) + 1
         
         self._state["context_index"][output_type] = context_entry
 
@@ -122,12 +310,14 @@ class GlobalStateBus:
         self._state["stage"] = "skill_done"
         self._persist()
 
+    @_synchronized
     def mark_skill_running(self, skill_name: str):
         """标记 Skill 正在运行"""
         self.set_skill_status(skill_name, "running")
         if self._state["selected_skill"] != skill_name:
             self.set_selected_skill(skill_name)
 
+    @_synchronized
     def mark_skill_error(self, skill_name: str, output_type: str | None = None):
         """标记 Skill 执行失败"""
         self.set_skill_status(skill_name, "error")
@@ -141,11 +331,13 @@ class GlobalStateBus:
         
         self._persist()
 
+    @_synchronized
     def mark_skill_skipped(self, skill_name: str):
         """标记 Skill 被跳过"""
         self.set_skill_status(skill_name, "skipped")
         self._persist()
 
+    @_synchronized
     def update_context_status(
         self, 
         context_type: str, 
@@ -155,7 +347,7 @@ class GlobalStateBus:
         """
         更新 context_index 中某个上下文的状态。
         
-        status 可选值: "pending" | "ready" | "failed"
+        status 可选值: "pending" | "ready" | "stale" | "failed"
         """
         if context_type not in self._state.setdefault("context_index", {}):
             # 如果不存在，创建一个基础条目
@@ -177,6 +369,176 @@ class GlobalStateBus:
         
         self._persist()
 
+    @_synchronized
+    def set_context_collection(
+        self,
+        context_type: str,
+        producer: str,
+        description: str,
+        ref: str,
+        items: list[dict],
+        status: str = "ready",
+        input_hashes: dict[str, str] | None = None,
+    ):
+        """
+        登记集合类上下文（如分镜插图）：ref 指向目录，items 按顺序列出每个成员
+        {index, ref, status, ...}。状态变为 ready 时版本号递增。
+        """
+        now = self._get_timestamp()
+        existing = self._state.setdefault("context_index", {}).get(context_type) or {}
+        version = existing.get("version", 0) + (1 if status == "ready" else 0)
+        entry = {
+            "ref": ref,
+            "producer": producer,
+            "status": status,
+            "description": description,
+            "created_at": existing.get("created_at", now),
+            "updated_at": now,
+            "version": version,
+            "items": items,
+        }
+        if input_hashes is not None:
+            entry["input_hashes"] = input_hashes
+        self._state["context_index"][context_type] = entry
+        self._persist()
+
+    @_synchronized
+    def mark_context_stale(self, context_types: list[str]) -> list[str]:
+        """
+        将已就绪的下游上下文标记为 stale（上游已变更，内容可能过期）。
+
+        返回实际被标记的类型列表。
+        """
+        context_index = self._state.setdefault("context_index", {})
+        now = self._get_timestamp()
+        marked = []
+        for context_type in context_types:
+            entry = context_index.get(context_type)
+            if entry and entry.get("status") == "ready":
+                entry["status"] = "stale"
+                entry["updated_at"] = now
+                marked.append(context_type)
+        if marked:
+            self._persist()
+        return marked
+
+    @_synchronized
+    def set_context_hash(self, context_type: str, content_hash: str):
+        """更新 context_index 中某个上下文的内容哈希（文件被直接编辑时使用）"""
+        entry = self._state.setdefault("context_index", {}).get(context_type)
+        if entry is None:
+            return
+        entry["content_hash"] = content_hash
+        entry["updated_at"] = self._get_timestamp()
+        self._persist()
+
+    @_synchronized
+    def start_workflow_run(
+        self,
+        workflow_name: str,
+        user_message: str,
+        outputs_dir: str | None = None,
+    ):
+        """
+        开始一次新的工作流运行，清空之前的检查点。
+
+        检查点只记录输入与已完成步骤，产出内容仍通过 context_index 引用。
+        """
+        now = self._get_timestamp()
+        self._state["workflow_run"] = {
+            "run_id": str(uuid.uuid4()),
+            "workflow": workflow_name,
+            "user_message": user_message,
+            "outputs_dir": outputs_dir,
+            "status": "running",
+            "current_step": None,
+            "completed_steps": [],
+            "started_at": now,
+            "updated_at": now,
+        }
+        _claim(self._state["workflow_run"])
+        self._persist()
+
+    @_synchronized
+    def get_workflow_run(self) -> dict | None:
+        run = self._state.get("workflow_run")
+        return json.loads(json.dumps(run)) if run else None
+
+    @_synchronized
+    def set_workflow_step(self, step: str | None):
+        """记录正在执行的步骤（续跑时由当前进程接管该运行）"""
+        run = self._state.get("workflow_run")
+        if run:
+            run["current_step"] = step
+            run["status"] = "running"
+            run["updated_at"] = self._get_timestamp()
+            _claim(run)
+            self._persist()
+
+    @_synchronized
+    def checkpoint_workflow_step(self, step: str):
+        """记录步骤已完成（产出已登记到 context_index 之后调用）"""
+        run = self._state.get("workflow_run")
+        if run:
+            if step not in run["completed_steps"]:
+                run["completed_steps"].append(step)
+            run["current_step"] = None
+            run["updated_at"] = self._get_timestamp()
+            run["heartbeat_at"] = time.time()
+            self._persist()
+
+    @_synchronized
+    def finish_workflow_run(self, status: str):
+        """
+        结束工作流运行。
+
+        status 可选值: "done" | "failed" | "interrupted"
+        """
+        run = self._state.get("workflow_run")
+        if run:
+            run["status"] = status
+            run["updated_at"] = self._get_timestamp()
+            _release(run)
+            self._persist()
+
+    @_synchronized
+    def workflow_run_active(self) -> bool:
+        """工作流运行是否仍由某个存活的进程执行（续跑前检查，避免同一运行被执行两次）"""
+        run = self._state.get("workflow_run")
+        return bool(
+            run and run.get("status") == "running"
+            and owner_alive(run.get("owner"), run.get("heartbeat_at"))
+        )
+
+    @_synchronized
+    def recover_orphaned_skills(self) -> list[str]:
+        """
+        进程启动时调用：所属进程已退出、但仍处于 running 的 Skill 不可能再完成，
+        标记为 interrupted；同样处理所属进程已退出的工作流运行。
+        其他存活进程中正在执行的 Skill 与工作流不受影响。
+
+        返回被恢复的 Skill 名称列表；没有需要恢复的条目时不写盘。
+        """
+        orphaned = [
+            name for name, info in self._state.get("skills", {}).items()
+            if info.get("status") == "running"
+            and not owner_alive(info.get("owner"), info.get("heartbeat_at"))
+        ]
+        for name in orphaned:
+            self._state["skills"][name]["status"] = "interrupted"
+            _release(self._state["skills"][name])
+        changed = bool(orphaned)
+        run = self._state.get("workflow_run")
+        if run and run.get("status") == "running" and not owner_alive(run.get("owner"), run.get("heartbeat_at")):
+            run["status"] = "interrupted"
+            run["updated_at"] = self._get_timestamp()
+            _release(run)
+            changed = True
+        if changed:
+            self._persist()
+        return orphaned
+
+    @_synchronized
     def set_pending_input(self, user_input: str | None):
         """
         设置当前轮次的待消耗用户输入。
@@ -189,10 +551,12 @@ class GlobalStateBus:
         self._state["pending_user_input"] = user_input
         self._persist()
 
+    @_synchronized
     def get_pending_input(self) -> str | None:
         """获取当前轮次的待消耗用户输入"""
         return self._state.get("pending_user_input")
     
+    @_synchronized
     def clear_pending_input(self):
         """
         清空待消耗的用户输入。
@@ -204,6 +568,7 @@ class GlobalStateBus:
         self._state["pending_user_input"] = None
         self._persist()
 
+    @_synchronized
     def set_error(self):
         """设置全局错误状态"""
         self._state["stage"] = "error"
@@ -1,25 +1,198 @@
 import json
 import os
+from dataclasses import asdict, dataclass, field
 from typing import Any
 
-from llm import LLMClient, parse_json
+import metrics
+import tracing
+import usage
+from intent_index import INTENT_MIN_SCORE, get_index
+from llm import JsonObjectStream, LLMClient
 from skills import Skill, skill_by_name
 
 
+# 提示词中列出与用户消息最相关的 K 个 Skill 及按总线状态可执行的下一步（0 为全部列出）
+DISPATCH_TOP_K = int(os.getenv("DISPATCH_TOP_K", "5"))
+KEYWORD_BONUS = 0.3  # 命中 trigger_keywords / Skill 名称时的加分
+INTENT_MARGIN = 0.15  # 启发式路由中第一名领先第二名超过该值时只给一个选项
+DISPATCH_MODEL_TIER = os.getenv("DISPATCH_MODEL_TIER", "fast")  # 路由决策只需小而快的模型
+
+# 硬约束规则（静态部分，每次调度原样拼接）
+CONSTRAINT_RULES = """
+【硬约束规则 - MUST FOLLOW】
+
+1. You may ONLY call a skill if ALL its required_context types are present in bus_state.context_index
+2. If context_index does NOT contain required input types, you MUST return action="ask_user"
+3. You MUST NOT infer missing context from user_message alone
+4. Check requires_context field of each skill BEFORE calling it
+
+Example:
+- script_from_transcript requires_context=["transcript"]
+- If context_index does NOT have "transcript", you CANNOT call script_from_transcript
+- You must ask_user to generate transcript first
+"""
+
+DISPATCH_ACTIONS = ("call_skill", "ask_user", "no_action", "refuse")
+# 各动作执行所需的字段：流式输出中这些字段到齐即可决策，不必等待其余输出
+DECISION_REQUIRED_FIELDS = {
+    "call_skill": ("skill_name",),
+    "ask_user": ("question", "options"),
+    "no_action": ("reason",),
+    "refuse": ("reason",),
+}
+
+
+@dataclass
+class DispatchDecision:
+    """Dispatcher 的决策（模型按 decision_schema 输出的 JSON 对象）"""
+
+    action: str
+    skill_name: str | None = None
+    question: str | None = None
+    options: list[str] = field(default_factory=list)
+    reason: str | None = None
+
+    @staticmethod
+    def ready(fields: dict[str, Any]) -> bool:
+        """已收到执行该动作所需的全部字段"""
+        required = DECISION_REQUIRED_FIELDS.get(fields.get("action"))
+        return required is not None and all(name in fields for name in required)
+
+    @classmethod
+    def from_fields(cls, fields: dict[str, Any]) -> "DispatchDecision":
+        action = fields.get("action")
+        if action not in DISPATCH_ACTIONS:
+            raise ValueError(f"Invalid dispatcher action: {action!r}")
+        if action == "call_skill" and not fields.get("skill_name"):
+            raise ValueError("call_skill without skill_name")
+        return cls(
+            action=action,
+            skill_name=fields.get("skill_name") if action == "call_skill" else None,
+            question=fields.get("question"),
+            options=[str(option) for option in fields.get("options") or []],
+            reason=fields.get("reason"),
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        return {key: value for key, value in asdict(self).items() if value is not None}
+
+
+def decision_schema(skills: list[Skill]) -> dict[str, Any]:
+    """
+    结构化输出的 response schema；skill_name 限定为全部 Skill。
+
+    不限定为预筛后的候选：预筛只决定提示词中详细列出哪些 Skill，
+    模型根据上下文选中未列出的 Skill 时仍可输出，再由 _enforce_constraints 校验。
+    """
+    skill_name: dict[str, Any] = {"type": "STRING", "nullable": True}
+    if skills:
+        skill_name["enum"] = [skill.name for skill in skills]
+    return {
+        "type": "OBJECT",
+        "properties": {
+            "action": {"type": "STRING", "enum": list(DISPATCH_ACTIONS)},
+            "skill_name": skill_name,
+            "question": {"type": "STRING", "nullable": True},
+            "options": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "reason": {"type": "STRING"},
+        },
+        "required": ["action", "reason"],
+        # 决策字段在前：流式输出时 action / skill_name 最先到达
+        "propertyOrdering": ["action", "skill_name", "question", "options", "reason"],
+    }
+
+
+_prompt_cache: dict[str, tuple[float, str]] = {}
+
+
+def _compact_json(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _load_dispatcher_prompt(path: str) -> str:
+    """读取 DispatcherPrompt.md，按修改时间缓存"""
+    mtime = os.path.getmtime(path)
+    cached = _prompt_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r", encoding="utf-8") as f:
+            cached = (mtime, f.read().strip())
+        _prompt_cache[path] = cached
+    return cached[1]
+
+
+def _keyword_hit(skill: Skill, lowered: str) -> bool:
+    name = skill.name.lower()
+    if name in lowered or name.replace("_", " ") in lowered:
+        return True
+    return any(kw.lower() in lowered for kw in skill.trigger_keywords)
+
+
+def _route_scores(user_message: str, skills: list[Skill]) -> list[float]:
+    """意图索引相似度 + 关键词命中加分"""
+    lowered = user_message.lower()
+    scores = get_index(skills).scores(user_message)
+    return [score + KEYWORD_BONUS * _keyword_hit(skill, lowered) for skill, score in zip(skills, scores)]
+
+
+def ready_next_skills(skills: list[Skill], bus_state: dict[str, Any]) -> list[Skill]:
+    """按总线状态可以执行的下一步：所需上下文全部 ready、自身产出尚未 ready 的 Skill"""
+    context_index = bus_state.get("context_index", {})
+
+    def ready(ctx_type: str) -> bool:
+        return (context_index.get(ctx_type) or {}).get("status") == "ready"
+
+    return [
+        skill for skill in skills
+        if all(ready(t) for t in skill.requires_context) and not (skill.produces and ready(skill.produces))
+    ]
+
+
+def rank_skills(
+    user_message: str,
+    skills: list[Skill],
+    top_k: int = DISPATCH_TOP_K,
+    bus_state: dict[str, Any] | None = None,
+) -> list[Skill]:
+    """
+    低成本预筛：按本地意图索引的相似度（关键词命中加分）给 Skill 排序，返回前 top_k 个，
+    再补上按总线状态可执行的下一步（"继续""下一步吧"这类消息只能靠状态判断）。
+
+    没有任何 Skill 达到 INTENT_MIN_SCORE 时说明消息本身不足以判断，返回全部 Skill。
+    得分相同时保持 SKILLS 中的顺序。
+    """
+    if top_k <= 0 or len(skills) <= top_k:
+        return list(skills)
+    scores = _route_scores(user_message, skills)
+    if max(scores) < INTENT_MIN_SCORE:
+        return list(skills)
+    order = sorted(range(len(skills)), key=lambda i: -scores[i])
+    ranked = [skills[i] for i in order[:top_k]]
+    extra = [s for s in ready_next_skills(skills, bus_state or {}) if s not in ranked]
+    return ranked + extra
+
+
+def _skill_summary(skill: Skill) -> dict[str, Any]:
+    info = {
+        "name": skill.name,
+        "description": skill.description,
+        "intent_description": skill.intent_description,
+        "input_schema": skill.input_schema,
+        "output_type": skill.output_type,
+    }
+    if skill.requires_context:
+        info["requires_context"] = skill.requires_context
+    return info
+
+
 def _bus_summary(bus_state: dict[str, Any], outputs_dir: str) -> dict[str, Any]:
     """
     构建给 Dispatcher 的总线摘要。
-    只传递语义类型和元信息，不传递文件内容。
+    只传递语义类型与状态（类型 → status），不传递文件路径、时间戳和内容。
     """
     context_index = bus_state.get("context_index", {})
-    
-    # 只传递类型键，不传递具体引用
-    available_types = list(context_index.keys())
-    
     return {
         "stage": bus_state.get("stage", "idle"),
-        "context_index": context_index,  # 完整的索引信息
-        "available_types": available_types,  # 快速查询：有哪些类型可用
+        "context_index": {ctx_type: entry.get("status") for ctx_type, entry in context_index.items()},
     }
 
 
@@ -42,35 +215,51 @@ def _validate_skill_requirements(
         
         # 检查状态是否 ready
         ctx = context_index.get(required_type, {})
+        if ctx.get("status") == "stale":
+            return False, f"上下文 {required_type} 已过期（上游已更新），请先重建"
         if ctx.get("status") != "ready":
             return False, f"上下文 {required_type} 尚未就绪"
     
     return True, ""
 
 
+def _enforce_constraints(decision: DispatchDecision, bus_state: dict[str, Any]) -> dict[str, Any]:
+    """【硬约束校验】在 Python 侧校验 LLM 的决策"""
+    if decision.action == "call_skill":
+        skill = skill_by_name(decision.skill_name)
+        if skill:
+            context_index = bus_state.get("context_index", {})
+            is_valid, reason = _validate_skill_requirements(skill, context_index)
+            if not is_valid:
+                # 校验失败，强制改为 ask_user
+                metrics.DISPATCH_OUTCOMES.inc(outcome="validation_override", action="ask_user")
+                return {
+                    "action": "ask_user",
+                    "question": f"无法执行 {decision.skill_name}：{reason}。请先完成前置步骤。",
+                    "options": [],
+                }
+    metrics.DISPATCH_OUTCOMES.inc(outcome="llm", action=decision.action)
+    return decision.to_dict()
+
+
 def _heuristic_dispatch(user_message: str, skills: list[Skill]) -> dict[str, Any]:
-    matches = []
-    lowered = user_message.lower()
-    for skill in skills:
-        skill_name = skill.name.lower()
-        if skill_name in lowered or skill_name.replace("_", " ") in lowered:
-            matches.append(skill)
-            continue
-        for kw in skill.trigger_keywords:
-            if kw.lower() in lowered:
-                matches.append(skill)
-                break
-    if len(matches) > 1:
+    scores = _route_scores(user_message, skills)
+    ranked = sorted(
+        (item for item in zip(skills, scores) if item[1] >= INTENT_MIN_SCORE),
+        key=lambda item: -item[1],
+    )
+    # 第一名明显领先时只给一个选项，否则列出所有足够相关的候选
+    if len(ranked) > 1 and ranked[0][1] - ranked[1][1] < INTENT_MARGIN:
         return {
             "action": "ask_user",
             "question": "Multiple skills match. Which one should I run?",
-            "options": [m.name for m in matches],
+            "options": [skill.name for skill, _ in ranked],
         }
-    if len(matches) == 1:
+    if ranked:
         return {
             "action": "ask_user",
             "question": "我理解你可能想执行下面的任务，请确认是否正确。",
-            "options": [matches[0].name],
+            "options": [ranked[0][0].name],
         }
     return {
         "action": "ask_user",
@@ -79,6 +268,7 @@ def _heuristic_dispatch(user_message: str, skills: list[Skill]) -> dict[str, Any
     }
 
 
+@tracing.traced("dispatch")
 def dispatch(
     user_message: str,
     bus_state: dict[str, Any],
@@ -86,71 +276,46 @@ def dispatch(
     dispatcher_prompt_path: str,
     outputs_dir: str,
 ) -> dict[str, Any]:
-    with open(dispatcher_prompt_path, "r", encoding="utf-8") as f:
-        prompt = f.read().strip()
-
+    prompt = _load_dispatcher_prompt(dispatcher_prompt_path)
     bus_info = _bus_summary(bus_state, outputs_dir)
-    skills_info = [
-        {
-            "name": s.name,
-            "description": s.description,
-            "intent_description": s.intent_description,
-            "input_schema": s.input_schema,
-            "output_type": s.output_type,
-            "requires_context": s.requires_context,  # 添加上下文依赖信息
-        }
-        for s in skills
-    ]
-    
-    # 添加硬约束规则
-    constraint_rules = """
-【硬约束规则 - MUST FOLLOW】
-
-1. You may ONLY call a skill if ALL its required_context types are present in bus_state.context_index
-2. If context_index does NOT contain required input types, you MUST return action="ask_user"
-3. You MUST NOT infer missing context from user_message alone
-4. Check requires_context field of each skill BEFORE calling it
+    candidates = rank_skills(user_message, skills, bus_state=bus_state)
+    skills_info = [_skill_summary(s) for s in candidates]
 
-Example:
-- script_from_transcript requires_context=["transcript"]
-- If context_index does NOT have "transcript", you CANNOT call script_from_transcript
-- You must ask_user to generate transcript first
-"""
-    
+    # 规则说明与硬约束对每次调度都相同，作为可缓存的前缀；候选 Skill 随消息变化，放在前缀之后
+    preamble = f"{prompt}\n\n{CONSTRAINT_RULES}\n\n"
     full_prompt = (
-        f"{prompt}\n\n"
-        f"{constraint_rules}\n\n"
-        f"available_skills:\n{json.dumps(skills_info, ensure_ascii=False, indent=2)}\n\n"
+        f"available_skills:\n{_compact_json(skills_info)}\n\n"
         f"user_message:\n{user_message}\n\n"
-        f"bus_state:\n{json.dumps(bus_info, ensure_ascii=False, indent=2)}\n"
+        f"bus_state:\n{_compact_json(bus_info)}\n"
     )
+    tracing.annotate(candidates=len(candidates), prompt_bytes=len(preamble) + len(full_prompt))
+
+    # 结构化输出 + 流式解析：决策所需字段到齐即停止接收；输出无效时直接走启发式路由，不重试
+    stream = JsonObjectStream()
+
+    def on_chunk(chunk: str) -> bool:
+        stream.feed(chunk)
+        return DispatchDecision.ready(stream.fields)
+
+    try:
+        # 用量记在 "dispatcher" 名下；超出预算（reject）时同样退回启发式路由
+        with usage.scope(skill="dispatcher"):
+            LLMClient().complete(
+                full_prompt,
+                tier=DISPATCH_MODEL_TIER,
+                cached_prefix=preamble,
+                cache_eagerly=True,
+                response_schema=decision_schema(skills),
+                on_chunk=on_chunk,
+            )
+        decision = DispatchDecision.from_fields(stream.fields)
+    except Exception:
+        decision = None
+    tracing.annotate(decision_fields=len(stream.fields), stream_complete=stream.done)
+
+    if decision is not None:
+        return _enforce_constraints(decision, bus_state)
 
-    llm = LLMClient()
-    for _ in range(2):
-        try:
-            response = llm.complete(full_prompt)
-            parsed = parse_json(response)
-            if parsed is not None:
-                # 【硬约束校验】在 Python 侧校验 LLM 的决策
-                action = parsed.get("action")
-                if action == "call_skill":
-                    skill_name = parsed.get("skill_name")
-                    skill = skill_by_name(skill_name)
-                    
-                    if skill:
-                        context_index = bus_state.get("context_index", {})
-                        is_valid, reason = _validate_skill_requirements(skill, context_index)
-                        
-                        if not is_valid:
-                            # 校验失败，强制改为 ask_user
-                            return {
-                                "action": "ask_user",
-                                "question": f"无法执行 {skill_name}：{reason}。请先完成前置步骤。",
-                                "options": [],
-                            }
-                
-                return parsed
-        except Exception:
-            break
-
-    return _heuristic_dispatch(user_message, skills)
+    result = _heuristic_dispatch(user_message, skills)
+    metrics.DISPATCH_OUTCOMES.inc(outcome="heuristic", action=result["action"])
+    return result
@@ -0,0 +1,30 @@
+"""
+读取 .env 文件写入环境变量（不依赖 python-dotenv）。
+
+入口脚本（app.py / main.py 等）需在导入其他项目模块之前调用，
+各模块在导入时读取的环境变量配置（如 LLM_MAX_RPM、IMAGE_WORKERS）才能生效。
+"""
+
+import os
+
+
+def load_env_file(path: str = ".env") -> dict[str, str]:
+    """解析 KEY=VALUE 行并写入 os.environ，返回读取到的键值；文件不存在时什么都不做"""
+    if not os.path.exists(path):
+        return {}
+    values = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            value = value.strip()
+            if value[:1] in ("'", '"') and value[-1:] == value[:1] and len(value) >= 2:
+                value = value[1:-1]
+            elif " #" in value:
+                # 行尾注释：USE_PROXY=false  # 如需代理设为 true
+                value = value.split(" #", 1)[0].rstrip()
+            values[key.strip()] = value
+    os.environ.update(values)
+    return values
@@ -0,0 +1,100 @@
+"""
+进程内发布/订阅。
+
+GlobalStateBus 每次写入后发布状态增量（state），图像管线发布渲染进度（image），
+文本 Skill 生成时发布清理后的输出增量（output），app.py 的 /api/events 以 SSE 推送给前端，替代轮询。
+
+保留最近的事件，断线重连时按 Last-Event-ID 补发。
+"""
+
+import itertools
+import json
+import queue
+import threading
+from collections import deque
+
+
+HISTORY_SIZE = 256
+
+
+class EventBroker:
+    def __init__(self, history_size: int = HISTORY_SIZE):
+        self._ids = itertools.count(1)
+        self._history: deque[dict] = deque(maxlen=history_size)
+        self._subscribers: list[queue.Queue] = []
+        self._lock = threading.Lock()
+
+    def publish(self, event_type: str, data: dict, transient: bool = False) -> int:
+        """transient=True 的事件（如生成中的文本增量）不保留，断线重连时不补发"""
+        with self._lock:
+            event = {"id": next(self._ids), "event": event_type, "data": data}
+            if not transient:
+                self._history.append(event)
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            q.put(event)
+        return event["id"]
+
+    def subscribe(self, last_event_id: int | None = None) -> tuple[queue.Queue, list[dict]]:
+        """返回 (订阅队列, 需要补发的事件)；last_event_id 为客户端收到的最后一个事件"""
+        q: queue.Queue = queue.Queue()
+        with self._lock:
+            self._subscribers.append(q)
+            backlog = [e for e in self._history if last_event_id is not None and e["id"] > last_event_id]
+        return q, backlog
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+
+def format_sse(event: dict) -> str:
+    data = json.dumps(event["data"], ensure_ascii=False)
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {data}\n\n"
+
+
+BROKER = EventBroker()
+
+
+# ==================== 总线状态增量 ====================
+
+def summarize_state(state: dict) -> dict:
+    """提取需要推送的状态字段（不含正文、items 等大字段）"""
+    run = state.get("workflow_run")
+    return {
+        "stage": state.get("stage"),
+        "selected_skill": state.get("selected_skill"),
+        "skills": {name: info.get("status") for name, info in state.get("skills", {}).items()},
+        "context": {
+            ctx_type: {"status": entry.get("status"), "version": entry.get("version"), "ref": entry.get("ref")}
+            for ctx_type, entry in state.get("context_index", {}).items()
+        },
+        "workflow": {
+            "run_id": run.get("run_id"),
+            "workflow": run.get("workflow"),
+            "status": run.get("status"),
+            "current_step": run.get("current_step"),
+            "completed_steps": list(run.get("completed_steps", [])),
+        } if run else None,
+    }
+
+
+def diff_states(old: dict | None, new: dict) -> list[dict]:
+    """比较两次 summarize_state 的结果，返回变化列表"""
+    old = old or {"skills": {}, "context": {}}
+    changes = []
+    for key in ("stage", "selected_skill"):
+        if old.get(key) != new[key]:
+            changes.append({"type": key, "value": new[key]})
+    for name, status in new["skills"].items():
+        if old["skills"].get(name) != status:
+            changes.append({"type": "skill", "skill": name, "status": status})
+    for ctx_type, entry in new["context"].items():
+        if old["context"].get(ctx_type) != entry:
+            changes.append({"type": "context", "context_type": ctx_type, **entry})
+    for ctx_type in old["context"].keys() - new["context"].keys():
+        changes.append({"type": "context", "context_type": ctx_type, "status": None})
+    if old.get("workflow") != new["workflow"]:
+        changes.append({"type": "workflow", "value": new["workflow"]})
+    return changes
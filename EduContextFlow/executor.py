@@ -1,8 +1,15 @@
 import base64
 import os
+import re
+import time
 
+import events
+import metrics
+import tracing
+import usage
 from llm import LLMClient
-from skills import Skill
+from sections import Section, splice_sections, split_sections
+from skills import Skill, SkillInput
 
 
 _ONE_PIXEL_PNG = base64.b64decode(
@@ -11,182 +18,463 @@ _ONE_PIXEL_PNG = base64.b64decode(
 )
 
 
+# 局部修改时使用的 Prompt：只重写目标章节，其余内容作为只读上下文
+_PATCH_PROMPT = """你正在修改一份已有的文档（{skill_description}）。
+只重写下面的【目标章节】，保持原有的标题、层级和整体风格，不要输出其他章节。
+
+【文档大纲】
+{outline}
+
+【前文末尾】
+{before}
+
+【目标章节】
+{section}
+
+【后文开头】
+{after}
+
+【修改要求】
+{instruction}
+
+请直接输出修改后的完整目标章节（以原标题开头的 Markdown），不要任何解释。"""
+
+_PATCH_CONTEXT_CHARS = 600
+
+
 def _ensure_parent_dir(path: str):
     parent = os.path.dirname(path)
     if parent and not os.path.isdir(parent):
         os.makedirs(parent, exist_ok=True)
 
 
+def _write_text(path: str, content: str):
+    with tracing.span("file.write", path=path, bytes=len(content.encode("utf-8"))):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+# 常见的 LLM 复述开头（仅在输出开头附近出现时才处理）
+_BAD_STARTS = (
+    "好的，这是根据",
+    "好的，我来",
+    "好的，以下是",
+    "根据您的要求",
+    "这是为您",
+    "以下是根据",
+    "## Prompt 模板",
+    "## 输出要求",
+    "===教学内容===",
+    "===用户需求===",
+)
+_BAD_START_LIMIT = 100  # 标记必须出现在前 100 字符内
+
+# 行分类规则（均作用于 strip 后的单行）
+_MARKER_SKIP_RE = re.compile(r"[#=\-]|.*(?:Prompt|模板|Template|要求|Requirements|\{\{|\}\})")
+_ECHO_SEPARATOR_RE = re.compile(r"===|现在请|要求|---\Z")
+_META_PREFIX_RE = re.compile(r"[#=]|Prompt|---\Z")
+_META_TOKEN_RE = re.compile(r"模板|Template|\{\{|\}\}")
+# 正文中的空白行（含仅有空白字符的行）
+_BLANK_LINE_RE = re.compile(r"\n[^\S\n]*(?=\n)")
+
+
+def _iter_lines(text: str, pos: int = 0):
+    """惰性逐行遍历，返回 (行起始偏移, 行结束偏移, strip 后的行)；调用方找到目标即可提前停止。"""
+    size = len(text)
+    while pos <= size:
+        end = text.find("\n", pos)
+        if end == -1:
+            end = size
+        yield pos, end, text[pos:end].strip()
+        pos = end + 1
+
+
+def _is_meta_line(stripped: str) -> bool:
+    return bool(_META_PREFIX_RE.match(stripped) or _META_TOKEN_RE.search(stripped))
+
+
+def _bad_start_offset(output: str) -> tuple[int, bool]:
+    """
+    阶段 1 的定位部分：返回实际内容的起始偏移，以及是否有标记尚未找到其后的内容行。
+
+    依次处理每个复述标记：标记出现在当前起点后的窗口内时，跳过标记所在的引导句（以冒号结尾）
+    及其后的空行、标题、元描述行，起点移到第一行实际内容。
+    """
+    start, unresolved = 0, False
+    for bad_start in _BAD_STARTS:
+        # 只在开头窗口内查找，避免对全文做 find
+        idx = output.find(bad_start, start, start + _BAD_START_LIMIT + len(bad_start) - 1)
+        if idx == -1:
+            continue
+        for offset, _, stripped in _iter_lines(output, idx):
+            if not stripped or _MARKER_SKIP_RE.match(stripped):
+                continue
+            if offset == idx and stripped.endswith(("：", ":")):
+                # "好的，以下是课程脚本内容：" 这类引导句本身不是内容
+                continue
+            if stripped[0].isdigit() or len(stripped) > 10:
+                start = offset + len(output[offset:]) - len(output[offset:].lstrip())
+                break
+        else:
+            unresolved = True
+    return start, unresolved
+
+
+def _strip_bad_start(output: str) -> str:
+    """阶段 1：开头附近出现复述标记时，跳到标记后第一行实际内容。"""
+    start, _ = _bad_start_offset(output)
+    return output[start:].strip()
+
+
+def _content_after_echo(after_input: str) -> str:
+    """阶段 2：跳过复述内容之后的分隔符与说明文字。"""
+    content_start = 0
+    for _, end, stripped in _iter_lines(after_input):
+        if _ECHO_SEPARATOR_RE.match(stripped):
+            content_start = end + 1
+        elif stripped and stripped[0] not in "=-":
+            break
+    return after_input[content_start:].strip()
+
+
+def _drop_meta_head(output: str) -> str:
+    """阶段 3：去掉开头的纯元描述行，正文中的空行一并移除。"""
+    for offset, _, stripped in _iter_lines(output):
+        if stripped and not _is_meta_line(stripped):
+            return _BLANK_LINE_RE.sub("", output[offset:]).strip()
+    return ""
+
+
 def _clean_llm_output(raw_output: str, original_input: str) -> str:
     """
     清理 LLM 输出，移除可能被复述的 Prompt 模板内容。
     只保留实际生成的内容。
+
+    线性时间实现：开头标记只在固定窗口内查找，复述检测只做一次 rfind，
+    行扫描在找到第一行实际内容后即停止，正文的空行清理由一次正则替换完成。
     """
-    output = raw_output.strip()
-    
-    # 阶段 1：移除常见的 LLM 复述开头
-    bad_starts = [
-        "好的，这是根据",
-        "好的，我来",
-        "好的，以下是",
-        "根据您的要求",
-        "这是为您",
-        "以下是根据",
-        "## Prompt 模板",
-        "## 输出要求",
-        "===教学内容===",
-        "===用户需求===",
-    ]
-    
-    for bad_start in bad_starts:
-        if bad_start in output:
-            # 找到这些标记后的内容
-            idx = output.find(bad_start)
-            if idx < 100:  # 如果在开头附近（前100字符内）
-                # 尝试跳过这部分
-                after_marker = output[idx:]
-                # 找到第一个看起来像实际内容的部分
-                lines = after_marker.split('\n')
-                for i, line in enumerate(lines):
-                    stripped = line.strip()
-                    # 跳过空行、标题、分隔符
-                    if not stripped or stripped.startswith('#') or stripped.startswith('=') or stripped.startswith('-'):
-                        continue
-                    # 跳过包含 "Prompt"、"模板"、"要求" 等元描述的行
-                    if any(kw in stripped for kw in ['Prompt', '模板', 'Template', '要求', 'Requirements', '{{', '}}']):
-                        continue
-                    # 找到第一行看起来像实际内容的行
-                    if stripped and (stripped[0].isdigit() or len(stripped) > 10):
-                        output = '\n'.join(lines[i:]).strip()
-                        break
-    
-    # 阶段 2：如果输出包含用户输入的完整内容，说明 LLM 可能复述了 prompt
-    if original_input in output:
-        # 找到用户输入最后出现的位置
+    output = _strip_bad_start(raw_output.strip())
+
+    # 如果输出包含用户输入的完整内容，说明 LLM 可能复述了 prompt
+    if original_input:
         last_idx = output.rfind(original_input)
         if last_idx != -1:
-            # 截取用户输入之后的内容
-            after_input = output[last_idx + len(original_input):].strip()
-            
-            # 如果后面还有实质内容，返回它
-            if after_input:
-                # 移除可能的分隔符和说明文字
-                lines = after_input.split('\n')
-                content_start = 0
-                for i, line in enumerate(lines):
-                    stripped = line.strip()
-                    # 跳过分隔符、说明性文字
-                    if stripped in ['===', '============', '==========', '---', '现在请直接输出', '要求：']:
-                        content_start = i + 1
-                    elif stripped.startswith('现在请') or stripped.startswith('要求') or stripped.startswith('==='):
-                        content_start = i + 1
-                    elif stripped and not stripped.startswith('=') and not stripped.startswith('-'):
-                        # 找到第一行实质内容
-                        break
-                
-                cleaned = '\n'.join(lines[content_start:]).strip()
-                if cleaned:
-                    return cleaned
-    
-    # 阶段 3：移除纯元描述内容（如果整个输出都是模板说明）
-    lines = output.split('\n')
-    real_content_lines = []
-    in_meta_section = True
-    
-    for line in lines:
-        stripped = line.strip()
-        
-        # 跳过空行
-        if not stripped:
-            continue
-        
-        # 检查是否是元描述（模板、说明、要求等）
-        is_meta = (
-            stripped.startswith('#') or 
-            stripped.startswith('=') or
-            stripped.startswith('Prompt') or
-            '模板' in stripped or
-            'Template' in stripped or
-            '{{' in stripped or
-            '}}' in stripped or
-            stripped in ['---', '===', '============']
-        )
-        
-        if not is_meta:
-            in_meta_section = False
-        
-        if not in_meta_section:
-            real_content_lines.append(line)
-    
-    if real_content_lines:
-        cleaned = '\n'.join(real_content_lines).strip()
-        if cleaned:
-            return cleaned
-    
-    # 如果清理后内容太少，返回原始输出
-    return output
+            cleaned = _content_after_echo(output[last_idx + len(original_input):].strip())
+            if cleaned:
+                return cleaned
+
+    # 如果清理后没有内容，返回原始输出
+    return _drop_meta_head(output) or output
+
+
+def _traced_clean(raw_output: str, original_input: str) -> str:
+    with tracing.span("clean_output", input_bytes=len(raw_output)) as s:
+        cleaned = _clean_llm_output(raw_output, original_input)
+        s["output_bytes"] = len(cleaned)
+    return cleaned
 
 
-def _generate_text(skill: Skill, input_text: str) -> str:
+def _first_content_line(output: str) -> int | None:
+    """阶段 3 的定位部分：第一行非元描述内容的起始偏移（只看完整的行）"""
+    for offset, end, stripped in _iter_lines(output):
+        if end == len(output):
+            return None
+        if stripped and not _is_meta_line(stripped):
+            return offset
+    return None
+
+
+class OutputSanitizer:
+    """
+    流式版本的输出清理器。
+
+    feed() 逐块接收 LLM 输出，只处理新到达的完整行，返回可立即展示的增量内容：
+    开头的复述标记、元描述与空行确定之后才开始输出，之后每个完整行去掉空行即可输出。
+    已输出的内容总是 finish() 结果的前缀，flush() 返回剩余部分，
+    即 "".join(feed 的返回值) + flush() == finish()。
+
+    例外：输出中复述了用户输入时（只能在结束时判断），finish() 截取复述之后的内容，
+    与已输出的前缀不一致，flush() 返回 None，消费方应整体替换为 finish() 的结果。
+    落盘内容以 finish() 为准。
+    """
+
+    # 判断开头是否还会出现复述标记所需的最少字符数（标记查找窗口）
+    _HEAD_WINDOW = _BAD_START_LIMIT + max(len(s) for s in _BAD_STARTS)
+
+    def __init__(self, original_input: str):
+        self.original_input = original_input
+        self._chunks: list[str] = []
+        self._pending = ""  # 尚未完整的行
+        self._head = ""  # 开头确定之前缓存的完整行
+        self._in_head = True
+        self._held = ""  # 最后一行末尾的空白（文档结尾的空白会被 strip，只有后面还有内容时才输出）
+        self.emitted = ""
+
+    def feed(self, chunk: str) -> str:
+        self._chunks.append(chunk)
+        text = self._pending + chunk
+        last_newline = text.rfind("\n")
+        if last_newline == -1:
+            self._pending = text
+            return ""
+        self._pending = text[last_newline + 1:]
+        complete = text[:last_newline + 1]
+        if self._in_head:
+            self._head += complete
+            complete = self._resolve_head()
+            if complete is None:
+                return ""
+        delta = self._emit_lines(complete)
+        self.emitted += delta
+        return delta
+
+    def _resolve_head(self) -> str | None:
+        """开头确定后返回从第一行实际内容开始的文本，尚不能确定时返回 None"""
+        head = self._head.lstrip()
+        start, unresolved = _bad_start_offset(head)
+        # 复述标记的查找窗口须完整落在已收到的内容内
+        if unresolved or len(head) < start + self._HEAD_WINDOW:
+            return None
+        offset = _first_content_line(head[start:])
+        if offset is None:
+            return None
+        self._in_head = False
+        self._head = ""
+        return head[start + offset:].lstrip()
+
+    def _emit_lines(self, complete: str) -> str:
+        """完整行（以换行结尾）去掉空行后拼接；行与行之间的换行在下一行到达时才输出"""
+        pieces = []
+        for line in complete[:-1].split("\n"):
+            if not line.strip():
+                continue
+            body = line.rstrip()
+            if self.emitted or pieces:
+                pieces.append(self._held + "\n")
+            pieces.append(body)
+            self._held = line[len(body):]
+        return "".join(pieces)
+
+    def finish(self) -> str:
+        return _clean_llm_output("".join(self._chunks), self.original_input)
+
+    def flush(self) -> str | None:
+        final = self.finish()
+        if not final.startswith(self.emitted):
+            return None
+        return final[len(self.emitted):]
+
+
+def render_prompt(skill: Skill, skill_input: SkillInput | str) -> tuple[str, str]:
+    """
+    用预编译模板渲染 prompt，返回 (prompt, user_input)。
+
+    模板中有同名槽位的上下文直接填入；其余上下文与用户要求分块后填入 {user_input}。
+    user_input 同时用于清理输出中被复述的输入。
+    """
+    if isinstance(skill_input, str):
+        skill_input = SkillInput(skill_input)
+    template = skill.prompt
+    slotted = {t: c for t, c in skill_input.contexts.items() if t in template.slots}
+    user_input = skill_input.block(exclude=slotted)
+    # 声明过但未就绪的可选上下文渲染为空，而不是留下 {类型} 原文
+    values = dict.fromkeys(skill.context_slots, "")
+    values.update(slotted)
+    values["user_input"] = user_input
+    return template.render(values), user_input
+
+
+_MESSAGE_MARKER = "\x00user_message\x00"
+
+
+def split_prompt(skill: Skill, skill_input: SkillInput | str) -> tuple[str, str, str]:
+    """
+    渲染 prompt 并切分为 (可缓存前缀, 其余部分, user_input)。
+
+    前缀是用户要求之前的全部内容（Skill 指令 + 上游上下文），上游未变时保持不变，
+    作为显式上下文缓存复用（重新生成、推测预生成与正式请求等）。
+    """
+    if isinstance(skill_input, str):
+        skill_input = SkillInput(skill_input)
+    prompt, user_input = render_prompt(skill, skill_input)
+    probe, _ = render_prompt(skill, SkillInput(_MESSAGE_MARKER, skill_input.contexts))
+    prefix = probe[:max(0, probe.find(_MESSAGE_MARKER))]
+    if not prompt.startswith(prefix):
+        return "", prompt, user_input
+    return prefix, prompt[len(prefix):], user_input
+
+
+def _text_output(skill: Skill, result: str | None, input_text: str) -> str:
+    if not result or not result.strip():
+        # 空结果不能写占位内容冒充产出（会被登记为 ready，续跑时也不会重试）
+        raise RuntimeError(f"Empty LLM output for skill: {skill.name}")
+    # 清理输出，移除可能被复述的 prompt 内容
+    return _traced_clean(result, input_text)
+
+
+def _generate_text(skill: Skill, skill_input: SkillInput | str) -> str:
     """
     纯粹的文本生成执行器。
-    只负责：格式化 prompt → 调用 LLM → 返回结果
+    只负责：渲染 prompt → 调用 LLM → 返回结果
+
+    LLM 调用失败（含超出预算）时异常直接抛给调用方，由其标记 Skill / 工作流步骤失败。
     """
     llm = LLMClient()
-    prompt = skill.prompt_template.format(user_input=input_text)
-    try:
-        result = llm.complete(prompt)
-        if result.strip():
-            # 清理输出，移除可能被复述的 prompt 内容
-            cleaned = _clean_llm_output(result, input_text)
-            return cleaned
-    except Exception:
-        pass
-    return (
-        f"# {skill.name}\n\n"
-        f"Input:\n\n{input_text}\n\n"
-        "Generated content placeholder.\n"
-    )
+    prefix, prompt, input_text = split_prompt(skill, skill_input)
+    sanitizer = OutputSanitizer(input_text)
 
+    def on_chunk(chunk: str):
+        # 清理后的增量经 /api/events 推送给前端实时展示（output 事件）
+        delta = sanitizer.feed(chunk)
+        if delta:
+            events.BROKER.publish("output", {"skill": skill.name, "delta": delta}, transient=True)
+
+    result = llm.complete(prompt, tier=skill.model_tier, cached_prefix=prefix, on_chunk=on_chunk)
+    content = _text_output(skill, result, input_text)
+    # 推送剩余部分；已推送的内容与最终结果不一致（复述了用户输入）时整体替换
+    done = {"skill": skill.name, "done": True}
+    if content.startswith(sanitizer.emitted):
+        done["delta"] = content[len(sanitizer.emitted):]
+    else:
+        done["text"] = content
+    events.BROKER.publish("output", done, transient=True)
+    return content
 
-def _generate_image(skill: Skill, input_text: str, path: str):
+
+def write_text_output(skill: Skill, result: str | None, input_text: str, output_path: str) -> str:
     """
-    纯粹的图像生成执行器。
-    只负责：格式化 prompt → 调用 image model → 写文件
+    批量接口等异步返回的文本结果落盘：与 execute_skill 相同的清理规则。
+
+    prompt 由调用方通过 render_prompt 渲染后提交；result 为空时抛出 RuntimeError，
+    调用方应让该步骤保持未完成，而不是登记产出。
+    """
+    content = _text_output(skill, result, input_text)
+    _ensure_parent_dir(output_path)
+    _write_text(output_path, content)
+    metrics.SKILL_OUTPUT_BYTES.observe(os.path.getsize(output_path), skill=skill.name)
+    return output_path
+
+
+def _write_image_error(path: str, exc: Exception):
+    error_path = os.path.splitext(path)[0] + "_error.txt"
+    with open(error_path, "w", encoding="utf-8") as f:
+        f.write(str(exc))
+
+
+@tracing.traced("image_prompt")
+def generate_image_prompt(skill: Skill, skill_input: SkillInput | str, path: str) -> str:
+    """
+    图像生成的提示词步骤：渲染 prompt → 调用文本模型 → 写 _prompt.txt。
+
+    返回清理后的图像提示词，渲染由 render_image 单独完成（可放到后台执行）。
     """
     _ensure_parent_dir(path)
-    llm = LLMClient()
     try:
-        prompt = skill.prompt_template.format(user_input=input_text)
-        raw_prompt = llm.complete(prompt).strip()
+        prefix, prompt, input_text = split_prompt(skill, skill_input)
+        with usage.scope(skill=skill.name):
+            raw_prompt = LLMClient().complete(prompt, tier=skill.model_tier, cached_prefix=prefix).strip()
         if not raw_prompt:
             raise RuntimeError("Empty image prompt.")
         
         # 清理图像提示词，移除可能的 prompt 复述
-        image_prompt = _clean_llm_output(raw_prompt, input_text)
+        image_prompt = _traced_clean(raw_prompt, input_text)
         
         prompt_path = os.path.splitext(path)[0] + "_prompt.txt"
-        with open(prompt_path, "w", encoding="utf-8") as f:
-            f.write(image_prompt)
-        llm.generate_image(image_prompt, path)
+        _write_text(prompt_path, image_prompt)
+        return image_prompt
+    except Exception as exc:
+        _write_image_error(path, exc)
+        raise
+
+
+@tracing.traced("render_image")
+def render_image(image_prompt: str, path: str) -> str:
+    """图像生成的渲染步骤：调用 image model → 写文件 → 检查大小"""
+    _ensure_parent_dir(path)
+    try:
+        LLMClient().generate_image(image_prompt, path)
         if os.path.exists(path) and os.path.getsize(path) < 2048:
             raise RuntimeError("Image output is too small, likely failed.")
-        return
+        return path
     except Exception as exc:
-        error_path = os.path.splitext(path)[0] + "_error.txt"
-        with open(error_path, "w", encoding="utf-8") as f:
-            f.write(str(exc))
+        _write_image_error(path, exc)
         raise
 
 
-def execute_skill(skill: Skill, input_text: str) -> str:
+def _generate_image(skill: Skill, skill_input: SkillInput | str, path: str):
+    """
+    纯粹的图像生成执行器（同步）。
+    只负责：生成图像提示词 → 调用 image model → 写文件
+    """
+    render_image(generate_image_prompt(skill, skill_input, path), path)
+
+
+def _patch_section(
+    llm: LLMClient,
+    skill: Skill,
+    document: str,
+    outline: str,
+    section: Section,
+    instruction: str,
+) -> str:
+    section_text = section.text(document)
+    prompt = _PATCH_PROMPT.format(
+        skill_description=skill.description,
+        outline=outline,
+        before=document[max(0, section.start - _PATCH_CONTEXT_CHARS):section.start].strip() or "（无）",
+        section=section_text.strip(),
+        after=document[section.end:section.end + _PATCH_CONTEXT_CHARS].strip() or "（无）",
+        instruction=instruction,
+    )
+    result = llm.complete(prompt, tier=skill.model_tier)
+    if not result.strip():
+        raise RuntimeError(f"Empty patch for section: {section.title}")
+    cleaned = _traced_clean(result, instruction)
+    # 模型漏掉标题时补回原标题，保证拼接后结构不变
+    heading = section_text.split("\n", 1)[0]
+    if not cleaned.lstrip().startswith("#"):
+        cleaned = f"{heading}\n{cleaned}"
+    return cleaned
+
+
+@tracing.traced("execute_patch")
+def execute_patch(
+    skill: Skill,
+    document: str,
+    sections: list[Section],
+    instruction: str,
+    output_path: str,
+) -> str:
+    """
+    局部修改执行器：只重新生成受影响的章节，拼接后写入新版本文件。
+
+    document 由 App 层读取后传入（Executor 不读取历史文件）；
+    成本与修改范围成正比，而不是与整篇文档长度成正比。
+    """
+    _ensure_parent_dir(output_path)
+    llm = LLMClient()
+    outline = "\n".join(
+        f"{'  ' * (s.level - 1)}- {s.title}"
+        for s in split_sections(document)
+    )
+    with usage.scope(skill=skill.name):
+        replacements = [
+            (section, _patch_section(llm, skill, document, outline, section, instruction))
+            for section in sections
+        ]
+    _write_text(output_path, splice_sections(document, replacements))
+    return output_path
+
+
+@tracing.traced("execute_skill")
+def execute_skill(skill: Skill, skill_input: SkillInput | str, output_path: str | None = None) -> str:
     """
     Executor 的唯一入口。
     
     职责：
-    1. 接收已经准备好的 input_text（由 App 层组装）
+    1. 接收已经准备好的 skill_input（由 App 层组装的 SkillInput，或直接给出的输入文本）
     2. 调用 LLM/Image Model
-    3. 写输出文件
+    3. 写输出文件（默认 skill.output_filename，批量模式下由 App 层指定会话目录）
     4. 返回文件路径
     
     禁止：
@@ -194,14 +482,18 @@ def execute_skill(skill: Skill, input_text: str) -> str:
     - 读取历史文件
     - 做任何上下文推理
     """
-    output_path = skill.output_filename
+    output_path = output_path or skill.output_filename
     _ensure_parent_dir(output_path)
+    started = time.perf_counter()
     
-    if skill.output_type == "image":
-        _generate_image(skill, input_text, output_path)
-    else:
-        content = _generate_text(skill, input_text)
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(content)
+    with usage.scope(skill=skill.name):
+        if skill.output_type == "image":
+            _generate_image(skill, skill_input, output_path)
+        else:
+            content = _generate_text(skill, skill_input)
+            _write_text(output_path, content)
     
+    metrics.SKILL_DURATION.observe(time.perf_counter() - started, skill=skill.name)
+    if os.path.exists(output_path):
+        metrics.SKILL_OUTPUT_BYTES.observe(os.path.getsize(output_path), skill=skill.name)
     return output_path
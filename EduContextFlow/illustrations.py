@@ -0,0 +1,159 @@
+"""
+分镜插图批量生成：从 storyboard 产出中解析镜头，为每个镜头的画面描述生成插图。
+
+- 提示词由画面描述直接拼装（不再逐个调用文本模型），相同提示词只渲染一次
+- 渲染提交到 ImagePipeline，并发度受线程池大小限制，所有请求共享 llm.py 中的限流器
+- 结果作为有序集合登记到 context_index["storyboard_images"]，items 中每项对应一个镜头
+- 重跑时提示词未变且图片仍在的镜头直接复用
+"""
+
+import hashlib
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+from bus import GlobalStateBus
+from image_pipeline import ImagePipeline
+from runner import ContextMissingError, file_hash
+from sections import split_sections
+
+
+CONTEXT_TYPE = "storyboard_images"
+PRODUCER = "storyboard_illustration"
+DESCRIPTION = "分镜插图（按镜头顺序排列的图片集合）"
+
+SHOT_PROMPT_TEMPLATE = "教学视频分镜插图：{picture}。扁平插画风格，构图简洁，主体清晰，画面中不出现文字。"
+
+_SHOT_TITLE_RE = re.compile(r"镜头\s*([0-9]+|[零一二两三四五六七八九十]+)")
+# "- **画面**：..." / "**画面：**..." / "画面：..."
+_PICTURE_RE = re.compile(r"^[ \t]*(?:[-*+][ \t]*)?\**[ \t]*画面[ \t]*\**[ \t]*[:：][ \t]*\**[ \t]*(.+?)[ \t]*$", re.M)
+
+
+@dataclass(frozen=True)
+class Shot:
+    index: int  # 在分镜中的顺序（从 1 开始）
+    title: str
+    module: str  # 所属的上级标题（如"模块一：XXX"）
+    picture: str  # 画面描述
+
+
+def parse_shots(document: str) -> list[Shot]:
+    """解析标题含"镜头 N"且带有画面描述的小节"""
+    sections = split_sections(document)
+    shots = []
+    for section in sections:
+        if not _SHOT_TITLE_RE.search(section.title):
+            continue
+        match = _PICTURE_RE.search(section.text(document))
+        if not match:
+            continue
+        picture = match.group(1).replace("**", "").strip()
+        if not picture:
+            continue
+        module = ""
+        for parent in sections:
+            if parent.level < section.level and parent.start < section.start and parent.end >= section.end:
+                module = parent.title
+        shots.append(Shot(index=len(shots) + 1, title=section.title, module=module, picture=picture))
+    return shots
+
+
+def shot_prompt(shot: Shot) -> str:
+    # 不含模块名，不同模块中相同的画面（如反复出现的讲师出镜）可以共用一张图
+    return SHOT_PROMPT_TEMPLATE.format(picture=" ".join(shot.picture.split()))
+
+
+def _prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def plan_illustrations(shots: list[Shot], images_dir: str, previous_items: list[dict]) -> tuple[list[dict], dict]:
+    """
+    为每个镜头生成集合条目，返回 (items, prompts)。
+
+    图片按提示词哈希命名，相同提示词自然指向同一文件；prompts 只包含需要渲染的
+    {prompt_hash: prompt}，上次已成功且文件仍在的直接复用。
+    """
+    reusable = {
+        item["prompt_hash"]
+        for item in previous_items
+        if item.get("status") == "ready" and os.path.exists(item.get("ref", ""))
+    }
+    items = []
+    prompts = {}
+    for shot in shots:
+        prompt = shot_prompt(shot)
+        key = _prompt_hash(prompt)
+        reused = key in reusable
+        if not reused:
+            prompts[key] = prompt
+        items.append({
+            "index": shot.index,
+            "title": shot.title,
+            "module": shot.module,
+            "picture": shot.picture,
+            "prompt_hash": key,
+            "ref": os.path.join(images_dir, f"{key}.png"),
+            "status": "ready" if reused else "pending",
+        })
+    return items, prompts
+
+
+def illustrate_storyboard(
+    bus: GlobalStateBus,
+    pipeline: ImagePipeline,
+    outputs_dir: str | None = None,
+) -> dict:
+    """
+    App 层：读取 storyboard 上下文，提交插图渲染并立即返回 {"items", "jobs"}。
+
+    集合先以 pending 状态登记；全部渲染结束后（后台线程）更新每项状态，
+    全部成功为 ready，否则为 failed（重跑时只补渲失败的镜头）。
+    """
+    context_index = bus.get_state().get("context_index", {})
+    entry = context_index.get("storyboard") or {}
+    storyboard_path = entry.get("ref", "")
+    if entry.get("status") != "ready" or not os.path.exists(storyboard_path):
+        raise ContextMissingError(["storyboard"])
+    with open(storyboard_path, "r", encoding="utf-8") as f:
+        shots = parse_shots(f.read())
+    if not shots:
+        raise ValueError("No shots with 画面 descriptions found in storyboard.")
+
+    images_dir = os.path.join(outputs_dir or os.path.dirname(storyboard_path), CONTEXT_TYPE)
+    previous_items = (context_index.get(CONTEXT_TYPE) or {}).get("items", [])
+    items, prompts = plan_illustrations(shots, images_dir, previous_items)
+    input_hashes = {"storyboard": file_hash(storyboard_path)}
+
+    def finish(target: GlobalStateBus, results: dict[str, str]):
+        final = [dict(item) for item in items]
+        for item in final:
+            if item["status"] == "pending":
+                item["status"] = "ready" if results.get(item["prompt_hash"]) == "done" else "failed"
+        status = "ready" if all(item["status"] == "ready" for item in final) else "failed"
+        target.set_context_collection(CONTEXT_TYPE, PRODUCER, DESCRIPTION, images_dir, final, status, input_hashes)
+
+    if not prompts:
+        finish(bus, {})
+        return {"items": items, "jobs": []}
+
+    bus.set_context_collection(CONTEXT_TYPE, PRODUCER, DESCRIPTION, images_dir, items, "pending", input_hashes)
+    results: dict[str, str] = {}
+    lock = threading.Lock()
+
+    def on_done_for(key: str):
+        def on_done(job):
+            with lock:
+                results[key] = job.status
+                last = len(results) == len(prompts)
+            if last:
+                # 回调在后台线程中执行，使用新的 bus 实例读取最新状态
+                finish(GlobalStateBus(bus.path), results)
+        return on_done
+
+    jobs = [
+        pipeline.submit(prompt, os.path.join(images_dir, f"{key}.png"), group=CONTEXT_TYPE, on_done=on_done_for(key))
+        for key, prompt in prompts.items()
+    ]
+    return {"items": items, "jobs": [job.to_dict() for job in jobs]}
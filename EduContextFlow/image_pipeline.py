@@ -0,0 +1,142 @@
+"""
+异步图像渲染管线。
+
+图像 Skill 分两步：提示词步骤（文本模型，较快）在请求内完成并立即返回；
+渲染步骤（image model，较慢）提交到后台线程池，多张插图并发渲染，
+所有请求仍经过 llm.py 中共享的限流器。
+
+渲染状态变化会推送给订阅者，并作为 image 事件发布到 events.BROKER
+（app.py 的 /api/events、/api/images/events 以 SSE 转发给前端）；
+渲染完成后由 image_variants 生成缩略图与压缩格式。
+"""
+
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Callable
+
+import events
+import image_variants
+import tracing
+import usage
+from executor import render_image
+
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+MAX_FINISHED_JOBS = 500  # 内存中最多保留的已结束任务数
+
+
+@dataclass
+class ImageJob:
+    job_id: str
+    prompt: str
+    output_path: str
+    group: str | None = None  # 同一批插图（如某个 storyboard）的分组标识
+    status: str = "queued"  # queued | rendering | done | failed
+    error: str | None = None
+    content_hash: str | None = None  # 登记产出后的内容哈希，前端作为 /outputs 的版本参数
+    created_at: str = field(default_factory=lambda: datetime.now().isoformat())
+    finished_at: str | None = None
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.pop("prompt")
+        return data
+
+
+class ImagePipeline:
+    """后台渲染线程池 + 任务表 + 订阅者队列（线程安全）"""
+
+    def __init__(self, max_workers: int = IMAGE_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="image")
+        self._jobs: dict[str, ImageJob] = {}
+        self._subscribers: list[queue.Queue] = []
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        prompt: str,
+        output_path: str,
+        group: str | None = None,
+        on_done: Callable[[ImageJob], None] | None = None,
+    ) -> ImageJob:
+        """提交渲染任务，立即返回；on_done 在渲染结束（成功或失败）后于后台线程调用"""
+        job = ImageJob(job_id=uuid.uuid4().hex[:12], prompt=prompt, output_path=output_path, group=group)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict()
+        self._publish(job)
+        self._pool.submit(self._render, job, on_done, tracing.current_trace_id(), usage.current_scope())
+        return job
+
+    def _render(self, job: ImageJob, on_done, trace_id: str | None, usage_scope: dict):
+        # 沿用提交请求的 trace_id 与用量归属，渲染耗时与费用可与原请求关联（费用记在任务分组名下）
+        with tracing.trace(trace_id), usage.scope(**usage_scope), usage.scope(skill=job.group):
+            job.status = "rendering"
+            self._publish(job)
+            try:
+                with tracing.span("image_job", job_id=job.job_id, group=job.group):
+                    render_image(job.prompt, job.output_path)
+                job.status = "done"
+                # 缩略图与 WebP / AVIF 版本在后台另行生成
+                image_variants.schedule(job.output_path)
+            except Exception as exc:
+                job.status = "failed"
+                job.error = str(exc)
+            job.finished_at = datetime.now().isoformat()
+            if on_done is not None:
+                try:
+                    on_done(job)
+                except Exception as exc:
+                    tracing.event("image_job", job_id=job.job_id, callback_error=str(exc)[:200])
+            self._publish(job)
+
+    def _evict(self):
+        finished = [j for j in self._jobs.values() if j.finished_at]
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            self._jobs.pop(job.job_id, None)
+
+    def get(self, job_id: str) -> ImageJob | None:
+        return self._jobs.get(job_id)
+
+    def jobs(self, group: str | None = None) -> list[ImageJob]:
+        with self._lock:
+            return [j for j in self._jobs.values() if group is None or j.group == group]
+
+    def subscribe(self) -> queue.Queue:
+        """订阅任务状态变化；每次变化放入一个 job dict"""
+        q: queue.Queue = queue.Queue()
+        with self._lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def _publish(self, job: ImageJob):
+        data = job.to_dict()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            q.put(data)
+        events.BROKER.publish("image", data)
+
+    def wait(self, job_ids: list[str], timeout: float | None = None) -> list[ImageJob]:
+        """阻塞直到指定任务全部结束（CLI / 批量模式使用）"""
+        q = self.subscribe()
+        try:
+            # 先订阅再检查，避免漏掉检查之后才结束的任务
+            pending = {i for i in job_ids if i in self._jobs and not self._jobs[i].finished_at}
+            while pending:
+                data = q.get(timeout=timeout)
+                if data["finished_at"]:
+                    pending.discard(data["job_id"])
+        finally:
+            self.unsubscribe(q)
+        return [self._jobs[i] for i in job_ids if i in self._jobs]
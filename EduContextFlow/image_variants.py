@@ -0,0 +1,171 @@
+"""
+图片产物后处理：渲染完成后在后台生成缩略图与 WebP / AVIF 版本，
+由 /outputs 按 Accept 头协商返回，减少页面载荷。
+
+变体与原图放在同一目录，只生成一次（原图更新后按修改时间判断为过期并重新生成）：
+    shot.png → shot.avif / shot.webp / shot.thumb.avif / shot.thumb.webp / shot.thumb.png
+
+依赖 Pillow；AVIF 需要 Pillow 带有对应编码器，不支持时跳过。
+Pillow 不可用时不生成变体，/outputs 直接返回原图。
+"""
+
+import importlib.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+
+THUMB_SIZE = int(os.getenv("THUMB_SIZE", "320"))  # 缩略图最长边（像素）
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# 按优先级排列：(MIME, 扩展名, Pillow 格式, 质量)
+FORMATS = (
+    ("image/avif", ".avif", "AVIF", 60),
+    ("image/webp", ".webp", "WEBP", 80),
+)
+
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-variants")
+_scheduled: set[str] = set()
+_unsupported: set[str] = set()  # 当前 Pillow 无法编码的格式
+_lock = threading.Lock()
+
+
+def is_image(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def variant_path(path: str, ext: str, thumb: bool = False) -> str:
+    base = os.path.splitext(path)[0]
+    return f"{base}.thumb{ext}" if thumb else f"{base}{ext}"
+
+
+def _fresh(variant: str, original: str) -> bool:
+    try:
+        return os.path.getmtime(variant) >= os.path.getmtime(original)
+    except OSError:
+        return False
+
+
+def _save(image, target: str, fmt: str, **options):
+    # 先写临时文件再替换，避免 /outputs 读到写了一半的变体
+    tmp_path = f"{target}.tmp"
+    try:
+        image.save(tmp_path, format=fmt, **options)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, target)
+
+
+@tracing.traced("image_variants")
+def generate_variants(path: str) -> list[str]:
+    """生成 path 的全部变体，返回写入的文件列表（已是最新的跳过）"""
+    if not PILLOW_AVAILABLE or not os.path.exists(path):
+        return []
+    from PIL import Image
+
+    written = []
+    with Image.open(path) as image:
+        image.load()
+        original_format = image.format or "PNG"
+        thumb = image.copy()
+        thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+        for _, ext, fmt, quality in FORMATS:
+            if fmt in _unsupported:
+                continue
+            for source, is_thumb in ((image, False), (thumb, True)):
+                target = variant_path(path, ext, is_thumb)
+                if _fresh(target, path):
+                    continue
+                try:
+                    _save(source, target, fmt, quality=quality)
+                except (KeyError, ValueError):
+                    # 当前 Pillow 不支持该编码器，之后不再尝试
+                    _unsupported.add(fmt)
+                    break
+                except OSError as exc:
+                    # 磁盘已满、权限等写入错误：本次跳过该格式，下次请求时重新生成
+                    tracing.event("image_variants", path=path, format=fmt, error=str(exc)[:200])
+                    break
+                written.append(target)
+        # 原格式缩略图，供不支持新格式的客户端使用
+        target = variant_path(path, os.path.splitext(path)[1], True)
+        if not _fresh(target, path):
+            _save(thumb, target, original_format)
+            written.append(target)
+    tracing.annotate(path=path, variants=len(written))
+    return written
+
+
+def _run(path: str):
+    try:
+        generate_variants(path)
+    except Exception as exc:
+        tracing.event("image_variants", path=path, error=str(exc)[:200])
+    finally:
+        with _lock:
+            _scheduled.discard(path)
+
+
+def schedule(path: str):
+    """在后台生成变体（同一文件同时只排队一次）"""
+    if not PILLOW_AVAILABLE or not is_image(path):
+        return
+    with _lock:
+        if path in _scheduled:
+            return
+        _scheduled.add(path)
+    _pool.submit(_run, path)
+
+
+def parse_accept(accept: str) -> dict[str, float]:
+    """解析 Accept 头，返回 {媒体类型(小写): q 值}；未写 q 时为 1，无法解析的 q 视为 0"""
+    weights = {}
+    for part in accept.split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        weights[media_type.lower()] = quality
+    return weights
+
+
+def negotiate(path: str, accept: str, thumb: bool = False) -> tuple[str, bool]:
+    """
+    按 Accept 头选择要返回的文件，返回 (文件路径, 是否为最佳版本)。
+
+    只考虑 Accept 中明确列出且 q > 0 的格式（通配符不算，旧客户端也会发送 */*），
+    按 q 值从高到低、q 相同时按 FORMATS 的顺序选择。
+    最佳版本尚未生成时返回当前可用的最好版本（最差为原图），并在后台补生成；
+    调用方据此决定是否允许长期缓存。
+    """
+    weights = parse_accept(accept)
+    ranked = sorted(
+        (-weights[mime], order, ext)
+        for order, (mime, ext, fmt, _) in enumerate(FORMATS)
+        if weights.get(mime, 0) > 0 and fmt not in _unsupported
+    )
+    candidates = [variant_path(path, ext, thumb) for _, _, ext in ranked]
+    if thumb:
+        candidates.append(variant_path(path, os.path.splitext(path)[1], True))
+    if not candidates or not PILLOW_AVAILABLE:
+        return path, True
+    for index, candidate in enumerate(candidates):
+        if _fresh(candidate, path):
+            if index > 0:
+                schedule(path)
+            return candidate, index == 0
+    schedule(path)
+    return path, False
@@ -0,0 +1,127 @@
+"""
+本地意图索引：不调用模型，在 CPU 上毫秒级地给 Skill 打分。
+
+每个 Skill 由若干文档组成（intent_description、名称 + trigger_keywords、每条 example_utterances），
+文档与用户消息都编码为字符 n-gram（1~3）哈希向量，按 IDF 加权并归一化；
+用户消息与全部文档做一次矩阵-向量乘法得到余弦相似度，Skill 的得分取其文档中的最大值。
+
+numpy（requirements.txt 中已列出）可用时向量存为 float64 稠密矩阵；否则退化为纯 Python 的稀疏点积
+（Skill 数量少，同样很快）。两条路径的得分只差浮点舍入，排序一致。
+dispatcher 用它做提示词的候选预筛，以及 LLM 不可用时的启发式路由。
+"""
+
+import importlib.util
+import math
+import os
+import re
+import threading
+import zlib
+from collections import Counter
+
+from skills import Skill
+
+
+EMBED_DIM = int(os.getenv("INTENT_EMBED_DIM", "2048"))  # 哈希桶数
+INTENT_MIN_SCORE = float(os.getenv("INTENT_MIN_SCORE", "0.25"))  # 启发式路由采纳的最低相似度
+NGRAM_SIZES = (1, 2, 3)
+
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+
+_NON_WORD_RE = re.compile(r"[\W_]+")
+
+
+def _features(text: str, dim: int) -> Counter:
+    """字符 n-gram 的哈希桶计数（crc32 在进程间稳定，不受 PYTHONHASHSEED 影响）"""
+    compact = _NON_WORD_RE.sub("", text.lower())
+    counts: Counter = Counter()
+    for n in NGRAM_SIZES:
+        for i in range(len(compact) - n + 1):
+            counts[zlib.crc32(compact[i:i + n].encode("utf-8")) % dim] += 1
+    return counts
+
+
+def _documents(skill: Skill) -> list[str]:
+    docs = [skill.intent_description, " ".join([skill.name.replace("_", " "), *skill.trigger_keywords])]
+    docs.extend(skill.example_utterances)
+    return [doc for doc in docs if doc.strip()]
+
+
+class IntentIndex:
+    def __init__(self, skills: list[Skill], dim: int = EMBED_DIM, dense: bool = NUMPY_AVAILABLE):
+        self.skills = list(skills)
+        self.dim = dim
+        rows: list[Counter] = []
+        owners: list[int] = []  # 每行文档所属 Skill 的下标（同一 Skill 的行连续）
+        for index, skill in enumerate(self.skills):
+            for doc in _documents(skill) or [skill.name]:
+                rows.append(_features(doc, dim))
+                owners.append(index)
+
+        document_frequency: Counter = Counter()
+        for row in rows:
+            document_frequency.update(row.keys())
+        total = len(rows)
+        self._idf = {bucket: math.log((1 + total) / (1 + df)) + 1 for bucket, df in document_frequency.items()}
+        self._default_idf = math.log(1 + total) + 1  # 索引中未出现过的 n-gram
+        self._rows = [self._weigh(row) for row in rows]
+        self._owners = owners
+
+        self._matrix = None
+        if dense:
+            import numpy as np
+
+            self._matrix = np.zeros((len(rows), dim), dtype=np.float64)
+            for i, row in enumerate(self._rows):
+                self._matrix[i, list(row)] = list(row.values())
+            self._row_starts = np.array([owners.index(i) for i in range(len(self.skills))])
+
+    def _weigh(self, counts: Counter) -> dict[int, float]:
+        """对数词频 × IDF，L2 归一化"""
+        vector = {
+            bucket: (1 + math.log(count)) * self._idf.get(bucket, self._default_idf)
+            for bucket, count in counts.items()
+        }
+        norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+        return {bucket: value / norm for bucket, value in vector.items()}
+
+    def embed(self, text: str) -> dict[int, float]:
+        return self._weigh(_features(text, self.dim))
+
+    def scores(self, text: str) -> list[float]:
+        """每个 Skill 的相似度（与 self.skills 顺序一致）"""
+        query = self.embed(text)
+        if not query or not self.skills:
+            return [0.0] * len(self.skills)
+        if self._matrix is not None:
+            import numpy as np
+
+            dense = np.zeros(self.dim, dtype=np.float64)
+            dense[list(query)] = list(query.values())
+            return np.maximum.reduceat(self._matrix @ dense, self._row_starts).tolist()
+        best = [0.0] * len(self.skills)
+        for owner, row in zip(self._owners, self._rows):
+            score = sum(weight * row.get(bucket, 0.0) for bucket, weight in query.items())
+            if score > best[owner]:
+                best[owner] = score
+        return best
+
+    def rank(self, text: str, top_k: int | None = None) -> list[tuple[Skill, float]]:
+        """按相似度降序返回 (Skill, 得分)，得分相同时保持原顺序"""
+        ranked = sorted(zip(self.skills, self.scores(text)), key=lambda item: -item[1])
+        return ranked[:top_k] if top_k else ranked
+
+
+_indexes: dict[tuple[str, ...], IntentIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(skills: list[Skill]) -> IntentIndex:
+    """按 Skill 列表缓存索引（Skill 元数据在进程内不变，只需构建一次）"""
+    key = tuple(skill.name for skill in skills)
+    index = _indexes.get(key)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(key)
+            if index is None:
+                index = _indexes[key] = IntentIndex(skills)
+    return index
@@ -3,15 +3,10 @@
 import os
 from google import genai
 
+from envfile import load_env_file
+
 # 从 .env 加载环境变量
-env_path = ".env"
-if os.path.exists(env_path):
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ[key.strip()] = value.strip()
+load_env_file()
 
 api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
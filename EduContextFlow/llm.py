@@ -1,65 +1,403 @@
+import hashlib
 import json
 import os
-from typing import Any
-
-# 在导入 google.genai 之前设置代理（如果需要）
-# 只有在环境变量 USE_PROXY=true 时才启用代理
-_use_proxy = os.getenv("USE_PROXY", "false").lower() == "true"
-if _use_proxy:
-    _proxy_host = os.getenv("HTTP_PROXY_HOST", "127.0.0.1")
-    _proxy_port = os.getenv("HTTP_PROXY_PORT", "7890")
-    _proxy_url = f"http://{_proxy_host}:{_proxy_port}"
-    
-    os.environ["HTTP_PROXY"] = _proxy_url
-    os.environ["HTTPS_PROXY"] = _proxy_url
-    os.environ["http_proxy"] = _proxy_url
-    os.environ["https_proxy"] = _proxy_url
-    os.environ["ALL_PROXY"] = _proxy_url
-    print(f"🌐 使用代理: {_proxy_url}")
-else:
-    print("🌐 直连模式（不使用代理）")
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+import metrics
+import tracing
+import usage
+
+
+_proxy_configured = False
+
+
+def configure_proxy():
+    """
+    按环境变量设置代理（USE_PROXY=true 时启用），需在创建 genai.Client 之前调用。
+
+    首次创建客户端时才执行，导入本模块不修改环境变量、不输出信息。
+    """
+    global _proxy_configured
+    if _proxy_configured:
+        return
+    _proxy_configured = True
+    if os.getenv("USE_PROXY", "false").lower() != "true":
+        print("🌐 直连模式（不使用代理）")
+        return
+    proxy_host = os.getenv("HTTP_PROXY_HOST", "127.0.0.1")
+    proxy_port = os.getenv("HTTP_PROXY_PORT", "7890")
+    proxy_url = f"http://{proxy_host}:{proxy_port}"
+    for key in ("HTTP_PROXY", "HTTPS_PROXY", "http_proxy", "https_proxy", "ALL_PROXY"):
+        os.environ[key] = proxy_url
+    print(f"🌐 使用代理: {proxy_url}")
+
+
+class RateLimiter:
+    """
+    进程内共享的令牌桶限流器（按每分钟请求数）。
+
+    所有 LLMClient 实例的每次 API 尝试（含重试）都先 acquire()，
+    多线程批量生成时总请求速率不会超过上限。rpm <= 0 表示不限流。
+    """
+
+    def __init__(self, rpm: float = 0):
+        self._lock = threading.Lock()
+        self.configure(rpm)
+
+    def configure(self, rpm: float):
+        with self._lock:
+            self.rpm = rpm
+            self._capacity = max(1.0, rpm / 60) if rpm > 0 else 0
+            self._tokens = self._capacity
+            self._updated = time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self.rpm <= 0:
+                    return
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self.rpm / 60)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * 60 / self.rpm
+            time.sleep(wait)
+
+
+RATE_LIMITER = RateLimiter(float(os.getenv("LLM_MAX_RPM", "0")))
+
+# genai.Client 按 api_key 在进程内共享（线程安全），避免每次调用重建连接
+_shared_clients: dict[str, Any] = {}
+_shared_clients_lock = threading.Lock()
+
+
+def set_rate_limit(rpm: float):
+    """设置全局 LLM 请求速率上限（每分钟请求数，0 为不限）"""
+    RATE_LIMITER.configure(rpm)
+
+
+# 显式上下文缓存：稳定的长前缀（Dispatcher 规则、Skill 指令 + 上游产出）登记一次，之后按名称引用
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "true").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", "600"))  # 秒
+CONTEXT_CACHE_MIN_CHARS = int(os.getenv("CONTEXT_CACHE_MIN_CHARS", "2000"))  # 更短的前缀不值得缓存
+CACHE_REFRESH_MARGIN = 30  # 剩余有效期不足该秒数时重新登记，避免请求途中过期
+
+
+class ContextCache:
+    """
+    进程内的缓存登记表：(api_key, model, 前缀哈希) → 服务端缓存名与过期时间。
+
+    缓存按模型区分，且只能作为请求的开头部分；登记失败（前缀低于模型的最小 token 数、
+    模型不支持等）同样记录一个 TTL，期间直接内联发送，不反复尝试。
+    非 eager 的前缀（Skill 指令 + 上游产出，多数只用一次）首次出现时只记下，TTL 内再次出现才登记，
+    避免为不会复用的前缀多付一次往返与缓存存储。过期的登记在 lookup 时清理。
+    """
+
+    def __init__(self):
+        self._entries: dict[tuple, dict] = {}
+        self._key_locks: dict[tuple, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(api_key: str, model: str, prefix: str) -> tuple:
+        return api_key, model, hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+
+    def lookup(self, client, key: tuple, prefix: str, eager: bool = False) -> tuple[str | None, str]:
+        """
+        返回 (缓存名, 结果)；结果为 hit | created | unavailable | first_use，缓存名为 None 时需内联发送前缀。
+
+        eager=True 时首次使用即登记（Dispatcher 规则这类每次请求都相同的前缀）。
+        """
+        with self._lock:
+            self._prune(time.time())
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        # 同一前缀并发请求时只登记一次
+        with key_lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            live = entry is not None and entry["expires_at"] - CACHE_REFRESH_MARGIN > now
+            if live and not entry.get("seen_only"):
+                return entry["name"], "hit" if entry["name"] else "unavailable"
+            if not live and not eager:
+                self._entries[key] = {"name": None, "seen_only": True, "expires_at": now + CONTEXT_CACHE_TTL}
+                return None, "first_use"
+            try:
+                name = _create_cache(client, key[1], prefix)
+                outcome = "created"
+            except Exception as exc:
+                tracing.event("context_cache", model=key[1], error=str(exc)[:200])
+                name, outcome = None, "unavailable"
+            self._entries[key] = {"name": name, "expires_at": time.time() + CONTEXT_CACHE_TTL}
+            return name, outcome
+
+    def _prune(self, now: float):
+        # 调用方持有 self._lock；其他线程正在使用的键保留
+        for key in [k for k, entry in self._entries.items() if entry["expires_at"] <= now]:
+            lock = self._key_locks.get(key)
+            if lock is None or not lock.locked():
+                self._entries.pop(key, None)
+                self._key_locks.pop(key, None)
+
+    def forget(self, key: tuple):
+        """服务端缓存已失效（被删除或提前过期）时移除登记"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def _create_cache(client, model: str, prefix: str) -> str:
+    from google.genai import types
+
+    # 登记缓存同样是一次 API 请求，计入全局速率限制
+    RATE_LIMITER.acquire()
+    cache = client.caches.create(
+        model=model,
+        config=types.CreateCachedContentConfig(contents=[prefix], ttl=f"{CONTEXT_CACHE_TTL}s"),
+    )
+    return cache.name
+
+
+def _is_cache_error(error: str) -> bool:
+    return "cachedContent" in error or "CachedContent" in error or "cached content" in error.lower()
+
+
+CONTEXT_CACHES = ContextCache()
+
+
+# ==================== 批量接口（离线模式） ====================
+
+# gemini：服务端批量作业（按批量单价计费，通常在 24 小时内完成）；local：本地替身
+LLM_BATCH_BACKEND = os.getenv("LLM_BATCH_BACKEND", "gemini")
+BATCH_RUNNING_STATES = ("JOB_STATE_PENDING", "JOB_STATE_QUEUED", "JOB_STATE_RUNNING")
+LOCAL_BATCH_PREFIX = "local-batches/"
+
+
+@dataclass
+class BatchResult:
+    text: str | None = None  # None 表示该请求失败
+    error: str | None = None
+    tokens: dict[str, int] = field(default_factory=dict)
+
+
+class LocalBatchBackend:
+    """
+    批量接口的本地替身（测试、或没有批量接口权限时使用）：
+    提交后在一个后台线程中逐条调用 LLMClient.complete，轮询语义与服务端作业一致。
+    作业只保存在内存中，进程重启后轮询会报错，由调用方重新提交。
+    """
+
+    def __init__(self):
+        self._jobs: dict[str, list[BatchResult] | None] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, prompts: list[str], tier: str) -> str:
+        name = f"{LOCAL_BATCH_PREFIX}{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._jobs[name] = None
+        threading.Thread(target=self._run, args=(name, prompts, tier), name="local-batch", daemon=True).start()
+        return name
+
+    def _run(self, name: str, prompts: list[str], tier: str):
+        llm = LLMClient()
+        results = []
+        for prompt in prompts:
+            try:
+                results.append(BatchResult(text=llm.complete(prompt, tier=tier)))
+            except Exception as exc:
+                results.append(BatchResult(error=str(exc)))
+        with self._lock:
+            self._jobs[name] = results
+
+    def poll(self, name: str) -> list[BatchResult] | None:
+        with self._lock:
+            if name not in self._jobs:
+                raise RuntimeError(f"Unknown batch job: {name}")
+            return self._jobs[name]
+
+
+LOCAL_BATCH = LocalBatchBackend()
+
+
+def _submit_gemini_batch(client, model: str, prompts: list[str]) -> str:
+    job = client.batches.create(
+        model=model,
+        src=[{"contents": [{"role": "user", "parts": [{"text": prompt}]}]} for prompt in prompts],
+        config={"display_name": f"educontextflow-{uuid.uuid4().hex[:8]}"},
+    )
+    return job.name
+
+
+def _poll_gemini_batch(client, name: str) -> list[BatchResult] | None:
+    job = client.batches.get(name=name)
+    state = getattr(job.state, "name", str(job.state))
+    if state in BATCH_RUNNING_STATES:
+        return None
+    if state != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {name} finished with {state}: {getattr(job, 'error', None)}")
+    results = []
+    for item in job.dest.inlined_responses:
+        if getattr(item, "error", None):
+            results.append(BatchResult(error=str(item.error)))
+        else:
+            results.append(BatchResult(text=item.response.text or "", tokens=_usage_tokens(item.response)))
+    return results
+
+
+def _is_overloaded(error: str) -> bool:
+    """服务端过载（503），换用其他模型通常立即可用；429 限流则需要等待"""
+    return any(code in error for code in ["503", "UNAVAILABLE", "overloaded"])
 
 
 class LLMClient:
+    """
+    文本模型分两档：fast（路由等短小的结构化决策）与 strong（长文本 Skill），
+    由调用方按 tier 选择。主模型过载（503）时不等待，直接改用该档位的备用模型重试
+    （strong → fallback_model，fast → fast_fallback_model，备用模型与主模型不同才有意义）。
+
+    每次成功的调用按当前用量归属记账（usage.record）；会话超出预算时降级到 fast 或拒绝调用。
+    调用方给出 cached_prefix 时，稳定的前缀通过显式上下文缓存复用（见 ContextCache）。
+    """
+
     def __init__(self):
         self.api_key = os.getenv("GEMINI_API_KEY")
         self.text_model = os.getenv("GEMINI_TEXT_MODEL", "gemini-2.5-flash")
+        self.fast_model = os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash-lite")
+        self.fallback_model = os.getenv("GEMINI_FALLBACK_MODEL", self.fast_model)
+        self.fast_fallback_model = os.getenv("GEMINI_FAST_FALLBACK_MODEL", "gemini-2.0-flash-lite")
         self.image_model = os.getenv("GEMINI_IMAGE_MODEL", "gemini-2.5-flash-image")
         self._client = None
 
+    def model_for(self, tier: str) -> str:
+        return self.fast_model if tier == "fast" else self.text_model
+
+    def fallback_for(self, tier: str) -> str:
+        return self.fast_fallback_model if tier == "fast" else self.fallback_model
+
     def _get_client(self):
         if not self.api_key:
             raise RuntimeError("GEMINI_API_KEY is not set.")
         if self._client is None:
-            from google import genai
+            with _shared_clients_lock:
+                if self.api_key not in _shared_clients:
+                    configure_proxy()
+                    # 延迟导入：只在实际调用模型时才加载 google.genai
+                    from google import genai
 
-            self._client = genai.Client(api_key=self.api_key)
+                    _shared_clients[self.api_key] = genai.Client(api_key=self.api_key)
+                self._client = _shared_clients[self.api_key]
         return self._client
 
-    def complete(self, prompt: str) -> str:
-        import time
-        
+    def _cached_content(
+        self, client, model: str, cached_prefix: str | None, eager: bool = False
+    ) -> tuple[tuple | None, str | None]:
+        """为前缀取得（必要时登记）显式缓存，返回 (登记键, 缓存名)；不适用时均为 None"""
+        if not (CONTEXT_CACHE and cached_prefix and len(cached_prefix) >= CONTEXT_CACHE_MIN_CHARS):
+            return None, None
+        key = ContextCache.key(self.api_key, model, cached_prefix)
+        name, outcome = CONTEXT_CACHES.lookup(client, key, cached_prefix, eager)
+        metrics.CONTEXT_CACHE_LOOKUPS.inc(model=model, outcome=outcome)
+        return key, name
+
+    def complete(
+        self,
+        prompt: str,
+        tier: str = "strong",
+        cached_prefix: str | None = None,
+        response_schema: dict | None = None,
+        on_chunk: Callable[[str], bool] | None = None,
+        cache_eagerly: bool = False,
+    ) -> str:
+        """
+        生成文本。实际发送的内容为 cached_prefix + prompt：
+        cached_prefix 足够长时登记为显式上下文缓存并按名称引用，否则与 prompt 拼接后内联发送。
+        默认同一前缀第二次出现时才登记；cache_eagerly=True 时首次使用即登记（每次请求都相同的前缀）。
+
+        response_schema：要求模型按该 schema 输出 JSON（response_mime_type=application/json）。
+        on_chunk：改为流式生成，逐块回调；回调返回 True 时停止接收，返回已收到的文本。
+        已开始回调后的失败不再重试（调用方已处理过部分输出）。
+        """
         client = self._get_client()
+        tier = usage.apply_budget(tier)
+        model = self.model_for(tier)
+        fallback = self.fallback_for(tier)
         last_error = None
-        
-        # 最多重试 3 次
+        wait = True
+        use_cache = True
+        streamed = []  # 已交给 on_chunk 的文本块
+
+        # 最多尝试 3 次
         for attempt in range(3):
             try:
-                if attempt > 0:
+                if attempt > 0 and wait:
                     # 指数退避：2秒、4秒
                     wait_time = 2 * attempt
                     print(f"⏳ API 繁忙，等待 {wait_time} 秒后重试（第 {attempt + 1} 次）...")
                     time.sleep(wait_time)
-                
-                response = client.models.generate_content(
-                    model=self.text_model,
-                    contents=prompt,
+                wait = True
+
+                cache_key, cache_name = (
+                    self._cached_content(client, model, cached_prefix, cache_eagerly) if use_cache else (None, None)
                 )
-                return response.text or ""
+                RATE_LIMITER.acquire()
+                metrics.LLM_ATTEMPTS.inc(kind="text", model=model)
+                started = time.perf_counter()
+                with tracing.span(
+                    "llm.attempt",
+                    model=model,
+                    tier=tier,
+                    attempt=attempt + 1,
+                    prompt_bytes=len(prompt) + len(cached_prefix or ""),
+                    cached_content=cache_name,
+                ) as s:
+                    request = {
+                        "model": model,
+                        "contents": prompt if cache_name else (cached_prefix or "") + prompt,
+                    }
+                    config = _generation_config(cache_name, response_schema)
+                    if config is not None:
+                        request["config"] = config
+                    if on_chunk is None:
+                        response = client.models.generate_content(**request)
+                        text = response.text or ""
+                    else:
+                        text, response, partial = _consume_stream(
+                            client.models.generate_content_stream(**request), on_chunk, streamed
+                        )
+                    s["output_bytes"] = len(text)
+                    tokens = _usage_tokens(response)
+                    s.update(tokens, partial_usage=partial)
+                latency = time.perf_counter() - started
+                metrics.LLM_LATENCY.observe(latency, kind="text", model=model)
+                usage.record("text", model, tokens, latency, partial=partial)
+                return text
             except Exception as exc:
                 last_error = exc
                 error_str = str(exc)
-                
+                metrics.LLM_ERRORS.inc(kind="text", model=model, code=metrics.error_code(exc))
+                if streamed:
+                    raise
+
+                # 引用的缓存已失效：移除登记，本次改为内联发送，不等待
+                if cache_name and _is_cache_error(error_str) and attempt < 2:
+                    CONTEXT_CACHES.forget(cache_key)
+                    metrics.CONTEXT_CACHE_LOOKUPS.inc(model=model, outcome="invalidated")
+                    use_cache = False
+                    wait = False
+                    continue
+
+                # 过载（503）且有备用模型：立即切换，不等待
+                if _is_overloaded(error_str) and fallback and fallback != model and attempt < 2:
+                    print(f"⚡ {model} 过载，改用 {fallback} 重试")
+                    metrics.LLM_FALLBACKS.inc(kind="text", from_model=model, to_model=fallback)
+                    model = fallback
+                    wait = False
+                    continue
+
                 # 如果是可重试的错误（503 过载、429 限流等），继续重试
                 if any(code in error_str for code in ["503", "429", "UNAVAILABLE", "RESOURCE_EXHAUSTED"]):
                     if attempt < 2:  # 还有重试机会
@@ -69,14 +407,34 @@ class LLMClient:
                 else:
                     # 其他错误直接抛出
                     raise
-        
+
         # 所有重试都失败
         raise RuntimeError(f"API 调用失败：{last_error}")
 
-    def generate_image(self, prompt: str, output_path: str) -> None:
-        import time
+    def submit_batch(self, prompts: list[str], tier: str = "strong") -> str:
+        """
+        以一个批量作业提交多条互相独立的文本请求，立即返回作业名；结果用 poll_batch 取得。
+
+        不做重试与模型降级：作业级失败由调用方处理（重新提交或标记失败）。
+        """
+        model = self.model_for(tier)
+        metrics.LLM_ATTEMPTS.inc(len(prompts), kind="batch", model=model)
+        with tracing.span("llm.batch_submit", model=model, tier=tier, requests=len(prompts)):
+            if LLM_BATCH_BACKEND == "local":
+                return LOCAL_BATCH.submit(prompts, tier)
+            RATE_LIMITER.acquire()
+            return _submit_gemini_batch(self._get_client(), model, prompts)
+
+    def poll_batch(self, name: str) -> list[BatchResult] | None:
+        """作业仍在进行时返回 None；完成后按提交顺序返回每条请求的结果"""
+        if name.startswith(LOCAL_BATCH_PREFIX):
+            return LOCAL_BATCH.poll(name)
+        RATE_LIMITER.acquire()
+        return _poll_gemini_batch(self._get_client(), name)
 
+    def generate_image(self, prompt: str, output_path: str) -> None:
         client = self._get_client()
+        usage.apply_budget("strong")
         last_error = None
 
         for attempt in range(3):
@@ -86,18 +444,31 @@ class LLMClient:
                     print(f"⏳ 图像 API 繁忙，等待 {wait_time} 秒后重试（第 {attempt + 1} 次）...")
                     time.sleep(wait_time)
 
-                response = client.models.generate_images(
+                RATE_LIMITER.acquire()
+                metrics.LLM_ATTEMPTS.inc(kind="image", model=self.image_model)
+                started = time.perf_counter()
+                with tracing.span(
+                    "llm.image_attempt",
                     model=self.image_model,
-                    prompt=prompt,
-                )
-                images = getattr(response, "generated_images", None) or []
-                if not images:
-                    raise RuntimeError("No image returned by model.")
-                images[0].image.save(output_path)
+                    attempt=attempt + 1,
+                    prompt_bytes=len(prompt),
+                ):
+                    response = client.models.generate_images(
+                        model=self.image_model,
+                        prompt=prompt,
+                    )
+                    images = getattr(response, "generated_images", None) or []
+                    if not images:
+                        raise RuntimeError("No image returned by model.")
+                    images[0].image.save(output_path)
+                latency = time.perf_counter() - started
+                metrics.LLM_LATENCY.observe(latency, kind="image", model=self.image_model)
+                usage.record("image", self.image_model, {}, latency, images=1)
                 return
             except Exception as exc:
                 last_error = exc
                 error_str = str(exc)
+                metrics.LLM_ERRORS.inc(kind="image", model=self.image_model, code=metrics.error_code(exc))
                 
                 # 可重试的错误：连接问题、503、429 等
                 if any(keyword in error_str for keyword in [
@@ -115,19 +486,126 @@ class LLMClient:
         raise RuntimeError(f"图像生成失败：{last_error}")
 
 
-def parse_json(text: str) -> dict[str, Any] | None:
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        pass
-    if not text:
+def _generation_config(cache_name: str | None, response_schema: dict | None):
+    if not cache_name and not response_schema:
         return None
-    start = text.find("{")
-    end = text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        return None
-    snippet = text[start : end + 1]
+    from google.genai import types
+
+    options = {}
+    if cache_name:
+        options["cached_content"] = cache_name
+    if response_schema:
+        options["response_mime_type"] = "application/json"
+        options["response_schema"] = response_schema
+    return types.GenerateContentConfig(**options)
+
+
+def _consume_stream(stream, on_chunk: Callable[[str], bool], streamed: list[str]) -> tuple[str, Any, bool]:
+    """
+    逐块读取流式响应并回调，返回 (文本, 最后一块, 是否提前停止)；用量信息取自最后收到的一块。
+
+    on_chunk 返回 True 时提前停止接收：此时最后一块的 usage_metadata 只统计到该块为止
+    （或缺失输出计数），而服务端在连接关闭前可能已生成更多 token，记账的输出 token 偏低。
+    """
+    last = None
+    stopped = False
     try:
-        return json.loads(snippet)
-    except json.JSONDecodeError:
-        return None
+        for chunk in stream:
+            last = chunk
+            delta = chunk.text or ""
+            if not delta:
+                continue
+            streamed.append(delta)
+            if on_chunk(delta):
+                stopped = True
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    return "".join(streamed), last, stopped
+
+
+def _usage_tokens(response) -> dict[str, int]:
+    """
+    从响应的 usage_metadata 中提取 token 数（字段缺失时忽略）。
+
+    response 为提前停止的流式响应的中间块时，output_tokens 只是下限（见 _consume_stream），
+    调用方以 partial=True 记账。
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return {}
+    tokens = {}
+    for key, field in (
+        ("prompt_tokens", "prompt_token_count"),
+        ("output_tokens", "candidates_token_count"),
+        ("cached_tokens", "cached_content_token_count"),
+        ("thoughts_tokens", "thoughts_token_count"),
+    ):
+        value = getattr(usage, field, None)
+        if isinstance(value, int):
+            tokens[key] = value
+    return tokens
+
+
+class JsonObjectStream:
+    """
+    增量解析一个 JSON 对象的顶层字段。
+
+    feed() 接收流式输出的文本块，只扫描新到达的字符（跟踪字符串、转义与嵌套深度）；
+    某个顶层字段的值结束（遇到同层的 , 或 }）时立即解析并放入 fields，
+    调用方不必等整个对象输出完毕。对象开始之前的字符被忽略。
+    """
+
+    def __init__(self):
+        self.fields: dict[str, Any] = {}
+        self.done = False
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: str | None = None  # 对象层最近一个完整的字符串（冒号前即为字段名）
+        self._key: str | None = None
+        self._value_start: int | None = None
+
+    def feed(self, chunk: str) -> dict[str, Any]:
+        """返回本次新完成的字段"""
+        self._text += chunk
+        completed = {}
+        text = self._text
+        for i in range(self._pos, len(text)):
+            if self.done:
+                break
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._value_start is None:
+                        self._last_string = json.loads(text[self._string_start:i + 1])
+                continue
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                self._depth += 1
+            elif char == ":" and self._depth == 1 and self._value_start is None:
+                self._key, self._value_start = self._last_string, i + 1
+            elif char in ",}" and self._depth == 1:
+                if self._value_start is not None and self._key is not None:
+                    value = json.loads(text[self._value_start:i])
+                    self.fields[self._key] = completed[self._key] = value
+                self._key = self._value_start = None
+                if char == "}":
+                    self._depth = 0
+                    self.done = True
+            elif char in "}]":
+                self._depth -= 1
+        self._pos = len(text)
+        return completed
@@ -1,10 +1,33 @@
 import argparse
+import os
 import sys
 
+from envfile import load_env_file
+
+# 先加载 .env，再导入在导入时读取环境变量的模块
+load_env_file()
+
+import tracing
+import usage
+from batch import BATCH_POLL_SECONDS, REPORT_FILENAME, print_report, run_batch, run_batch_offline
 from bus import GlobalStateBus
 from dispatcher import dispatch
 from executor import execute_skill
-from skills import SKILLS, skill_by_name
+from illustrations import illustrate_storyboard
+from image_pipeline import IMAGE_WORKERS, ImagePipeline
+from llm import set_rate_limit
+from runner import (
+    ContextMissingError,
+    WorkflowRunActiveError,
+    _prepare_skill_input,
+    patch_skill_output,
+    rebuild_stale,
+    record_skill_output,
+    recover_interrupted,
+    resume_workflow,
+    run_workflow,
+)
+from skills import SKILLS, SKILL_OUTPUT_TYPES, skill_by_name
 
 
 def _read_input(args: argparse.Namespace) -> str:
@@ -15,6 +38,25 @@ def _read_input(args: argparse.Namespace) -> str:
     raise ValueError("No user input provided.")
 
 
+def _print_usage(totals: dict):
+    print(f"{'scope':<36}{'calls':>7}{'prompt':>10}{'cached':>10}{'output':>10}{'cost($)':>10}")
+    rows = [("session", totals["session"])]
+    rows += [(f"skill:{name}", t) for name, t in totals["skills"].items()]
+    rows += [(f"run:{run_id[:8]}", t) for run_id, t in totals["workflow_runs"].items()]
+    for name, t in rows:
+        print(
+            f"{name:<36}{t['calls']:>7}{t['prompt_tokens']:>10}{t['cached_tokens']:>10}"
+            f"{t['output_tokens'] + t['thoughts_tokens']:>10}{t['cost_usd']:>10.4f}"
+        )
+    partial = totals["session"].get("partial_calls", 0)
+    if partial:
+        print(f"Note: {partial} streamed call(s) stopped early; their output tokens and cost are lower bounds")
+    budget = usage.budget_config()
+    if budget["usd"] or budget["tokens"]:
+        state = "exceeded" if usage.over_budget(totals["session"]) else "ok"
+        print(f"Budget: ${budget['usd']:g} / {budget['tokens']} tokens ({budget['action']}), {state}")
+
+
 def run():
     parser = argparse.ArgumentParser(description="LLM dispatcher MVP")
     parser.add_argument("--text", help="User input text")
@@ -33,10 +75,128 @@ def run():
         default="outputs",
         help="Outputs directory",
     )
+    parser.add_argument(
+        "--batch",
+        help="Course manifest (JSONL or CSV) to run course_production_workflow for each course",
+    )
+    parser.add_argument(
+        "--batch-dir",
+        help="Batch output directory (default: batches/<manifest name>); re-use it to resume",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent courses in batch mode")
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="Run --batch through the provider batch API (set LLM_BATCH_BACKEND=local for the local stand-in)",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=BATCH_POLL_SECONDS,
+        help="Seconds between batch job status checks with --batch-api",
+    )
+    parser.add_argument("--rpm", type=float, help="Max LLM requests per minute shared by all workers")
+    parser.add_argument(
+        "--rebuild-stale",
+        action="store_true",
+        help="Re-run only stale downstream skills in dependency order",
+    )
+    parser.add_argument(
+        "--illustrate",
+        action="store_true",
+        help="Render an illustration for every shot in the storyboard",
+    )
+    parser.add_argument(
+        "--image-workers",
+        type=int,
+        default=IMAGE_WORKERS,
+        help="Concurrent image renders for --illustrate",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted workflow from its last checkpoint",
+    )
+    parser.add_argument(
+        "--usage",
+        action="store_true",
+        help="Print LLM token usage and estimated cost of the session",
+    )
     args = parser.parse_args()
 
-    user_message = _read_input(args)
+    if args.rpm is not None:
+        set_rate_limit(args.rpm)
+
+    if args.batch:
+        batch_dir = args.batch_dir or os.path.join(
+            "batches", os.path.splitext(os.path.basename(args.batch))[0]
+        )
+        if args.batch_api:
+            report = run_batch_offline(args.batch, batch_dir, poll_interval=args.poll_interval)
+        else:
+            report = run_batch(args.batch, batch_dir, workers=args.workers)
+        print_report(report)
+        print(f"Report: {os.path.join(batch_dir, REPORT_FILENAME)}")
+        return
+
     bus = GlobalStateBus(args.state_path)
+    # 本次命令中的 LLM 调用都计入该会话（进程结束即退出，无需复位）
+    usage.begin(args.state_path)
+    interrupted = recover_interrupted(bus)
+
+    if args.usage:
+        _print_usage(bus.get_usage())
+        return
+
+    if args.resume:
+        try:
+            steps = resume_workflow(bus)
+        except WorkflowRunActiveError as exc:
+            print(str(exc))
+            return
+        if steps is None:
+            print("No interrupted workflow to resume.")
+        for step in steps or []:
+            print(f"{step['step']}: {step['status']} -> {step['ref']}")
+        return
+
+    if interrupted:
+        done = len(interrupted["completed_steps"])
+        print(
+            f"Interrupted workflow {interrupted['workflow']} found "
+            f"({done} step(s) completed); run with --resume to continue."
+        )
+
+    if args.illustrate:
+        pipeline = ImagePipeline(max_workers=args.image_workers)
+        try:
+            result = illustrate_storyboard(bus, pipeline, args.outputs_dir)
+        except (ContextMissingError, ValueError) as exc:
+            print(str(exc))
+            return
+        jobs = pipeline.wait([job["job_id"] for job in result["jobs"]])
+        failed = [job for job in jobs if job.status == "failed"]
+        reused = sum(1 for item in result["items"] if item["status"] == "ready")
+        print(
+            f"{len(result['items'])} shots, {len(jobs)} rendered, "
+            f"{len(result['items']) - len(jobs) - reused} deduplicated, {reused} reused, {len(failed)} failed"
+        )
+        for job in failed:
+            print(f"- {job.output_path}: {job.error}")
+        return
+
+    if args.rebuild_stale:
+        results = rebuild_stale(bus)
+        if not results:
+            print("Nothing to rebuild.")
+        for item in results:
+            line = f"{item['context_type']}: {item['status']}"
+            if item.get("reason"):
+                line += f" ({item['reason']})"
+            print(line)
+        return
+
+    user_message = _read_input(args)
     state = bus.get_state()
 
     result = dispatch(
@@ -58,19 +218,30 @@ def run():
         bus.set_stage("skill_selected")
         bus.set_selected_skill(skill.name)
         bus.mark_skill_running(skill.name)
+        context_index = state.get("context_index", {})
+        try:
+            skill_input = _prepare_skill_input(skill, user_message, context_index)
+        except ContextMissingError as exc:
+            bus.mark_skill_error(skill.name)
+            print(str(exc))
+            return
         try:
-            output_path = execute_skill(skill, user_message)
+            if skill.skill_type == "workflow":
+                steps = run_workflow(bus, skill, user_message, args.outputs_dir)
+                print(f"Workflow done. Outputs: {', '.join(step['ref'] for step in steps)}")
+                return
+            output_path = patch_skill_output(bus, skill, user_message, context_index)
+            stale = []
+            if output_path is None:
+                output_path = execute_skill(skill, skill_input)
+                stale = record_skill_output(bus, skill, output_path, context_index)
         except Exception as exc:
-            # 简化版：根据 skill.output_type 推断 output_type
-            output_type = skill.output_type if hasattr(skill, 'output_type') else "unknown"
-            bus.mark_skill_error(skill.name, output_type)
+            bus.mark_skill_error(skill.name, SKILL_OUTPUT_TYPES.get(skill.name))
             print(f"Skill execution failed: {exc}")
             return
-        # 简化版：使用 skill 的基本信息
-        output_type = skill.output_type if hasattr(skill, 'output_type') else "unknown"
-        description = skill.description if hasattr(skill, 'description') else skill.name
-        bus.mark_skill_done(skill.name, output_path, output_type, description)
         print(f"Skill done. Output: {output_path}")
+        if stale:
+            print(f"Stale downstream: {', '.join(stale)} (run with --rebuild-stale)")
         return
 
     if action == "ask_user":
@@ -91,4 +262,5 @@ def run():
 
 
 if __name__ == "__main__":
-    run()
+    with tracing.trace():
+        run()
@@ -0,0 +1,208 @@
+"""
+进程内指标注册表，按 Prometheus 文本格式（0.0.4）导出，由 app.py 的 /metrics 暴露。
+
+只实现 Counter / Gauge / Histogram 三种类型，不引入额外依赖。
+"""
+
+import bisect
+import threading
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+_REGISTRY: list["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = super().render()
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}  # key -> [bucket_counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[2] if series else 0
+
+    def render(self):
+        lines = super().render()
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ==================== 指标定义 ====================
+
+HTTP_REQUESTS = Counter(
+    "educontextflow_http_requests_total", "HTTP requests by endpoint and status.",
+    ("endpoint", "method", "status"),
+)
+HTTP_LATENCY = Histogram(
+    "educontextflow_http_request_seconds", "HTTP request latency.", ("endpoint",),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "educontextflow_http_requests_in_flight", "Requests currently being handled.",
+)
+
+LLM_ATTEMPTS = Counter(
+    "educontextflow_llm_attempts_total", "LLM API attempts, including retries.", ("kind", "model"),
+)
+LLM_ERRORS = Counter(
+    "educontextflow_llm_errors_total", "Failed LLM API attempts by error code.", ("kind", "model", "code"),
+)
+LLM_LATENCY = Histogram(
+    "educontextflow_llm_latency_seconds", "Latency of a single LLM API attempt.", ("kind", "model"),
+)
+LLM_FALLBACKS = Counter(
+    "educontextflow_llm_fallbacks_total", "Switches to the fallback model after an overload (503).",
+    ("kind", "from_model", "to_model"),
+)
+CONTEXT_CACHE_LOOKUPS = Counter(
+    "educontextflow_context_cache_lookups_total",
+    "Explicit context cache lookups by outcome (hit, created, unavailable, invalidated).",
+    ("model", "outcome"),
+)
+LLM_TOKENS = Counter(
+    "educontextflow_llm_tokens_total", "Tokens reported by successful LLM calls.", ("kind", "model", "type"),
+)
+LLM_COST = Counter(
+    "educontextflow_llm_cost_usd_total", "Estimated cost of successful LLM calls (USD).", ("kind", "model"),
+)
+
+DISPATCH_OUTCOMES = Counter(
+    "educontextflow_dispatch_outcomes_total",
+    "Dispatcher decisions by source (llm, heuristic, validation_override).",
+    ("outcome", "action"),
+)
+
+SKILL_DURATION = Histogram(
+    "educontextflow_skill_duration_seconds", "execute_skill duration per skill.", ("skill",),
+)
+SKILL_OUTPUT_BYTES = Histogram(
+    "educontextflow_skill_output_bytes", "Size of skill output files.", ("skill",), buckets=SIZE_BUCKETS,
+)
+
+SPECULATION_OUTCOMES = Counter(
+    "educontextflow_speculation_outcomes_total",
+    "Speculative pre-generations by outcome (scheduled, hit, discarded).",
+    ("outcome", "skill"),
+)
+
+BUS_PERSISTS = Counter(
+    "educontextflow_bus_persists_total", "GlobalStateBus persist operations.",
+)
+BUS_PERSIST_SECONDS = Histogram(
+    "educontextflow_bus_persist_seconds", "GlobalStateBus persist duration.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+
+
+def error_code(exc: BaseException) -> str:
+    """把 LLM 异常归类为 429 / 503 / other"""
+    text = str(exc)
+    if "429" in text or "RESOURCE_EXHAUSTED" in text:
+        return "429"
+    if "503" in text or "UNAVAILABLE" in text or "overloaded" in text:
+        return "503"
+    return "other"
@@ -0,0 +1,472 @@
+import hashlib
+import os
+
+import tracing
+import usage
+from bus import GlobalStateBus
+from executor import execute_patch, execute_skill
+from sections import find_target_sections, split_sections
+from skills import (
+    SKILL_DESCRIPTIONS,
+    SKILL_OUTPUT_TYPES,
+    Skill,
+    SkillInput,
+    downstream_context_types,
+    skill_by_name,
+    topological_context_order,
+)
+
+
+MAX_CONTEXT_CHARS = 8000
+
+# 重建时没有新的用户输入，使用固定说明让 Skill 基于更新后的上游重新生成
+REBUILD_INSTRUCTION = "上游内容已更新，请基于最新的上下文重新生成完整内容。"
+
+
+class ContextMissingError(RuntimeError):
+    def __init__(self, missing_types: list[str]):
+        self.missing_types = missing_types
+        missing = ", ".join(sorted(set(missing_types)))
+        super().__init__(f"上下文文件缺失或读取失败：{missing}")
+
+
+class WorkflowRunActiveError(RuntimeError):
+    def __init__(self, run: dict):
+        self.run = run
+        owner = run.get("owner") or {}
+        super().__init__(
+            f"工作流 {run['workflow']} 正在其他进程中执行（pid {owner.get('pid')}@{owner.get('host')}），不能续跑"
+        )
+
+
+def _log_context_trace(message: str):
+    """
+    记录上下文链路追踪日志（用于排查“断层/未注入/吐提示词”问题）。
+
+    作为 context 事件写入 tracing 的 JSONL，携带当前请求的 trace_id。
+    """
+    tracing.event("context", message=message.rstrip())
+
+
+def file_hash(path: str) -> str | None:
+    """计算文件内容的 sha256；文件不存在时返回 None。"""
+    if not path or not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@tracing.traced("prepare_input")
+def _prepare_skill_input(skill: Skill, user_message: str, context_index: dict) -> SkillInput:
+    """
+    App 层负责：读取上下文 + 组装输入。
+
+    Executor 只接收组装好的 SkillInput（按类型划分的上下文 + 用户要求），不做任何上下文读取。
+    """
+    if not skill.requires_context and not skill.optional_context:
+        # 不需要上下文，直接使用用户消息
+        _log_context_trace(
+            f"[prepare_input] skill={skill.name} requires_context=[] input=raw_user_message"
+        )
+        return SkillInput(user_message)
+
+    # 需要上下文：读取并组装
+    contexts = {}
+    missing_types = []
+    for ctx_type in skill.requires_context:
+        ctx_info = context_index.get(ctx_type)
+        if not ctx_info:
+            missing_types.append(ctx_type)
+            continue
+
+        ref_path = ctx_info.get("ref", "")
+        if not ref_path or not os.path.exists(ref_path):
+            missing_types.append(ctx_type)
+            continue
+
+        try:
+            with open(ref_path, "r", encoding="utf-8") as f:
+                content = f.read()
+            if not content.strip():
+                missing_types.append(ctx_type)
+                continue
+            if len(content) > MAX_CONTEXT_CHARS:
+                content = content[:MAX_CONTEXT_CHARS] + "\n\n[内容已截断]\n"
+                _log_context_trace(
+                    f"[prepare_input] skill={skill.name} ctx={ctx_type} truncated_to={MAX_CONTEXT_CHARS}"
+                )
+            contexts[ctx_type] = content
+            _log_context_trace(
+                f"[prepare_input] skill={skill.name} ctx={ctx_type} ref={ref_path} bytes={len(content)}"
+            )
+        except Exception:
+            missing_types.append(ctx_type)
+
+    # 可选上下文（如用户上传的参考资料）：ready 时注入，否则跳过
+    for ctx_type in skill.optional_context:
+        ctx_info = context_index.get(ctx_type) or {}
+        ref_path = ctx_info.get("ref", "")
+        if ctx_info.get("status") != "ready" or not ref_path or not os.path.exists(ref_path):
+            continue
+        try:
+            with open(ref_path, "r", encoding="utf-8") as f:
+                content = f.read()
+        except Exception:
+            continue
+        if not content.strip():
+            continue
+        if len(content) > MAX_CONTEXT_CHARS:
+            content = content[:MAX_CONTEXT_CHARS] + "\n\n[内容已截断]\n"
+        contexts[ctx_type] = content
+        _log_context_trace(
+            f"[prepare_input] skill={skill.name} optional_ctx={ctx_type} ref={ref_path} bytes={len(content)}"
+        )
+
+    if missing_types:
+        missing = ", ".join(sorted(set(missing_types)))
+        _log_context_trace(
+            f"[prepare_input] skill={skill.name} missing_context={missing}"
+        )
+        raise ContextMissingError(missing_types)
+
+    skill_input = SkillInput(user_message, contexts)
+    if contexts:
+        input_bytes = len(user_message) + sum(len(content) for content in contexts.values())
+        tracing.annotate(skill=skill.name, input_bytes=input_bytes)
+        _log_context_trace(
+            f"[prepare_input] skill={skill.name} final_input_bytes={input_bytes}"
+        )
+    return skill_input
+
+
+def _input_hashes(skill: Skill, context_index: dict) -> dict[str, str]:
+    """Skill 所依赖的上游上下文的当前内容哈希。"""
+    hashes = {}
+    for ctx_type in [*skill.requires_context, *skill.optional_context]:
+        ref_path = context_index.get(ctx_type, {}).get("ref", "")
+        digest = file_hash(ref_path)
+        if digest:
+            hashes[ctx_type] = digest
+    return hashes
+
+
+def record_skill_output(
+    bus: GlobalStateBus,
+    skill: Skill,
+    output_path: str,
+    context_index: dict,
+) -> list[str]:
+    """
+    登记 Skill 产出，并在内容发生变化时让下游上下文失效。
+
+    context_index 为执行前的索引快照。返回被标记为 stale 的类型列表。
+    """
+    output_type = SKILL_OUTPUT_TYPES.get(skill.name, "unknown")
+    previous = context_index.get(output_type) or {}
+    content_hash = file_hash(output_path)
+    bus.mark_skill_done(
+        skill.name,
+        output_path,
+        output_type,
+        SKILL_DESCRIPTIONS.get(skill.name, skill.description),
+        content_hash=content_hash,
+        input_hashes=_input_hashes(skill, context_index),
+    )
+    if content_hash is not None and content_hash == previous.get("content_hash"):
+        # 内容未变，下游无需失效
+        return []
+    stale = bus.mark_context_stale(downstream_context_types(output_type))
+    if stale:
+        _log_context_trace(
+            f"[invalidate] upstream={output_type} stale={','.join(stale)}"
+        )
+    return stale
+
+
+def skill_output_path(skill: Skill, outputs_dir: str | None = None) -> str:
+    """Skill 产出文件路径；指定 outputs_dir 时写入该会话目录"""
+    if not outputs_dir:
+        return skill.output_filename
+    return os.path.join(outputs_dir, os.path.basename(skill.output_filename))
+
+
+def start_or_resume_run(
+    bus: GlobalStateBus,
+    workflow: Skill,
+    user_message: str,
+    outputs_dir: str | None = None,
+    resume: bool = False,
+) -> dict:
+    """
+    resume=True 且存在未完成的同名工作流运行时沿用其检查点（用户输入、输出目录、已完成步骤），
+    否则开始一次新的运行。返回运行检查点。
+    """
+    run = bus.get_workflow_run()
+    if resume and run and run["workflow"] == workflow.name and run["status"] != "done":
+        return run
+    bus.start_workflow_run(workflow.name, user_message, outputs_dir)
+    return bus.get_workflow_run()
+
+
+def _reusable_output(step: str, run: dict, context_index: dict) -> dict | None:
+    """检查点中已完成、且产出仍为 ready 的步骤返回其上下文条目"""
+    entry = context_index.get(SKILL_OUTPUT_TYPES.get(step)) or {}
+    if step in run["completed_steps"] and entry.get("status") == "ready" and os.path.exists(entry.get("ref", "")):
+        return entry
+    return None
+
+
+def _step_skill(bus: GlobalStateBus, workflow: Skill, step: str) -> Skill:
+    skill = skill_by_name(step)
+    if skill is None:
+        bus.finish_workflow_run("failed")
+        bus.set_skill_status(workflow.name, "error")
+        raise RuntimeError(f"Unknown workflow step: {step}")
+    return skill
+
+
+def next_workflow_step(bus: GlobalStateBus, workflow: Skill) -> Skill | None:
+    """当前运行中第一个需要执行的步骤；全部完成时返回 None"""
+    run = bus.get_workflow_run()
+    context_index = bus.get_state().get("context_index", {})
+    for step in workflow.workflow_steps:
+        skill = _step_skill(bus, workflow, step)
+        if _reusable_output(step, run, context_index) is None:
+            return skill
+    return None
+
+
+def begin_workflow_step(bus: GlobalStateBus, skill: Skill):
+    bus.set_workflow_step(skill.name)
+    bus.mark_skill_running(skill.name)
+
+
+def complete_workflow_step(bus: GlobalStateBus, skill: Skill, output_path: str, context_index: dict):
+    """登记步骤产出并记录检查点"""
+    record_skill_output(bus, skill, output_path, context_index)
+    bus.checkpoint_workflow_step(skill.name)
+
+
+def fail_workflow_step(bus: GlobalStateBus, workflow: Skill, skill: Skill):
+    bus.mark_skill_error(skill.name, SKILL_OUTPUT_TYPES.get(skill.name))
+    bus.finish_workflow_run("failed")
+    bus.set_skill_status(workflow.name, "error")
+
+
+def finish_workflow(bus: GlobalStateBus, workflow: Skill):
+    bus.finish_workflow_run("done")
+    bus.set_skill_status(workflow.name, "done")
+
+
+def run_workflow(
+    bus: GlobalStateBus,
+    workflow: Skill,
+    user_message: str,
+    outputs_dir: str | None = None,
+    resume: bool = False,
+) -> list[dict]:
+    """
+    按 workflow_steps 顺序执行子 Skill，每完成一步就在 GlobalStateBus 中记录检查点。
+
+    resume=True 且存在未完成的同名工作流运行时，沿用其用户输入与输出目录，
+    检查点中已完成且产出仍为 ready 的步骤直接复用，从第一个未完成的步骤继续；
+    否则开始一次新的运行。某一步失败时标记错误并抛出异常。
+    返回每一步的结果：executed | reused
+    """
+    run = start_or_resume_run(bus, workflow, user_message, outputs_dir, resume)
+    user_message = run["user_message"]
+    outputs_dir = run.get("outputs_dir")
+
+    bus.mark_skill_running(workflow.name)
+    results = []
+    for step in workflow.workflow_steps:
+        skill = _step_skill(bus, workflow, step)
+        context_index = bus.get_state().get("context_index", {})
+        entry = _reusable_output(step, run, context_index)
+        if entry is not None:
+            results.append({"step": step, "status": "reused", "ref": entry["ref"]})
+            continue
+
+        begin_workflow_step(bus, skill)
+        try:
+            skill_input = _prepare_skill_input(skill, user_message, context_index)
+            with usage.scope(state_path=bus.path, run_id=run["run_id"]):
+                output_path = execute_skill(skill, skill_input, skill_output_path(skill, outputs_dir))
+        except Exception:
+            fail_workflow_step(bus, workflow, skill)
+            raise
+        complete_workflow_step(bus, skill, output_path, context_index)
+        results.append({"step": step, "status": "executed", "ref": output_path})
+
+    finish_workflow(bus, workflow)
+    return results
+
+
+def recover_interrupted(bus: GlobalStateBus) -> dict | None:
+    """
+    进程启动时调用：把所属进程已退出、仍为 running 的 Skill 与工作流运行标记为 interrupted，
+    返回可续跑的工作流运行（没有则返回 None）。其他存活进程中正在执行的运行不受影响。
+    """
+    orphaned = bus.recover_orphaned_skills()
+    if orphaned:
+        _log_context_trace(f"[recover] interrupted skills: {', '.join(orphaned)}")
+    run = bus.get_workflow_run()
+    if run and run["status"] in ("interrupted", "failed"):
+        return run
+    return None
+
+
+def resume_workflow(bus: GlobalStateBus) -> list[dict] | None:
+    """
+    从检查点续跑未完成的工作流；没有可续跑的运行时返回 None。
+
+    运行仍由存活的进程执行时抛出 WorkflowRunActiveError，不会重复执行。
+    """
+    run = bus.get_workflow_run()
+    if not run or run["status"] == "done":
+        return None
+    if bus.workflow_run_active():
+        raise WorkflowRunActiveError(run)
+    workflow = skill_by_name(run["workflow"])
+    if workflow is None:
+        return None
+    return run_workflow(bus, workflow, run["user_message"], run.get("outputs_dir"), resume=True)
+
+
+def _versioned_path(path: str, version: int) -> str:
+    """outputs/course_script.md -> outputs/course_script.v2.md"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.v{version}{ext}"
+
+
+def plan_patch(skill: Skill, user_message: str, context_index: dict):
+    """
+    判断本次请求能否以局部修改的方式完成。
+
+    条件：Skill 为文本产出、已有 ready 的产出文件、请求能定位到具体章节
+    且不是整篇文档。返回 (document, sections, entry)，否则返回 None。
+    """
+    if skill.output_type != "text" or skill.skill_type != "skill":
+        return None
+    entry = context_index.get(SKILL_OUTPUT_TYPES.get(skill.name, ""))
+    if not entry or entry.get("status") != "ready":
+        return None
+    ref_path = entry.get("ref", "")
+    if not ref_path or not os.path.exists(ref_path):
+        return None
+    with open(ref_path, "r", encoding="utf-8") as f:
+        document = f.read()
+    sections = find_target_sections(split_sections(document), user_message)
+    if not sections:
+        return None
+    if sum(s.end - s.start for s in sections) >= len(document.strip()):
+        return None
+    return document, sections, entry
+
+
+def patch_skill_output(
+    bus: GlobalStateBus,
+    skill: Skill,
+    user_message: str,
+    context_index: dict,
+) -> str | None:
+    """
+    局部修改模式：只重新生成受影响的章节，拼接为新版本产出。
+
+    无法定位章节时返回 None，由调用方回退到完整生成。
+    """
+    plan = plan_patch(skill, user_message, context_index)
+    if plan is None:
+        return None
+    document, sections, entry = plan
+    output_path = _versioned_path(skill.output_filename, entry.get("version", 1) + 1)
+    _log_context_trace(
+        f"[patch] skill={skill.name} base={entry.get('ref')} "
+        f"sections={'|'.join(s.title for s in sections)} "
+        f"section_bytes={sum(s.end - s.start for s in sections)} doc_bytes={len(document)}"
+    )
+    with usage.scope(state_path=bus.path):
+        execute_patch(skill, document, sections, user_message, output_path)
+    record_skill_output(bus, skill, output_path, context_index)
+    return output_path
+
+
+def refresh_changed_contexts(bus: GlobalStateBus) -> list[str]:
+    """
+    检测被直接编辑过的产出文件（内容哈希与登记值不一致），
+    更新其哈希并让下游上下文失效。返回被标记为 stale 的类型列表。
+    """
+    stale = []
+    context_index = bus.get_state().get("context_index", {})
+    for ctx_type, entry in context_index.items():
+        recorded = entry.get("content_hash")
+        if not recorded or entry.get("status") != "ready":
+            continue
+        current = file_hash(entry.get("ref", ""))
+        if current and current != recorded:
+            bus.set_context_hash(ctx_type, current)
+            stale.extend(bus.mark_context_stale(downstream_context_types(ctx_type)))
+    return stale
+
+
+def rebuild_stale(
+    bus: GlobalStateBus,
+    instruction: str = REBUILD_INSTRUCTION,
+) -> list[dict]:
+    """
+    按拓扑顺序只重跑 stale 的上下文。
+
+    若某个上下文所依赖的上游内容哈希与上次生成时一致，则跳过重跑，直接恢复为 ready
+    （类似构建系统的增量构建）。返回每个类型的处理结果：
+    rebuilt | skipped | blocked | failed
+    """
+    refresh_changed_contexts(bus)
+    context_index = bus.get_state().get("context_index", {})
+    stale_types = [t for t, e in context_index.items() if e.get("status") == "stale"]
+
+    results = []
+    for ctx_type in topological_context_order(stale_types):
+        context_index = bus.get_state().get("context_index", {})
+        entry = context_index.get(ctx_type, {})
+        skill = skill_by_name(entry.get("producer", ""))
+        if skill is None:
+            results.append({"context_type": ctx_type, "status": "failed", "reason": "unknown producer"})
+            continue
+
+        not_ready = [
+            t for t in skill.requires_context
+            if context_index.get(t, {}).get("status") != "ready"
+        ]
+        if not_ready:
+            results.append({
+                "context_type": ctx_type,
+                "status": "blocked",
+                "reason": f"上游未就绪：{', '.join(not_ready)}",
+            })
+            continue
+
+        if entry.get("input_hashes") and entry["input_hashes"] == _input_hashes(skill, context_index):
+            bus.update_context_status(ctx_type, "ready")
+            _log_context_trace(f"[rebuild] ctx={ctx_type} skipped=inputs_unchanged")
+            results.append({"context_type": ctx_type, "status": "skipped"})
+            continue
+
+        bus.mark_skill_running(skill.name)
+        try:
+            skill_input = _prepare_skill_input(skill, instruction, context_index)
+            with usage.scope(state_path=bus.path):
+                # 写回条目当前引用的文件（局部修改产生的 .vN 版本、批量模式的会话目录），
+                # 保持 context_index 的 ref 与实际产出一致
+                output_path = execute_skill(skill, skill_input, entry.get("ref") or None)
+        except Exception as exc:
+            bus.mark_skill_error(skill.name, ctx_type)
+            results.append({"context_type": ctx_type, "status": "failed", "reason": str(exc)})
+            continue
+        record_skill_output(bus, skill, output_path, context_index)
+        _log_context_trace(f"[rebuild] ctx={ctx_type} rebuilt={output_path}")
+        results.append({"context_type": ctx_type, "status": "rebuilt", "ref": output_path})
+
+    return results
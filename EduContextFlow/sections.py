@@ -0,0 +1,184 @@
+import re
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Section:
+    level: int  # 标题级别（# 为 1）
+    title: str
+    start: int  # 标题行起始偏移
+    end: int  # 本节（含子节）结束偏移
+
+    def text(self, document: str) -> str:
+        return document[self.start:self.end]
+
+
+_HEADING_RE = re.compile(r"^(#{1,6})[ \t]+(.+?)[ \t#]*$", re.M)
+_FENCE_RE = re.compile(r"^(```|~~~)", re.M)
+
+# "第三章" / "第 3 节" / "第十二部分" 等序号引用
+_ORDINAL_RE = re.compile(r"第\s*([0-9]+|[零一二两三四五六七八九十]+)\s*(章|节|部分|模块|课|单元|讲|幕)")
+# "模块三" / "单元 2" 这类后置序号
+_SUFFIX_ORDINAL_RE = re.compile(r"(章节|模块|单元|部分|环节)\s*([0-9]+|[一二两三四五六七八九十]+)")
+
+# 引号中的章节标题："把“光合作用的过程”这一节改短一些"（书名号多用于课程名，不算章节引用）
+_QUOTED_RE = re.compile(r"[「『“\"]([^」』”\"\n]{2,40})[」』”\"]")
+
+# 修改类动词：只有明确要求修改已有内容时才考虑局部修改（"改" 覆盖 修改 / 改写 / 改成 等）
+EDIT_VERBS = (
+    "改", "调整", "重写", "替换", "换成", "补充", "增加", "加上", "删", "去掉",
+    "润色", "优化", "完善", "精简", "扩充", "扩写", "缩短", "更新",
+)
+
+# 常见的章节内容名词，只用于在序号定位的章节内收窄到子节（如"第三章的练习"）
+SECTION_KEYWORDS = (
+    "练习", "示例", "案例", "例题", "小结", "总结", "导入", "讲解", "作业",
+    "知识点", "目标", "讨论", "提问", "实验", "活动", "评价", "拓展", "开场", "结尾",
+)
+
+_CN_DIGITS = {"零": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+
+def parse_number(token: str) -> int | None:
+    """解析阿拉伯数字或 99 以内的中文数字。"""
+    if token.isdigit():
+        return int(token)
+    if "十" in token:
+        tens, _, ones = token.partition("十")
+        value = (_CN_DIGITS.get(tens, 0) if tens else 1) * 10
+        return value + (_CN_DIGITS.get(ones, 0) if ones else 0)
+    if len(token) == 1 and token in _CN_DIGITS:
+        return _CN_DIGITS[token]
+    return None
+
+
+def split_sections(document: str) -> list[Section]:
+    """
+    按 Markdown 标题切分文档（忽略代码块内的 #）。
+
+    每个 Section 覆盖到下一个同级或更高级标题之前，即包含其子节。
+    """
+    fences = [m.start() for m in _FENCE_RE.finditer(document)]
+    headings = []
+    for match in _HEADING_RE.finditer(document):
+        # 位于奇数个围栏之后 = 在代码块内
+        inside_fence = sum(1 for pos in fences if pos < match.start()) % 2 == 1
+        if not inside_fence:
+            headings.append((len(match.group(1)), match.group(2).strip(), match.start()))
+
+    sections = []
+    for i, (level, title, start) in enumerate(headings):
+        end = len(document)
+        for next_level, _, next_start in headings[i + 1:]:
+            if next_level <= level:
+                end = next_start
+                break
+        sections.append(Section(level=level, title=title, start=start, end=end))
+    return sections
+
+
+def _chapter_level(sections: list[Section]) -> int | None:
+    """章节所在的标题级别：最高级标题只有一个时视为文档标题，取下一级。"""
+    levels = sorted({s.level for s in sections})
+    if not levels:
+        return None
+    top = levels[0]
+    if sum(1 for s in sections if s.level == top) == 1 and len(levels) > 1:
+        return levels[1]
+    return top
+
+
+def _find_ordinal(sections: list[Section], request: str) -> list[Section]:
+    match = _ORDINAL_RE.search(request)
+    if match:
+        number, unit = parse_number(match.group(1)), match.group(2)
+    else:
+        match = _SUFFIX_ORDINAL_RE.search(request)
+        if not match:
+            return []
+        unit, number = match.group(1), parse_number(match.group(2))
+    if not number:
+        return []
+
+    # 优先匹配标题中写明的序号（"第三章 …" / "第3章 …" / "模块三 …"）
+    for section in sections:
+        for title_match in _ORDINAL_RE.finditer(section.title):
+            if parse_number(title_match.group(1)) == number and title_match.group(2) == unit:
+                return [section]
+        for title_match in _SUFFIX_ORDINAL_RE.finditer(section.title):
+            if parse_number(title_match.group(2)) == number and title_match.group(1) == unit:
+                return [section]
+
+    # 否则按章节级标题的出现顺序取第 N 个
+    level = _chapter_level(sections)
+    chapters = [s for s in sections if s.level == level]
+    if 0 < number <= len(chapters):
+        return [chapters[number - 1]]
+    return []
+
+
+def _normalize_title(title: str) -> str:
+    title = _ORDINAL_RE.sub("", title)
+    return re.sub(r"^[\s0-9.、:：)）(（-]+|[\s:：]+$", "", title)
+
+
+def _title_matches(section: Section, request: str) -> bool:
+    normalized = _normalize_title(section.title)
+    if len(normalized) >= 2 and normalized in request:
+        return True
+    return any(kw in request and kw in section.title for kw in SECTION_KEYWORDS)
+
+
+def _find_quoted(sections: list[Section], request: str) -> list[Section]:
+    quoted = [q.strip() for q in _QUOTED_RE.findall(request)]
+    return [s for s in sections if any(q and q in s.title for q in quoted)]
+
+
+def has_edit_intent(request: str) -> bool:
+    return any(verb in request for verb in EDIT_VERBS)
+
+
+def find_target_sections(sections: list[Section], request: str) -> list[Section]:
+    """
+    根据修改请求定位受影响的章节，如 "改一下第三章的练习"。
+
+    只有请求包含修改类动词、且显式引用了章节（序号，或引号中的标题）时才定位：
+    先按序号定位章节，再在章节内按标题关键词收窄到子节；没有序号时按引号中的标题匹配。
+    "目标""练习"等泛用词单独出现不算引用，避免新的需求说明被误当作局部修改。
+    返回互不重叠的章节列表（按文档顺序），无法定位时返回空列表（由调用方完整生成）。
+    """
+    if not has_edit_intent(request):
+        return []
+    scope = _find_ordinal(sections, request)
+    if scope:
+        chapter = scope[0]
+        inner = [
+            s for s in sections
+            if chapter.start < s.start < chapter.end and _title_matches(s, request)
+        ]
+        targets = inner or scope
+    else:
+        targets = _find_quoted(sections, request)
+
+    # 去掉被其他目标包含的子节
+    result = []
+    for section in sorted(targets, key=lambda s: (s.start, -s.end)):
+        if result and section.start < result[-1].end:
+            continue
+        result.append(section)
+    return result
+
+
+def splice_sections(document: str, replacements: list[tuple[Section, str]]) -> str:
+    """把重新生成的章节拼回原文（replacements 中的章节互不重叠）。"""
+    pieces = []
+    cursor = 0
+    for section, new_text in sorted(replacements, key=lambda item: item[0].start):
+        pieces.append(document[cursor:section.start])
+        body = new_text.strip("\n")
+        # 保持与后续内容之间的原有空行
+        trailing = section.text(document)[len(section.text(document).rstrip("\n")):]
+        pieces.append(body + (trailing or "\n"))
+        cursor = section.end
+    pieces.append(document[cursor:])
+    return "".join(pieces)
@@ -1,5 +1,8 @@
 from dataclasses import dataclass, field
 import os
+import re
+import threading
+import time
 
 
 @dataclass(frozen=True)
@@ -9,19 +12,153 @@ class Skill:
     intent_description: str
     input_schema: dict
     trigger_keywords: list[str]
-    prompt_template: str
+    prompt_file: str  # skills/ 下的提示词文件，首次使用时才读取
     output_filename: str
     output_type: str  # "text" or "image"
     requires_context: list[str]  # 需要的上下文类型（如 ["transcript"]）
     skill_type: str = "skill"  # "skill" or "workflow"
     workflow_steps: list[str] = field(default_factory=list)  # 仅workflow类型使用，子skill名称列表
+    optional_context: list[str] = field(default_factory=list)  # 可选上下文：ready 时注入，缺失时跳过
+    produces: str = ""  # 产出写入 context_index 的语义类型（固定枚举）
+    produces_description: str = ""  # 产出在 context_index 中的描述
+    example_utterances: list[str] = field(default_factory=list)  # 典型用户说法，用于意图索引
+    model_tier: str = "strong"  # 文本模型档位：fast（短小输出）| strong（长文本）
 
+    @property
+    def prompt_template(self) -> str:
+        return PROMPTS.get(self.prompt_file)
 
-def _read_prompt(filename: str) -> str:
-    base_dir = os.path.join(os.path.dirname(__file__), "skills")
-    path = os.path.join(base_dir, filename)
-    with open(path, "r", encoding="utf-8") as f:
-        return f.read().strip()
+    @property
+    def prompt(self) -> "PromptTemplate":
+        """预编译的提示词模板"""
+        return PROMPTS.compiled(self.prompt_file)
+
+    @property
+    def context_slots(self) -> tuple[str, ...]:
+        """模板中可使用的上下文槽位名（所需上下文 + 可选上下文）"""
+        return (*self.requires_context, *self.optional_context)
+
+
+# {user_input}、{design_plan} 这样的标识符才是槽位；JSON 示例等其他花括号按原文保留
+_SLOT_RE = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    预编译的提示词模板：literals 与 slots 交替排列（len(literals) == len(slots) + 1），
+    渲染只做拼接，不再逐次解析模板。
+
+    与 str.format 不同，未提供值的槽位按原文 "{name}" 输出，模板中的花括号无需转义。
+    """
+
+    literals: tuple[str, ...]
+    slots: tuple[str, ...]
+
+    @classmethod
+    def compile(cls, text: str) -> "PromptTemplate":
+        literals = []
+        slots = []
+        position = 0
+        for match in _SLOT_RE.finditer(text):
+            literals.append(text[position:match.start()])
+            slots.append(match.group(1))
+            position = match.end()
+        literals.append(text[position:])
+        return cls(tuple(literals), tuple(slots))
+
+    def render(self, values: dict[str, str]) -> str:
+        parts = [self.literals[0]]
+        for slot, literal in zip(self.slots, self.literals[1:]):
+            value = values.get(slot)
+            parts.append("{" + slot + "}" if value is None else value)
+            parts.append(literal)
+        return "".join(parts)
+
+
+@dataclass(frozen=True)
+class SkillInput:
+    """
+    App 层组装好的 Skill 输入：按类型划分的上下文正文 + 用户要求。
+
+    Executor 渲染时，模板中有同名槽位的上下文直接填入槽位，
+    其余上下文与用户要求按 "=== 类型 ===" 分块放入 {user_input}。
+    """
+
+    user_message: str
+    contexts: dict[str, str] = field(default_factory=dict)  # 上下文类型 → 正文，按注入顺序
+
+    def block(self, exclude=()) -> str:
+        parts = [
+            f"=== {ctx_type} ===\n{content}\n"
+            for ctx_type, content in self.contexts.items()
+            if ctx_type not in exclude
+        ]
+        if not parts:
+            return self.user_message
+        return "\n".join(parts) + f"\n=== 用户要求 ===\n{self.user_message}"
+
+    @property
+    def text(self) -> str:
+        """全部上下文 + 用户要求的完整文本"""
+        return self.block()
+
+
+PROMPT_DIR = os.path.join(os.path.dirname(__file__), "skills")
+SKILL_RELOAD_INTERVAL = float(os.getenv("SKILL_RELOAD_INTERVAL", "2"))  # 提示词热加载轮询间隔（秒），0 为关闭
+
+
+def _mtime(path: str) -> float | None:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class PromptStore:
+    """
+    提示词缓存：导入时不读取任何文件，首次使用某个 Skill 时才读取并编译其提示词。
+
+    invalidate_changed() 丢弃文件已被修改的缓存项，下次使用时重新读取。
+    """
+
+    def __init__(self, prompt_dir: str = PROMPT_DIR):
+        self.prompt_dir = prompt_dir
+        # 文件名 → (修改时间, 原文, 编译后的模板)
+        self._cache: dict[str, tuple[float | None, str, PromptTemplate]] = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, filename: str) -> tuple[float | None, str, PromptTemplate]:
+        entry = self._cache.get(filename)
+        if entry is None:
+            path = os.path.join(self.prompt_dir, filename)
+            # 先取修改时间再读内容：读取期间文件被改写时，下次检查会再次失效
+            mtime = _mtime(path)
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read().strip()
+            entry = (mtime, text, PromptTemplate.compile(text))
+            with self._lock:
+                self._cache[filename] = entry
+        return entry
+
+    def get(self, filename: str) -> str:
+        return self._entry(filename)[1]
+
+    def compiled(self, filename: str) -> PromptTemplate:
+        return self._entry(filename)[2]
+
+    def invalidate_changed(self) -> list[str]:
+        """返回缓存已失效的文件名（只检查已加载过的文件）"""
+        changed = []
+        with self._lock:
+            for filename, (mtime, _, _) in list(self._cache.items()):
+                if _mtime(os.path.join(self.prompt_dir, filename)) != mtime:
+                    del self._cache[filename]
+                    changed.append(filename)
+        return changed
+
+
+PROMPTS = PromptStore()
 
 
 SKILLS = [
@@ -35,9 +172,12 @@ SKILLS = [
         ),
         input_schema={"course_topic": "string", "target_audience": "string", "course_duration": "string(optional)"},
         trigger_keywords=["课程目标", "学习目标", "定义目标", "课程目标确认"],
-        prompt_template=_read_prompt("course_goal_definition.md"),
+        example_utterances=["帮我确定这门课的学习目标", "给初二学生讲光合作用，先定一下课程目标"],
+        prompt_file="course_goal_definition.md",
         output_filename="outputs/course_goal.md",
         output_type="text",
+        produces="course_goal",
+        produces_description="课程目标与学习成果",
         requires_context=[],  # 不需要前置上下文
     ),
     # Skill 2: 课程设计方案编写
@@ -50,10 +190,14 @@ SKILLS = [
         ),
         input_schema={"course_goal": "string"},
         trigger_keywords=["课程设计", "设计方案", "课程方案", "设计课程"],
-        prompt_template=_read_prompt("course_design_plan.md"),
+        example_utterances=["根据课程目标出一份课程设计方案", "帮我规划课程的章节和课时安排"],
+        prompt_file="course_design_plan.md",
         output_filename="outputs/design_plan.md",
         output_type="text",
+        produces="design_plan",
+        produces_description="课程设计方案",
         requires_context=["course_goal"],  # 需要 course_goal 上下文
+        optional_context=["reference_material"],  # 用户上传的已有课程资料
     ),
     # Skill 3: 课程设计方案评审
     Skill(
@@ -65,9 +209,12 @@ SKILLS = [
         ),
         input_schema={"design_plan": "string"},
         trigger_keywords=["评审方案", "方案评审", "评审课程设计", "检查方案"],
-        prompt_template=_read_prompt("course_plan_review.md"),
+        example_utterances=["帮我看看这个设计方案有没有问题", "评审一下刚才的课程方案"],
+        prompt_file="course_plan_review.md",
         output_filename="outputs/design_review.md",
         output_type="text",
+        produces="design_review",
+        produces_description="课程设计方案评审报告",
         requires_context=["design_plan"],  # 需要 design_plan 上下文
     ),
     # Skill 4: 课程脚本编写
@@ -80,9 +227,12 @@ SKILLS = [
         ),
         input_schema={"design_plan": "string"},
         trigger_keywords=["课程脚本", "写脚本", "生成脚本", "脚本编写"],
-        prompt_template=_read_prompt("course_script_writing.md"),
+        example_utterances=["按设计方案把讲稿写出来", "帮我写每一节课的讲解脚本"],
+        prompt_file="course_script_writing.md",
         output_filename="outputs/course_script.md",
         output_type="text",
+        produces="course_script",
+        produces_description="课程脚本",
         requires_context=["design_plan"],  # 需要 design_plan 上下文
     ),
     # Skill 5: 课程脚本评审
@@ -95,9 +245,12 @@ SKILLS = [
         ),
         input_schema={"course_script": "string"},
         trigger_keywords=["评审脚本", "脚本评审", "检查脚本", "脚本审查"],
-        prompt_template=_read_prompt("course_script_review.md"),
+        example_utterances=["检查一下课程脚本写得怎么样", "评审一下刚才的讲稿"],
+        prompt_file="course_script_review.md",
         output_filename="outputs/script_review.md",
         output_type="text",
+        produces="script_review",
+        produces_description="课程脚本评审报告",
         requires_context=["course_script"],  # 需要 course_script 上下文
     ),
     # Skill 6: 分镜脚本编写
@@ -110,9 +263,12 @@ SKILLS = [
         ),
         input_schema={"course_script": "string"},
         trigger_keywords=["分镜", "分镜脚本", "生成分镜", "分镜设计"],
-        prompt_template=_read_prompt("storyboard_writing.md"),
+        example_utterances=["把课程脚本做成视频分镜", "帮我设计每个镜头的画面和字幕"],
+        prompt_file="storyboard_writing.md",
         output_filename="outputs/storyboard.md",
         output_type="text",
+        produces="storyboard",
+        produces_description="分镜脚本",
         requires_context=["course_script"],  # 需要 course_script 上下文
     ),
     # Skill 7: 分镜脚本评审
@@ -125,9 +281,12 @@ SKILLS = [
         ),
         input_schema={"storyboard": "string"},
         trigger_keywords=["评审分镜", "分镜评审", "检查分镜", "分镜审查"],
-        prompt_template=_read_prompt("storyboard_review.md"),
+        example_utterances=["看看分镜有没有需要改的地方", "评审一下刚才的分镜"],
+        prompt_file="storyboard_review.md",
         output_filename="outputs/storyboard_review.md",
         output_type="text",
+        produces="storyboard_review",
+        produces_description="分镜脚本评审报告",
         requires_context=["storyboard"],  # 需要 storyboard 上下文
     ),
     # Workflow: 课程制作完整流程
@@ -140,9 +299,12 @@ SKILLS = [
         ),
         input_schema={"course_topic": "string", "target_audience": "string", "course_duration": "string(optional)"},
         trigger_keywords=["完整流程", "全流程", "制作课程", "课程制作", "完整课程"],
-        prompt_template=_read_prompt("course_production_workflow.md"),
+        example_utterances=["从头到尾帮我做一门完整的课程", "一次性完成目标、方案、脚本和分镜"],
+        prompt_file="course_production_workflow.md",
         output_filename="outputs/workflow_summary.md",
         output_type="text",
+        produces="workflow_summary",
+        produces_description="课程制作完整流程",
         requires_context=[],  # 不需要前置上下文
         skill_type="workflow",
         workflow_steps=[
@@ -158,8 +320,121 @@ SKILLS = [
 ]
 
 
+class SkillRegistry:
+    """
+    Skill 注册表：按名称、产出类型、所需上下文建立索引，查找为 O(1)。
+
+    requires_context 的反向边（上下文类型 → 依赖它的 Skill）构成反向依赖图，
+    供失效传播与拓扑排序使用。
+
+    watch() 在后台轮询已加载提示词的修改时间，变化的提示词在下次使用时重新读取，
+    修改提示词无需重启服务。
+    """
+
+    def __init__(self, skills: list[Skill], prompts: PromptStore = PROMPTS):
+        self.prompts = prompts
+        self._skills = list(skills)
+        self._lock = threading.Lock()
+        self._watcher: threading.Thread | None = None
+        self._by_name = {skill.name: skill for skill in self._skills}
+        self._by_output_type = {skill.produces: skill for skill in self._skills if skill.produces}
+        self._by_required_context: dict[str, list[str]] = {}
+        for skill in self._skills:
+            for ctx_type in skill.requires_context:
+                self._by_required_context.setdefault(ctx_type, []).append(skill.name)
+
+    @property
+    def skills(self) -> list[Skill]:
+        return self._skills
+
+    def get(self, name: str) -> Skill | None:
+        return self._by_name.get(name)
+
+    def by_output_type(self, output_type: str) -> Skill | None:
+        """产出 output_type 的 Skill"""
+        return self._by_output_type.get(output_type)
+
+    def consumers(self, context_type: str) -> list[Skill]:
+        """requires_context 中包含 context_type 的 Skill（反向依赖图的一条出边）"""
+        return [self._by_name[name] for name in self._by_required_context.get(context_type, [])]
+
+    def output_types(self) -> dict[str, str]:
+        return {skill.name: skill.produces for skill in self._skills if skill.produces}
+
+    def descriptions(self) -> dict[str, str]:
+        return {skill.name: skill.produces_description for skill in self._skills if skill.produces_description}
+
+    def reload(self) -> list[str]:
+        """让修改过的提示词失效，返回受影响的 Skill 名称"""
+        changed = set(self.prompts.invalidate_changed())
+        return [skill.name for skill in self._skills if skill.prompt_file in changed]
+
+    def watch(self, interval: float = SKILL_RELOAD_INTERVAL) -> threading.Thread | None:
+        """启动后台轮询线程（重复调用只启动一次）"""
+        if interval <= 0:
+            return None
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(
+                    target=self._watch_loop, args=(interval,), name="skill-reload", daemon=True
+                )
+                self._watcher.start()
+        return self._watcher
+
+    def _watch_loop(self, interval: float):
+        while True:
+            time.sleep(interval)
+            changed = self.reload()
+            if changed:
+                print(f"🔄 已重新加载提示词: {', '.join(changed)}")
+
+
+REGISTRY = SkillRegistry(SKILLS)
+SKILLS = REGISTRY.skills
+
+# Skill output type 映射（固定枚举）：Skill 产出写入 context_index 的语义类型
+SKILL_OUTPUT_TYPES = REGISTRY.output_types()
+
+# Skill 描述映射
+SKILL_DESCRIPTIONS = REGISTRY.descriptions()
+
+
 def skill_by_name(name: str) -> Skill | None:
-    for skill in SKILLS:
-        if skill.name == name:
-            return skill
-    return None
+    return REGISTRY.get(name)
+
+
+def downstream_context_types(context_type: str) -> list[str]:
+    """
+    沿 requires_context 依赖边，找出所有（直接或间接）依赖 context_type 的上下文类型。
+    返回结果按拓扑顺序排列（上游在前）。
+    """
+    affected = set()
+    frontier = [context_type]
+    while frontier:
+        current = frontier.pop()
+        for skill in REGISTRY.consumers(current):
+            if skill.produces and skill.produces not in affected:
+                affected.add(skill.produces)
+                frontier.append(skill.produces)
+    return topological_context_order(affected)
+
+
+def topological_context_order(context_types) -> list[str]:
+    """按依赖关系对上下文类型排序：被依赖的类型排在依赖它的类型之前。"""
+    wanted = set(context_types)
+    ordered: list[str] = []
+    visited = set()
+
+    def visit(ctx_type: str):
+        if ctx_type in visited:
+            return
+        visited.add(ctx_type)
+        producer = REGISTRY.by_output_type(ctx_type)
+        for upstream in producer.requires_context if producer else []:
+            visit(upstream)
+        if ctx_type in wanted:
+            ordered.append(ctx_type)
+
+    for ctx_type in sorted(wanted):
+        visit(ctx_type)
+    return ordered
@@ -0,0 +1,255 @@
+"""
+推测式预生成（可选，设置 SPECULATIVE_PREGEN=true 开启）。
+
+某个 Skill 完成后，在后台线程中提前生成最可能被请求的下一个 Skill：
+- 候选：上游上下文全部 ready、自身产出尚未 ready 的 Skill（requires_context 图）
+- 排序：bus 中观察到的转移次数 > 是否直接依赖刚完成的产出 > SKILLS 中的顺序
+- 用户随后请求该 Skill、上游内容未变且请求只是确认/继续（"好的""继续""生成分镜"）时，
+  直接使用后台结果（仍在生成时等待其完成）；带有任何具体要求（"改成5分钟""面向小学生"）
+  的请求照常重新生成，因为推测生成时并不知道这些要求
+- 上游变化、超过 SPECULATION_TTL_SECONDS 未被使用的结果会被丢弃并删除临时文件；
+  SPECULATION_WINDOW_SECONDS 内丢弃次数达到 SPECULATION_BUDGET 时暂停推测，命中后重新计数
+
+推测生成只写 outputs/.speculative/ 下的临时文件，不写 GlobalStateBus，
+由请求线程在命中时登记产出。
+"""
+
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import tracing
+import usage
+from executor import execute_skill
+from runner import ContextMissingError, _input_hashes, _prepare_skill_input, skill_output_path
+from skills import SKILLS, SKILL_OUTPUT_TYPES, Skill, SkillInput, skill_by_name
+
+
+SPECULATIVE_PREGEN = os.getenv("SPECULATIVE_PREGEN", "").lower() in ("1", "true", "yes")
+SPECULATION_WIDTH = int(os.getenv("SPECULATION_WIDTH", "1"))  # 每次最多预生成几个 Skill
+SPECULATION_BUDGET = int(os.getenv("SPECULATION_BUDGET", "5"))  # 时间窗口内允许浪费的推测生成次数
+SPECULATION_WINDOW_SECONDS = float(os.getenv("SPECULATION_WINDOW_SECONDS", "3600"))
+SPECULATION_TTL_SECONDS = float(os.getenv("SPECULATION_TTL_SECONDS", "900"))  # 未被取用的结果保留时长
+
+# 推测时没有用户输入，使用固定说明
+SPECULATIVE_INSTRUCTION = "请基于上游内容生成完整内容。"
+SPECULATIVE_DIR = ".speculative"
+
+# 确认/继续类用词（按长度从长到短去除）
+CONFIRM_WORDS = sorted(
+    (
+        "好的", "好", "可以", "行", "没问题", "确认", "确定", "同意", "继续", "接着", "下一步",
+        "开始", "请", "帮我", "直接", "生成", "写", "做", "一下", "吧", "嗯", "是的", "对",
+        "ok", "okay", "yes", "go",
+    ),
+    key=len,
+    reverse=True,
+)
+_PUNCT_RE = re.compile(r"[\W_]+")
+
+
+def is_confirm_message(skill: Skill, user_message: str) -> bool:
+    """
+    请求是否只是确认/继续该 Skill：去掉标点、确认类用词与 Skill 触发词后没有剩余内容。
+
+    推测结果是按固定说明生成的，只要请求中还有其他内容（时长、对象、修改要求等），就不能直接使用。
+    """
+    text = _PUNCT_RE.sub("", user_message.lower())
+    for word in sorted(skill.trigger_keywords, key=len, reverse=True) + CONFIRM_WORDS:
+        text = text.replace(word, "")
+    return not text
+
+
+def predict_next_skills(last_skill: str, bus_state: dict, width: int = SPECULATION_WIDTH) -> list[Skill]:
+    """根据依赖图与观察到的转移次数，预测 last_skill 完成后最可能被请求的 Skill"""
+    context_index = bus_state.get("context_index", {})
+    skills_state = bus_state.get("skills", {})
+    observed = bus_state.get("skill_transitions", {}).get(last_skill, {})
+    produced = SKILL_OUTPUT_TYPES.get(last_skill)
+
+    candidates = []
+    for order, skill in enumerate(SKILLS):
+        if skill.skill_type != "skill" or skill.name == last_skill or not skill.requires_context:
+            continue
+        if skills_state.get(skill.name, {}).get("status") == "running":
+            continue
+        own = context_index.get(SKILL_OUTPUT_TYPES.get(skill.name)) or {}
+        if own.get("status") == "ready":
+            continue
+        if any((context_index.get(t) or {}).get("status") != "ready" for t in skill.requires_context):
+            continue
+        rank = (-observed.get(skill.name, 0), produced not in skill.requires_context, order)
+        candidates.append((rank, skill))
+    candidates.sort(key=lambda c: c[0])
+    return [skill for _, skill in candidates[:width]]
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _sweep_dir(directory: str, keep: set[str], max_age: float):
+    """删除推测目录中超过 max_age 的临时文件（包括之前进程遗留的），keep 中的路径保留"""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    cutoff = time.time() - max_age
+    for name in names:
+        path = os.path.join(directory, name)
+        if path in keep:
+            continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class Speculator:
+    """后台预生成的调度与取用（线程安全）"""
+
+    def __init__(
+        self,
+        outputs_dir: str | None = None,
+        enabled: bool = SPECULATIVE_PREGEN,
+        width: int = SPECULATION_WIDTH,
+        budget: int = SPECULATION_BUDGET,
+        window: float = SPECULATION_WINDOW_SECONDS,
+        ttl: float = SPECULATION_TTL_SECONDS,
+        max_workers: int = 2,
+    ):
+        self.outputs_dir = outputs_dir
+        self.enabled = enabled
+        self.width = width
+        self.budget = budget
+        self.window = window
+        self.ttl = ttl
+        self.hits = 0
+        self.wasted = 0
+        self._recent_waste: deque[float] = deque()  # 窗口内的丢弃时间，命中时清空
+        self._pending: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculate")
+
+    def schedule(self, bus_state: dict, last_skill: str) -> list[str]:
+        """last_skill 完成后调用，返回开始预生成的 Skill 名称"""
+        if not self.enabled:
+            return []
+        context_index = bus_state.get("context_index", {})
+        self.discard_stale(context_index)
+        self._sweep()
+
+        scheduled = []
+        with self._lock:
+            for skill in predict_next_skills(last_skill, bus_state, self.width):
+                if self._over_budget():
+                    break
+                if skill.name in self._pending:
+                    continue
+                try:
+                    skill_input = _prepare_skill_input(skill, SPECULATIVE_INSTRUCTION, context_index)
+                except ContextMissingError:
+                    continue
+                final_path = skill_output_path(skill, self.outputs_dir)
+                base, ext = os.path.splitext(os.path.basename(final_path))
+                path = os.path.join(
+                    os.path.dirname(final_path), SPECULATIVE_DIR, f"{base}.{uuid.uuid4().hex[:8]}{ext}"
+                )
+                self._pending[skill.name] = {
+                    "input_hashes": _input_hashes(skill, context_index),
+                    "path": path,
+                    "created_at": time.time(),
+                    "future": self._pool.submit(self._generate, skill, skill_input, path, usage.current_scope()),
+                }
+                scheduled.append(skill.name)
+                metrics.SPECULATION_OUTCOMES.inc(outcome="scheduled", skill=skill.name)
+        return scheduled
+
+    def _generate(self, skill: Skill, skill_input: SkillInput, path: str, usage_scope: dict) -> str:
+        # 推测生成同样计入调度它的会话
+        with tracing.trace(f"speculate-{skill.name}"), usage.scope(**usage_scope):
+            with tracing.span("speculate", skill=skill.name):
+                return execute_skill(skill, skill_input, path)
+
+    def take(self, skill: Skill, user_message: str, context_index: dict) -> str | None:
+        """
+        取用 skill 的预生成结果：命中时移动到正式产出路径并返回，否则返回 None。
+
+        上游内容已变化、或用户请求不只是确认/继续（带有具体要求）时丢弃结果。
+        """
+        with self._lock:
+            entry = self._pending.pop(skill.name, None)
+        if entry is None:
+            return None
+        if (
+            not is_confirm_message(skill, user_message)
+            or entry["input_hashes"] != _input_hashes(skill, context_index)
+        ):
+            self._discard(skill.name, entry)
+            return None
+        try:
+            path = entry["future"].result()
+        except Exception:
+            self._discard(skill.name, entry)
+            return None
+
+        final_path = skill_output_path(skill, self.outputs_dir)
+        os.replace(path, final_path)
+        with self._lock:
+            self.hits += 1
+            self._recent_waste.clear()
+        metrics.SPECULATION_OUTCOMES.inc(outcome="hit", skill=skill.name)
+        tracing.event("speculation", skill=skill.name, outcome="hit")
+        return final_path
+
+    def discard_stale(self, context_index: dict):
+        """丢弃上游内容已变化、产出已通过其他途径生成、或超过 TTL 未被取用的预生成结果"""
+        expired = time.time() - self.ttl
+        with self._lock:
+            stale = []
+            for name, entry in self._pending.items():
+                own = context_index.get(SKILL_OUTPUT_TYPES.get(name)) or {}
+                if (
+                    own.get("status") == "ready"
+                    or entry["created_at"] < expired
+                    or entry["input_hashes"] != _input_hashes(skill_by_name(name), context_index)
+                ):
+                    stale.append(name)
+            entries = [(name, self._pending.pop(name)) for name in stale]
+        for name, entry in entries:
+            self._discard(name, entry)
+
+    def _over_budget(self) -> bool:
+        # 调用方持有 self._lock
+        cutoff = time.time() - self.window
+        while self._recent_waste and self._recent_waste[0] < cutoff:
+            self._recent_waste.popleft()
+        return len(self._recent_waste) >= self.budget
+
+    def _sweep(self):
+        """清理推测目录中过期的临时文件（含进程退出前未来得及删除的）"""
+        directory = os.path.join(
+            os.path.dirname(skill_output_path(SKILLS[0], self.outputs_dir)), SPECULATIVE_DIR
+        )
+        with self._lock:
+            keep = {entry["path"] for entry in self._pending.values()}
+        _sweep_dir(directory, keep, self.ttl)
+
+    def _discard(self, skill_name: str, entry: dict):
+        with self._lock:
+            self.wasted += 1
+            self._recent_waste.append(time.time())
+        entry["future"].cancel()
+        # 仍在生成的结果在完成后删除
+        entry["future"].add_done_callback(lambda _: _remove_file(entry["path"]))
+        metrics.SPECULATION_OUTCOMES.inc(outcome="discarded", skill=skill_name)
+        tracing.event("speculation", skill=skill_name, outcome="discarded")
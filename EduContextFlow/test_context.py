@@ -16,15 +16,10 @@ from typing import Any
 # 确保可以导入项目模块
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+from envfile import load_env_file
+
 # 加载 .env 文件
-env_path = ".env"
-if os.path.exists(env_path):
-    with open(env_path) as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith("#") and "=" in line:
-                key, value = line.split("=", 1)
-                os.environ[key.strip()] = value.strip()
+load_env_file()
 
 from bus import GlobalStateBus
 from dispatcher import dispatch
@@ -0,0 +1,257 @@
+"""
+结构化链路追踪：按阶段记录 span（耗时、字节数、token 数、关联 ID），
+经缓冲的后台线程批量写入 JSONL。
+
+用法：
+    with tracing.span("llm.attempt", model=model) as s:
+        ...
+        s["output_bytes"] = len(text)
+
+统计各阶段耗时（p50/p95）：
+    python tracing.py [outputs/trace.jsonl]
+"""
+
+import argparse
+import atexit
+import contextvars
+import functools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+
+TRACE_PATH = os.getenv("TRACE_PATH", os.path.join("outputs", "trace.jsonl"))
+FLUSH_INTERVAL = 1.0  # 秒
+MAX_BATCH = 256
+
+_trace_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("trace_id", default=None)
+_current_span: contextvars.ContextVar[dict | None] = contextvars.ContextVar("current_span", default=None)
+
+
+class JsonlSink:
+    """
+    缓冲的异步 JSONL 写入器。
+
+    调用方只做一次 queue.put；序列化与写文件由后台线程按批完成，
+    每批只打开一次文件。
+    """
+
+    def __init__(self, path: str, flush_interval: float = FLUSH_INTERVAL, max_batch: int = MAX_BATCH):
+        # 创建时固定为绝对路径，避免进程切换工作目录后写到别处
+        self.path = os.path.abspath(path)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="trace-sink", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict):
+        self._queue.put(record)
+
+    def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.max_batch:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            if batch:
+                self._write_batch(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_batch(self, batch: list[dict]):
+        try:
+            parent = os.path.dirname(self.path)
+            if parent:
+                os.makedirs(parent, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))
+        except Exception:
+            pass
+
+    def flush(self):
+        """阻塞直到已提交的记录全部落盘"""
+        self._queue.join()
+
+
+_sink: JsonlSink | None = None
+_sink_lock = threading.Lock()
+
+
+def _get_sink() -> JsonlSink:
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = JsonlSink(TRACE_PATH)
+                atexit.register(_sink.flush)
+    return _sink
+
+
+def flush():
+    if _sink is not None:
+        _sink.flush()
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_trace_id() -> str | None:
+    return _trace_id.get()
+
+
+def begin_trace(trace_id: str | None = None):
+    """开始一条链路（如一次 HTTP 请求），返回用于 end_trace 的 token"""
+    return _trace_id.set(trace_id or new_trace_id())
+
+
+def end_trace(token):
+    _trace_id.reset(token)
+
+
+@contextmanager
+def trace(trace_id: str | None = None):
+    token = begin_trace(trace_id)
+    try:
+        yield _trace_id.get()
+    finally:
+        end_trace(token)
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """
+    记录一个阶段的耗时。yield 出的 dict 可继续补充属性（字节数、token 数等），
+    异常会被记录为 status=error 后继续抛出。
+    """
+    parent = _current_span.get()
+    record = dict(attrs)
+    meta = {
+        "span_id": uuid.uuid4().hex[:8],
+        "parent_id": parent["span_id"] if parent else None,
+        "record": record,
+    }
+    token = _current_span.set(meta)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield record
+    except BaseException as exc:
+        status = "error"
+        record.setdefault("error", str(exc)[:200])
+        raise
+    finally:
+        _current_span.reset(token)
+        _get_sink().write({
+            "ts": datetime.now().isoformat(),
+            "trace_id": _trace_id.get(),
+            "span_id": meta["span_id"],
+            "parent_id": meta["parent_id"],
+            "stage": stage,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            "status": status,
+            **record,
+        })
+
+
+def annotate(**attrs):
+    """给当前 span 补充属性（不在 span 内时忽略）"""
+    current = _current_span.get()
+    if current is not None:
+        current["record"].update(attrs)
+
+
+def traced(stage: str):
+    """函数装饰器版本的 span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def event(stage: str, **attrs):
+    """记录一个无耗时的事件（如上下文注入明细）"""
+    _get_sink().write({
+        "ts": datetime.now().isoformat(),
+        "trace_id": _trace_id.get(),
+        "parent_id": (_current_span.get() or {}).get("span_id"),
+        "stage": stage,
+        **attrs,
+    })
+
+
+def _percentile(sorted_values: list[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(path: str) -> dict[str, dict]:
+    """按 stage 汇总耗时分布"""
+    durations: dict[str, list[float]] = {}
+    errors: dict[str, int] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "duration_ms" not in record:
+                continue
+            stage = record.get("stage", "unknown")
+            durations.setdefault(stage, []).append(record["duration_ms"])
+            if record.get("status") == "error":
+                errors[stage] = errors.get(stage, 0) + 1
+
+    summary = {}
+    for stage, values in durations.items():
+        values.sort()
+        summary[stage] = {
+            "count": len(values),
+            "errors": errors.get(stage, 0),
+            "p50_ms": _percentile(values, 50),
+            "p95_ms": _percentile(values, 95),
+            "max_ms": values[-1],
+        }
+    return summary
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Per-stage latency report from trace JSONL")
+    parser.add_argument("path", nargs="?", default=TRACE_PATH, help="Trace JSONL path")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable JSON")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f"Trace file not found: {args.path}")
+        return 1
+    summary = summarize(args.path)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+        return 0
+
+    print(f"{'stage':<24}{'count':>8}{'errors':>8}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}")
+    for stage, row in sorted(summary.items()):
+        print(
+            f"{stage:<24}{row['count']:>8}{row['errors']:>8}"
+            f"{row['p50_ms']:>12.2f}{row['p95_ms']:>12.2f}{row['max_ms']:>12.2f}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,232 @@
+"""
+上传文件处理。
+
+- 流式落盘：分块写入临时文件，超过大小上限立即中止，边写边计算 sha256
+- 按内容哈希命名，重复上传的文件只保存一份
+- md / txt / docx / pdf 的文本提取在后台线程中进行，不阻塞请求；
+  提取结果合并登记为 reference_material 上下文，供 course_design_plan 等 Skill 作为可选上下文使用
+- PDF 需要 pypdf（requirements.txt 中已列出）；未安装时上传即拒绝，而不是在后台提取时才失败
+"""
+
+import hashlib
+import importlib.util
+import os
+import re
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from xml.etree import ElementTree
+
+import tracing
+from bus import GlobalStateBus
+
+
+UPLOAD_FOLDER = "uploads"
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024)  # 单个文件上限
+MAX_REQUEST_BYTES = int(float(os.getenv("MAX_REQUEST_MB", "100")) * 1024 * 1024)  # 单个请求上限
+CHUNK_SIZE = 64 * 1024
+
+CONTEXT_TYPE = "reference_material"
+PRODUCER = "upload"
+DESCRIPTION = "用户上传的已有课程资料（提取出的文本）"
+MATERIAL_FILENAME = "reference_material.md"
+
+PYPDF_AVAILABLE = importlib.util.find_spec("pypdf") is not None
+
+TEXT_EXTENSIONS = (".md", ".txt")
+EXTRACTABLE_EXTENSIONS = TEXT_EXTENSIONS + (".docx",) + ((".pdf",) if PYPDF_AVAILABLE else ())
+
+_EXTENSION_RE = re.compile(r"\.[a-z0-9]{1,8}")
+_WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class UploadTooLargeError(ValueError):
+    def __init__(self, filename: str, limit: int):
+        self.filename = filename
+        self.limit = limit
+        super().__init__(f"文件 {filename} 超过大小上限（{round(limit / (1024 * 1024), 2):g} MB）")
+
+
+class UnsupportedUploadError(ValueError):
+    def __init__(self, filename: str, reason: str):
+        self.filename = filename
+        super().__init__(f"无法处理文件 {filename}：{reason}")
+
+
+@dataclass
+class StoredUpload:
+    filename: str  # 原始文件名（仅用于展示）
+    path: str  # 按内容哈希命名的存储路径
+    sha256: str
+    size: int
+    duplicate: bool  # 相同内容此前已上传过
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def save_upload(file, upload_dir: str = UPLOAD_FOLDER, max_bytes: int = MAX_UPLOAD_BYTES) -> StoredUpload:
+    """
+    分块读取上传流写入磁盘，超过 max_bytes 时抛出 UploadTooLargeError；
+    无法提取文本的 PDF（未安装 pypdf）在写盘前抛出 UnsupportedUploadError。
+    """
+    # 文件名只用于展示；存储路径由内容哈希 + 扩展名组成
+    # （secure_filename 会去掉中文等非 ASCII 字符，不能用它来取扩展名）
+    filename = os.path.basename((file.filename or "").replace("\\", "/")).strip() or "upload"
+    ext = os.path.splitext(filename)[1].lower()
+    if not _EXTENSION_RE.fullmatch(ext):
+        ext = ""
+    if ext == ".pdf" and not PYPDF_AVAILABLE:
+        raise UnsupportedUploadError(filename, "PDF 文本提取需要安装 pypdf")
+    os.makedirs(upload_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = file.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLargeError(filename, max_bytes)
+                digest.update(chunk)
+                out.write(chunk)
+        sha256 = digest.hexdigest()
+        path = os.path.join(upload_dir, f"{sha256[:16]}{ext}")
+        duplicate = os.path.exists(path)
+        if duplicate:
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return StoredUpload(filename=filename, path=path, sha256=sha256, size=size, duplicate=duplicate)
+
+
+def is_extractable(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in EXTRACTABLE_EXTENSIONS
+
+
+def _decode(data: bytes) -> str:
+    for encoding in ("utf-8-sig", "gb18030"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="replace")
+
+
+def _extract_docx(path: str) -> str:
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{_WORD_NS}p"):
+        text = "".join(node.text or "" for node in paragraph.iter(f"{_WORD_NS}t"))
+        if text.strip():
+            paragraphs.append(text)
+    return "\n".join(paragraphs)
+
+
+def _extract_pdf(path: str) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise RuntimeError("PDF 文本提取需要安装 pypdf")
+    reader = PdfReader(path)
+    return "\n\n".join((page.extract_text() or "").strip() for page in reader.pages).strip()
+
+
+def extract_text(path: str) -> str:
+    ext = os.path.splitext(path)[1].lower()
+    if ext in TEXT_EXTENSIONS:
+        with open(path, "rb") as f:
+            return _decode(f.read())
+    if ext == ".docx":
+        return _extract_docx(path)
+    if ext == ".pdf":
+        return _extract_pdf(path)
+    raise ValueError(f"Unsupported file type: {ext}")
+
+
+class MaterialExtractor:
+    """
+    后台提取上传资料的文本，并把所有已提取的资料合并登记为 reference_material。
+
+    提取结果按内容哈希缓存在 uploads/extracted/ 下，重复上传不会重复提取。
+    """
+
+    def __init__(self, state_path: str, outputs_dir: str = "outputs", upload_dir: str = UPLOAD_FOLDER):
+        self.state_path = state_path
+        self.outputs_dir = outputs_dir
+        self.extracted_dir = os.path.join(upload_dir, "extracted")
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-extract")
+        # 请求线程与后台线程都会更新同一个集合条目，读-改-写需要串行
+        self._lock = threading.Lock()
+
+    def submit(self, upload: StoredUpload):
+        """先以 pending 登记，提取在后台完成"""
+        self._register(upload, "pending")
+        self._pool.submit(self._extract, upload, tracing.current_trace_id())
+
+    def _extract(self, upload: StoredUpload, trace_id: str | None):
+        with tracing.trace(trace_id):
+            text_path = os.path.join(self.extracted_dir, f"{upload.sha256[:16]}.txt")
+            try:
+                with tracing.span("upload.extract", filename=upload.filename, bytes=upload.size) as s:
+                    if not os.path.exists(text_path):
+                        text = extract_text(upload.path).strip()
+                        if not text:
+                            raise ValueError("No text extracted.")
+                        os.makedirs(self.extracted_dir, exist_ok=True)
+                        with open(text_path, "w", encoding="utf-8") as f:
+                            f.write(text)
+                    s["text_ref"] = text_path
+                self._register(upload, "ready", text_ref=text_path)
+            except Exception as exc:
+                self._register(upload, "failed", error=str(exc))
+
+    def _register(self, upload: StoredUpload, status: str, text_ref: str | None = None, error: str | None = None):
+        with self._lock:
+            self._register_locked(upload, status, text_ref, error)
+
+    def _register_locked(self, upload: StoredUpload, status: str, text_ref: str | None, error: str | None):
+        bus = GlobalStateBus(self.state_path)
+        entry = bus.get_state().get("context_index", {}).get(CONTEXT_TYPE) or {}
+        items = [item for item in entry.get("items", []) if item.get("sha256") != upload.sha256]
+        items.append({
+            "index": len(items) + 1,
+            "filename": upload.filename,
+            "sha256": upload.sha256,
+            "size": upload.size,
+            "ref": upload.path,
+            "text_ref": text_ref,
+            "status": status,
+            "error": error,
+        })
+        for index, item in enumerate(items, start=1):
+            item["index"] = index
+
+        # 合并全部已提取的资料，作为一个上下文文件供 Skill 读取
+        parts = []
+        for item in items:
+            if item["status"] == "ready" and item.get("text_ref") and os.path.exists(item["text_ref"]):
+                with open(item["text_ref"], "r", encoding="utf-8") as f:
+                    parts.append(f"## {item['filename']}\n\n{f.read().strip()}\n")
+        material_path = os.path.join(self.outputs_dir, MATERIAL_FILENAME)
+        if parts:
+            os.makedirs(self.outputs_dir, exist_ok=True)
+            with open(material_path, "w", encoding="utf-8") as f:
+                f.write("# 参考资料\n\n" + "\n".join(parts))
+            collection_status = "ready"
+        elif any(item["status"] == "pending" for item in items):
+            collection_status = "pending"
+        else:
+            collection_status = "failed"
+        bus.set_context_collection(CONTEXT_TYPE, PRODUCER, DESCRIPTION, material_path, items, collection_status)
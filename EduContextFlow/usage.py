@@ -0,0 +1,170 @@
+"""
+LLM 用量与成本核算。
+
+LLMClient 每次调用成功后调用 record()，按当前的用量归属（scope）累计到 GlobalStateBus：
+会话合计、按 Skill、按工作流运行。归属由调用方用 scope() 逐层补充：
+App / runner 设置会话（state_path）与工作流运行（run_id），executor / dispatcher 设置 Skill。
+后台线程通过 current_scope() 取得提交时的归属后重新进入，与 tracing 的 trace_id 用法一致。
+
+流式调用提前停止接收（如 Dispatcher 决策字段到齐）时，用量取自最后收到的中间块，
+输出 token 与成本偏低；这类调用计入 partial_calls，对应的 output_tokens 只是下限。
+
+会话预算（SESSION_BUDGET_USD / SESSION_TOKEN_BUDGET）超出后，按 BUDGET_ACTION：
+- downgrade：后续文本调用改用 fast 档模型
+- reject：拒绝后续调用，抛出 BudgetExceededError
+"""
+
+import contextvars
+import json
+import os
+from contextlib import contextmanager
+
+import metrics
+
+
+SESSION_BUDGET_USD = float(os.getenv("SESSION_BUDGET_USD", "0"))  # 0 为不限
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "0"))  # 0 为不限
+BUDGET_ACTION = os.getenv("BUDGET_ACTION", "downgrade")  # downgrade | reject
+
+# 美元价格：文本模型按每百万 token（input / output / cached input），图像模型按张
+# 价格会调整，可通过 LLM_PRICING（JSON，同结构）覆盖或补充
+DEFAULT_PRICING = {
+    "gemini-2.5-pro": {"input": 1.25, "output": 10.0, "cached": 0.31},
+    "gemini-2.5-flash": {"input": 0.30, "output": 2.50, "cached": 0.075},
+    "gemini-2.5-flash-lite": {"input": 0.10, "output": 0.40, "cached": 0.025},
+    "gemini-2.0-flash-lite": {"input": 0.075, "output": 0.30, "cached": 0.019},
+    "gemini-2.5-flash-image": {"image": 0.039},
+    "models/imagen-4.0-fast-generate-001": {"image": 0.02},
+}
+PRICING = {**DEFAULT_PRICING, **json.loads(os.getenv("LLM_PRICING", "{}"))}
+BATCH_PRICE_FACTOR = float(os.getenv("BATCH_PRICE_FACTOR", "0.5"))  # 批量接口相对在线调用的价格比例
+
+USAGE_FIELDS = (
+    "calls", "partial_calls", "prompt_tokens", "output_tokens", "cached_tokens", "thoughts_tokens",
+    "latency_seconds", "cost_usd",
+)
+
+_SCOPE: contextvars.ContextVar[dict] = contextvars.ContextVar("usage_scope", default={})
+
+
+class BudgetExceededError(RuntimeError):
+    def __init__(self, session: dict):
+        self.session = session
+        super().__init__(
+            f"已超出会话预算（已用 ${session.get('cost_usd', 0):.4f}，{total_tokens(session)} tokens），请调整预算后重试"
+        )
+
+
+def empty_usage() -> dict:
+    return dict.fromkeys(USAGE_FIELDS, 0)
+
+
+def total_tokens(totals: dict) -> int:
+    """计费 token 数：输入 + 输出 + 思考"""
+    return totals.get("prompt_tokens", 0) + totals.get("output_tokens", 0) + totals.get("thoughts_tokens", 0)
+
+
+def add_usage(total: dict, usage: dict):
+    for field in USAGE_FIELDS:
+        total[field] = round(total.get(field, 0) + usage.get(field, 0), 6)
+
+
+@contextmanager
+def scope(state_path: str | None = None, skill: str | None = None, run_id: str | None = None):
+    """在当前归属上补充字段（未给出的字段沿用外层）"""
+    updates = {"state_path": state_path, "skill": skill, "run_id": run_id}
+    merged = {**_SCOPE.get(), **{k: v for k, v in updates.items() if v is not None}}
+    token = _SCOPE.set(merged)
+    try:
+        yield merged
+    finally:
+        _SCOPE.reset(token)
+
+
+def begin(state_path: str) -> contextvars.Token:
+    """请求开始时设置会话归属（与 end 配对，供 Flask 的请求钩子使用）"""
+    return _SCOPE.set({"state_path": state_path})
+
+
+def end(token: contextvars.Token):
+    _SCOPE.reset(token)
+
+
+def current_scope() -> dict:
+    return dict(_SCOPE.get())
+
+
+def cost_usd(model: str, tokens: dict, images: int = 0) -> float:
+    price = PRICING.get(model) or PRICING.get(model.removeprefix("models/")) or {}
+    # prompt_tokens 中已包含命中缓存的部分；思考 token 按输出计价
+    cached = tokens.get("cached_tokens", 0)
+    fresh = max(0, tokens.get("prompt_tokens", 0) - cached)
+    output = tokens.get("output_tokens", 0) + tokens.get("thoughts_tokens", 0)
+    cost = (
+        fresh * price.get("input", 0)
+        + cached * price.get("cached", price.get("input", 0))
+        + output * price.get("output", 0)
+    ) / 1_000_000
+    return cost + images * price.get("image", 0)
+
+
+def _bus():
+    state_path = _SCOPE.get().get("state_path")
+    if not state_path:
+        return None
+    from bus import GlobalStateBus
+
+    return GlobalStateBus(state_path)
+
+
+def record(kind: str, model: str, tokens: dict, latency: float, images: int = 0, partial: bool = False) -> dict:
+    """
+    记录一次成功的调用，返回本次用量（kind="batch" 按批量单价计费）。
+
+    partial=True 表示 tokens 来自提前停止的流式响应，输出 token 只是下限，计入 partial_calls。
+    """
+    usage = empty_usage()
+    usage.update({key: value for key, value in tokens.items() if key in usage})
+    usage["calls"] = 1
+    usage["partial_calls"] = int(partial)
+    usage["latency_seconds"] = round(latency, 3)
+    price_factor = BATCH_PRICE_FACTOR if kind == "batch" else 1.0
+    usage["cost_usd"] = round(cost_usd(model, tokens, images) * price_factor, 6)
+
+    for key in ("prompt_tokens", "output_tokens", "cached_tokens", "thoughts_tokens"):
+        if usage[key]:
+            metrics.LLM_TOKENS.inc(usage[key], kind=kind, model=model, type=key.removesuffix("_tokens"))
+    if usage["cost_usd"]:
+        metrics.LLM_COST.inc(usage["cost_usd"], kind=kind, model=model)
+
+    bus = _bus()
+    if bus is not None:
+        current = _SCOPE.get()
+        bus.record_usage(usage, skill=current.get("skill"), run_id=current.get("run_id"))
+    return usage
+
+
+def budget_config() -> dict:
+    return {"usd": SESSION_BUDGET_USD, "tokens": SESSION_TOKEN_BUDGET, "action": BUDGET_ACTION}
+
+
+def over_budget(session: dict) -> bool:
+    return bool(
+        (SESSION_BUDGET_USD > 0 and session.get("cost_usd", 0) >= SESSION_BUDGET_USD)
+        or (SESSION_TOKEN_BUDGET > 0 and total_tokens(session) >= SESSION_TOKEN_BUDGET)
+    )
+
+
+def apply_budget(tier: str) -> str:
+    """调用前检查当前会话预算：未超出返回原档位，超出时降级或抛出 BudgetExceededError"""
+    if SESSION_BUDGET_USD <= 0 and SESSION_TOKEN_BUDGET <= 0:
+        return tier
+    bus = _bus()
+    if bus is None:
+        return tier
+    session = bus.get_usage()["session"]
+    if not over_budget(session):
+        return tier
+    if BUDGET_ACTION == "reject":
+        raise BudgetExceededError(session)
+    return "fast"
@@ -25,6 +25,7 @@ function showLoading() {
   loadingDiv.id = "loading-indicator";
   
   const textSpan = document.createElement("span");
+  textSpan.id = "loading-text";
   textSpan.textContent = "正在思考";
   
   const dotsDiv = document.createElement("div");
@@ -110,6 +111,88 @@ function renderOptions(options) {
   messagesEl.scrollTop = messagesEl.scrollHeight;
 }
 
+// 预览使用缩略图（服务端按浏览器支持返回 AVIF / WebP），点击查看原图
+function thumbnailLink(file, version) {
+  const query = version ? `&v=${encodeURIComponent(version)}` : "";
+  const link = document.createElement("a");
+  link.href = `/${file}`;
+  link.target = "_blank";
+  const img = document.createElement("img");
+  img.src = `/${file}?size=thumb${query}`;
+  img.alt = file;
+  img.loading = "lazy";
+  img.style.maxWidth = "100%";
+  img.style.borderRadius = "8px";
+  img.style.marginTop = "8px";
+  link.appendChild(img);
+  return link;
+}
+
+// 图像在后台渲染，完成后通过 SSE 推送，替换对应的占位元素
+function renderImageJob(job) {
+  const placeholder = document.getElementById(`image-job-${job.job_id}`);
+  if (!placeholder) return;
+  if (job.status === "done") {
+    // 内容哈希作为版本参数，服务端确认与当前内容一致时允许浏览器长期缓存
+    placeholder.replaceWith(thumbnailLink(job.output_path, job.content_hash));
+  } else if (job.status === "failed") {
+    placeholder.textContent = `插图生成失败: ${job.error || "未知错误"}`;
+  } else {
+    placeholder.textContent = job.status === "rendering" ? "插图渲染中…" : "插图排队中…";
+  }
+}
+
+// 工作流执行期间，按总线推送的 Skill 状态显示当前步骤
+function renderStateChanges(data) {
+  const textEl = document.getElementById("loading-text");
+  if (!textEl) {
+    return;
+  }
+  data.changes.forEach((change) => {
+    if (change.type === "skill" && change.status === "running") {
+      textEl.textContent = `正在执行 ${change.skill}`;
+    }
+  });
+}
+
+// 文本 Skill 生成中的内容（服务端已清理的增量）显示在加载提示中，请求返回后随加载提示一起移除
+function renderOutput(data) {
+  const loadingDiv = document.getElementById("loading-indicator");
+  if (!loadingDiv) {
+    return;
+  }
+  let preview = document.getElementById("stream-preview");
+  if (!preview) {
+    preview = document.createElement("pre");
+    preview.id = "stream-preview";
+    preview.className = "stream-preview";
+    loadingDiv.appendChild(preview);
+  }
+  if (data.text !== undefined) {
+    preview.textContent = data.text;
+  } else {
+    preview.textContent += data.delta || "";
+  }
+  preview.scrollTop = preview.scrollHeight;
+  if (data.done) {
+    // 工作流的下一步重新开始展示
+    preview.remove();
+  }
+}
+
+if (window.EventSource) {
+  const events = new EventSource("/api/events");
+  events.addEventListener("output", (event) => {
+    renderOutput(JSON.parse(event.data));
+  });
+  events.addEventListener("image", (event) => {
+    renderImageJob(JSON.parse(event.data));
+  });
+  events.addEventListener("state", (event) => {
+    renderStateChanges(JSON.parse(event.data));
+  });
+}
+
 function renderFiles() {
   fileList.innerHTML = "";
   imagePreview.innerHTML = "";
@@ -197,12 +280,7 @@ async function sendMessage() {
 
         // 图片直接预览
         if (file.endsWith(".png") || file.endsWith(".jpg") || file.endsWith(".jpeg")) {
-          const img = document.createElement("img");
-          img.src = `/${file}`;
-          img.alt = file;
-          img.style.maxWidth = "100%";
-          img.style.borderRadius = "8px";
-          img.style.marginTop = "8px";
+          const img = thumbnailLink(file);
           if (shouldRenderWrapper) {
             replyWrapper.appendChild(img);
           } else {
@@ -239,6 +317,21 @@ async function sendMessage() {
       });
     }
 
+    if (data.image_jobs && data.image_jobs.length > 0) {
+      data.image_jobs.forEach((job) => {
+        const placeholder = document.createElement("div");
+        placeholder.id = `image-job-${job.job_id}`;
+        placeholder.style.marginTop = "8px";
+        placeholder.style.color = "#888";
+        if (shouldRenderWrapper) {
+          replyWrapper.appendChild(placeholder);
+        } else {
+          messagesEl.appendChild(placeholder);
+        }
+        renderImageJob(job);
+      });
+    }
+
     messagesEl.scrollTop = messagesEl.scrollHeight;
 
     // 清空文件